@@ -0,0 +1,381 @@
+'''
+End-to-end benchmarks of the proxy against local origin servers.
+
+Starts an HTTP and an HTTPS origin (signed by a throwaway test CA) in this process, runs run_proxy
+in a child process in front of them, and drives each scenario through the proxy. The child process
+is restarted for every scenario, so its CPU time and peak RSS belong to that scenario alone.
+
+    python -m benchmarks.e2e --output results.json
+    python -m benchmarks.e2e --baseline results.json --threshold 0.1
+    python -m benchmarks.e2e --scenario small_get --scale 0.2 --proxy-config '{"upstream_http2": true}'
+'''
+from httprequest import RequestMessage
+from proxy import cert
+from proxy.replay import Report, send_via_proxy
+from benchmarks.util import ROOT_DIR, compare, get_commit
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from OpenSSL import crypto
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+
+SMALL_SIZE = 1024
+LARGE_SIZE = 64 * 1024 * 1024
+CHUNKED_SIZE = 1024 * 1024
+CHUNK_SIZE = 8192
+UPLOAD_SIZE = 1024 * 1024
+STORM_HOSTS = 64
+
+# name: (method, path, https, requests, concurrency)
+SCENARIOS = {
+    'small_get': ('GET', '/small', False, 3000, 16),
+    'large_download': ('GET', '/large', False, 16, 4),
+    'chunked': ('GET', '/chunked', False, 300, 8),
+    'gzip': ('GET', '/gzip', False, 1000, 16),
+    'upload': ('POST', '/upload', False, 300, 8),
+    'https_get': ('GET', '/small', True, 300, 8),
+    'connect_storm': ('GET', '/small', True, 500, 32),
+}
+
+# 大きいほど悪い指標と、小さいほど悪い指標
+HIGHER_IS_WORSE = ('p50', 'p99', 'cpu_per_request', 'peak_rss')
+LOWER_IS_WORSE = ('requests_per_second',)
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def create_test_ca(directory: str) -> tuple[str, str]:
+    private_key = cert.generate_keypair()
+    cacert, cacert_pem = cert.create_cacert(private_key)
+
+    key_path = os.path.join(directory, 'ca-key.pem')
+    cert_path = os.path.join(directory, 'ca-cert.pem')
+    with open(key_path, 'wb') as f:
+        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, private_key))
+    with open(cert_path, 'wb') as f:
+        f.write(cacert_pem)
+
+    return key_path, cert_path
+
+
+def create_origin_cert(directory: str, ca_key_path: str, ca_cert_path: str, hosts: list[str]) -> tuple[str, str]:
+    ca_key, _ = cert.get_private_key(ca_key_path)
+    ca_cert, _ = cert.get_cacert(ca_cert_path)
+    private_key = cert.generate_keypair()
+
+    server_cert = crypto.X509()
+    server_cert.set_version(2)
+    server_cert.set_serial_number(random.getrandbits(64))
+    server_cert.get_subject().CN = hosts[0]
+    server_cert.gmtime_adj_notBefore(0)
+    server_cert.gmtime_adj_notAfter(86400)
+    server_cert.set_issuer(ca_cert.get_subject())
+    server_cert.set_pubkey(private_key)
+    altname = b', '.join(cert.get_altname(x) for x in hosts)
+    server_cert.add_extensions([
+        crypto.X509Extension(b'subjectAltName', False, altname),
+        crypto.X509Extension(b'basicConstraints', False, b'CA:FALSE'),
+    ])
+    server_cert.sign(ca_key, 'sha256')
+
+    key_path = os.path.join(directory, 'origin-key.pem')
+    cert_path = os.path.join(directory, 'origin-cert.pem')
+    with open(key_path, 'wb') as f:
+        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, private_key))
+    with open(cert_path, 'wb') as f:
+        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, server_cert))
+
+    return key_path, cert_path
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    small_body = b'x' * SMALL_SIZE
+    gzip_body = gzip.compress(b''.join(b'{"id": %d, "name": "item-%d", "tags": ["a", "b"]}\n' % (i, i)
+                                       for i in range(2000)))
+    large_chunk = os.urandom(1024 * 1024)
+
+    def do_GET(self):
+        # プロキシからは absolute-form で届く
+        path = urllib.parse.urlsplit(self.path).path
+        if path == '/small':
+            self.send_body(self.small_body)
+        elif path == '/gzip':
+            self.send_body(self.gzip_body, (('Content-Encoding', 'gzip'), ('Content-Type', 'application/json')))
+        elif path == '/large':
+            self.send_response(200)
+            self.send_header('Content-Length', str(LARGE_SIZE))
+            self.end_headers()
+            for _ in range(LARGE_SIZE // len(self.large_chunk)):
+                self.wfile.write(self.large_chunk)
+        elif path == '/chunked':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            chunk = b'%x\r\n%s\r\n' % (CHUNK_SIZE, b'c' * CHUNK_SIZE)
+            for _ in range(CHUNKED_SIZE // CHUNK_SIZE):
+                self.wfile.write(chunk)
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 65536)))
+        self.send_body(b'ok')
+
+    def send_body(self, body: bytes, headers: tuple[tuple[str, str], ...] = ()):
+        self.send_response(200)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OriginServer(ThreadingHTTPServer):
+    # オリジンの accept キューが先に詰まらないように
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def start_origin(port: int, ssl_context: ssl.SSLContext | None = None) -> ThreadingHTTPServer:
+    # HTTPS のオリジンは 127.0.0.0/8 の別のアドレス宛ても受けるように全アドレスで待つ
+    server = OriginServer(('127.0.0.1' if ssl_context is None else '', port), OriginHandler)
+    if ssl_context:
+        server.socket = ssl_context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class ProxyProcess():
+    '''
+    run_proxy in a child process, with proxy/proxy.conf written to a temporary working directory.
+    '''
+
+    def __init__(self, directory: str, config: dict, ca_cert_path: str):
+        self.directory = directory
+        self.config = config
+        self.port = config['port']
+        os.makedirs(os.path.join(directory, 'proxy'), exist_ok=True)
+        with open(os.path.join(directory, 'proxy', 'proxy.conf'), 'wt') as f:
+            json.dump(config, f)
+
+        env = dict(os.environ, PYTHONPATH=ROOT_DIR)
+        # 証明書を作るときにオリジンの証明書を検証できるように、テスト用の CA を信頼させる
+        env['SSL_CERT_FILE'] = ca_cert_path
+        code = 'import proxy; proxy.run_proxy(lambda x: x, lambda x: x)'
+        self.process = subprocess.Popen([sys.executable, '-c', code], cwd=directory, env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.wait_ready()
+
+    def wait_ready(self, timeout: float = 10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        self.stop()
+        raise RuntimeError('The proxy did not start.')
+
+    def get_cpu_time(self) -> float | None:
+        # /proc/<pid>/stat の utime と stime (clock ticks)
+        try:
+            with open(f'/proc/{self.process.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def get_peak_rss(self) -> int | None:
+        try:
+            with open(f'/proc/{self.process.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class Bench():
+    def __init__(self, directory: str, proxy_config: dict | None = None, scale: float = 1.0):
+        self.directory = directory
+        self.proxy_config = proxy_config or {}
+        self.scale = scale
+
+        self.ca_key_path, self.ca_cert_path = create_test_ca(directory)
+        self.storm_hosts = ['127.0.0.%d' % i for i in range(1, STORM_HOSTS + 1)]
+        origin_key_path, origin_cert_path = create_origin_cert(
+            directory, self.ca_key_path, self.ca_cert_path, ['localhost'] + self.storm_hosts)
+
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(origin_cert_path, origin_key_path)
+        self.http_port = get_free_port()
+        self.https_port = get_free_port()
+        self.origins = [start_origin(self.http_port), start_origin(self.https_port, ssl_context)]
+
+    def get_proxy_config(self) -> dict:
+        config = {
+            'host': '127.0.0.1',
+            'port': get_free_port(),
+            'private_key_path': self.ca_key_path,
+            'cacert_path': self.ca_cert_path,
+            'access_log': False,
+        }
+        config.update(self.proxy_config)
+        return config
+
+    def run(self, name: str) -> dict:
+        method, path, is_ssl, requests, concurrency = SCENARIOS[name]
+        requests = max(int(requests * self.scale), 1)
+        body = os.urandom(UPLOAD_SIZE) if method == 'POST' else None
+
+        proxy = ProxyProcess(os.path.join(self.directory, name), self.get_proxy_config(), self.ca_cert_path)
+        try:
+            start_cpu = proxy.get_cpu_time()
+            report = Report()
+
+            def request(i: int):
+                if name == 'connect_storm':
+                    host = self.storm_hosts[i % len(self.storm_hosts)]
+                else:
+                    host = '127.0.0.1'
+                port = self.https_port if is_ssl else self.http_port
+                headers = {'Host': f'{host}:{port}', 'Accept-Encoding': 'gzip'}
+                if body:
+                    headers['Content-Length'] = str(len(body))
+                message = RequestMessage(method=method, request_target=path, http_version='HTTP/1.1',
+                                         headers=headers, raw_body=body)
+
+                start = time.monotonic()
+                try:
+                    status = send_via_proxy(('127.0.0.1', proxy.port), message, host, port, is_ssl)
+                    report.add(time.monotonic() - start, status=status)
+                except Exception as e:
+                    report.add(time.monotonic() - start, error=type(e).__name__)
+
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                list(executor.map(request, range(requests)))
+            report.finish()
+
+            end_cpu = proxy.get_cpu_time()
+            peak_rss = proxy.get_peak_rss()
+        finally:
+            proxy.stop()
+
+        result = report.to_dict()
+        cpu = end_cpu - start_cpu if start_cpu is not None and end_cpu is not None else None
+        return {
+            'requests': result['requests'],
+            'concurrency': concurrency,
+            'errors': sum(result['errors'].values()) + sum(v for k, v in result['statuses'].items()
+                                                           if not k.startswith('2')),
+            'requests_per_second': result['throughput'],
+            'p50': result['latency']['p50'],
+            'p99': result['latency']['p99'],
+            'cpu': cpu,
+            'cpu_per_request': cpu / result['requests'] if cpu is not None and result['requests'] else None,
+            'peak_rss': peak_rss,
+        }
+
+    def close(self):
+        for origin in self.origins:
+            origin.shutdown()
+            origin.server_close()
+
+
+def format_result(name: str, result: dict) -> str:
+    def ms(value):
+        return '-' if value is None else '%.2f' % (value * 1000)
+
+    rss = '-' if result['peak_rss'] is None else '%.1f' % (result['peak_rss'] / 1024 / 1024)
+    cpu = '-' if result['cpu'] is None else '%.2f' % result['cpu']
+    return '%-16s %8.1f %9s %9s %7s %8s %6d' % (
+        name, result['requests_per_second'], ms(result['p50']), ms(result['p99']), cpu, rss, result['errors'])
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.e2e', description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('-s', '--scenario', action='append', choices=list(SCENARIOS),
+                        help='scenario to run, can be repeated (default: all)')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply the number of requests')
+    parser.add_argument('--proxy-config', default='{}', help='JSON merged into proxy.conf')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('-b', '--baseline', help='compare with the results in this JSON file')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='allowed regression against the baseline (default: 0.1 = 10%%)')
+    args = parser.parse_args(argv)
+
+    results = {
+        'time': time.time(),
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'proxy_config': json.loads(args.proxy_config),
+        'scenarios': {},
+    }
+
+    print('%-16s %8s %9s %9s %7s %8s %6s' % ('scenario', 'req/s', 'p50 ms', 'p99 ms', 'cpu s', 'rss MB', 'errors'))
+    with tempfile.TemporaryDirectory() as directory:
+        bench = Bench(directory, results['proxy_config'], args.scale)
+        try:
+            for name in args.scenario or SCENARIOS:
+                result = bench.run(name)
+                results['scenarios'][name] = result
+                print(format_result(name, result), flush=True)
+        finally:
+            bench.close()
+
+    if args.output:
+        with open(args.output, 'wt') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, 'scenarios', HIGHER_IS_WORSE, LOWER_IS_WORSE)
+        if regressions:
+            print('\nRegressions against %s:' % args.baseline)
+            for regression in regressions:
+                print('  ' + regression)
+            return 1
+        print('\nNo regressions against %s.' % args.baseline)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
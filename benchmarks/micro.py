@@ -0,0 +1,387 @@
+'''
+Microbenchmarks of the httprequest message layer.
+
+Parses and serializes a corpus of requests and responses (huge cookies, many headers, form, JSON,
+multipart, chunked and compressed bodies) with no network in between, and reports the time per
+operation and the memory it allocates. Flows recorded by the capture stage can be added to the corpus.
+
+    python -m benchmarks.micro
+    python -m benchmarks.micro --filter headers --output micro.json
+    python -m benchmarks.micro --capture-dir captures --baseline micro.json
+'''
+from httprequest import encoding, util
+from httprequest.http import Headers, MediaType, Query, RequestMessage, ResponseMessage, URI
+from proxy.capture import CaptureReader
+from benchmarks.util import compare, get_commit
+from collections.abc import Callable
+
+import argparse
+import gc
+import gzip
+import json
+import platform
+import random
+import re
+import sys
+import time
+import tracemalloc
+import zlib
+
+import brotli
+
+
+MIN_TIME = 0.2
+REPEAT = 5
+ALLOCATION_ROUNDS = 20
+# 大きいほど悪い指標
+METRICS = ('ns_per_op', 'peak_bytes_per_op', 'blocks_per_op')
+CAPTURE_FLOWS = 50
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+
+
+def get_cookie(size: int) -> str:
+    rand = random.Random(size)
+    cookies = []
+    length = 0
+    while length < size:
+        cookie = '_c%d=%s' % (len(cookies), ''.join(rand.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=48)))
+        cookies.append(cookie)
+        length += len(cookie) + 2
+    return '; '.join(cookies)
+
+
+def get_head(start_line: str, fields: list[tuple[str, str]]) -> bytes:
+    return (start_line + '\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in fields) + '\r\n').encode()
+
+
+def get_chunked(data: bytes, chunk_size: int) -> bytes:
+    chunks = [b'%x\r\n%s\r\n' % (len(data[i:i + chunk_size]), data[i:i + chunk_size])
+              for i in range(0, len(data), chunk_size)]
+    return b''.join(chunks) + b'0\r\n\r\n'
+
+
+def get_multipart(boundary: str, files: int, size: int) -> bytes:
+    rand = random.Random(files)
+    parts = [b'--%s\r\nContent-Disposition: form-data; name="comment"\r\n\r\nhello\r\n' % boundary.encode()]
+    for i in range(files):
+        parts.append(b'--%s\r\nContent-Disposition: form-data; name="file%d"; filename="file%d.bin"\r\n'
+                     b'Content-Type: application/octet-stream\r\n\r\n%s\r\n'
+                     % (boundary.encode(), i, i, rand.randbytes(size)))
+    parts.append(b'--%s--\r\n' % boundary.encode())
+    return b''.join(parts)
+
+
+def get_json(items: int) -> bytes:
+    return json.dumps([{'id': i, 'name': f'item-{i}', 'tags': ['a', 'b'], 'price': i * 1.5}
+                       for i in range(items)]).encode()
+
+
+def get_html(size: int) -> bytes:
+    row = b'<tr><td class="name">item</td><td class="price">1,280</td><td><a href="/items/1">detail</a></td></tr>\n'
+    return b'<!DOCTYPE html>\n<html><body><table>\n' + row * (size // len(row)) + b'</table></body></html>\n'
+
+
+def build_requests() -> dict[str, bytes]:
+    browser = [
+        ('Host', 'www.example.com'),
+        ('User-Agent', USER_AGENT),
+        ('Accept', 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8'),
+        ('Accept-Language', 'ja,en-US;q=0.7,en;q=0.3'),
+        ('Accept-Encoding', 'gzip, deflate, br'),
+        ('Connection', 'keep-alive'),
+        ('Upgrade-Insecure-Requests', '1'),
+    ]
+    many_headers = browser + [(f'X-Custom-Header-{i}', f'value-{i}-' + 'v' * 32) for i in range(100)]
+    form = b'&'.join(b'field%d=value%%20%d' % (i, i) for i in range(50))
+    body = get_json(50)
+    multipart = get_multipart('----WebKitFormBoundary7MA4YWxkTrZu0gW', 4, 16 * 1024)
+    query = '&'.join(f'q{i}=%E6%A4%9C%E7%B4%A2{i}' for i in range(40))
+
+    return {
+        'get': get_head('GET /index.html HTTP/1.1', browser),
+        'get_query': get_head(f'GET /search?{query} HTTP/1.1', browser),
+        'cookie_8k': get_head('GET / HTTP/1.1', browser + [('Cookie', get_cookie(8 * 1024))]),
+        'cookie_64k': get_head('GET / HTTP/1.1', browser + [('Cookie', get_cookie(64 * 1024))]),
+        'many_headers': get_head('GET / HTTP/1.1', many_headers),
+        'form': get_head('POST /login HTTP/1.1', browser + [
+            ('Content-Type', 'application/x-www-form-urlencoded'), ('Content-Length', str(len(form)))]) + form,
+        'json': get_head('POST /api/items HTTP/1.1', browser + [
+            ('Content-Type', 'application/json'), ('Content-Length', str(len(body)))]) + body,
+        'multipart': get_head('POST /upload HTTP/1.1', browser + [
+            ('Content-Type', 'multipart/form-data; boundary=----WebKitFormBoundary7MA4YWxkTrZu0gW'),
+            ('Content-Length', str(len(multipart)))]) + multipart,
+    }
+
+
+def build_responses() -> dict[str, bytes]:
+    common = [
+        ('Date', 'Mon, 01 Jan 2024 00:00:00 GMT'),
+        ('Server', 'nginx'),
+        ('Cache-Control', 'private, max-age=0'),
+        ('Set-Cookie', 'session=' + 's' * 64 + '; Path=/; HttpOnly; Secure'),
+    ]
+    html = get_html(32 * 1024)
+    body = get_json(500)
+
+    return {
+        'html': get_head('HTTP/1.1 200 OK', common + [
+            ('Content-Type', 'text/html; charset=utf-8'), ('Content-Length', str(len(html)))]) + html,
+        'not_modified': get_head('HTTP/1.1 304 Not Modified', common + [('ETag', '"5d8c72a5edda8"')]),
+        'chunked': get_head('HTTP/1.1 200 OK', common + [
+            ('Content-Type', 'application/json'), ('Transfer-Encoding', 'chunked')]) + get_chunked(body, 4096),
+        'gzip': get_head('HTTP/1.1 200 OK', common + [
+            ('Content-Type', 'application/json'), ('Content-Encoding', 'gzip')]) + gzip.compress(body),
+        'many_headers': get_head('HTTP/1.1 200 OK', common + [
+            (f'X-Custom-Header-{i}', f'value-{i}') for i in range(100)] + [('Content-Length', '0')]),
+    }
+
+
+def build_encoded() -> dict[str, tuple[bytes, str]]:
+    content = get_json(2000)
+    deflate = zlib.compressobj(wbits=-15)
+    return {
+        'gzip': (gzip.compress(content), 'gzip'),
+        'deflate': (zlib.compress(content), 'deflate'),
+        'raw_deflate': (deflate.compress(content) + deflate.flush(), 'deflate'),
+        'br': (brotli.compress(content), 'br'),
+    }
+
+
+def load_captured(directory: str, count: int) -> tuple[dict[str, bytes], dict[str, bytes]]:
+    '''
+    Request and response bytes of the last count flows in a capture directory.
+    '''
+    reader = CaptureReader(directory)
+    requests, responses = {}, {}
+    try:
+        for segment_id in reversed(reader.get_segment_ids()):
+            for offset, *_ in reversed(reader.read_index(segment_id)):
+                if len(requests) >= count:
+                    return requests, responses
+                flow = reader.read(segment_id, offset)
+                name = 'captured_%d_%d' % (segment_id, offset)
+                requests[name] = flow.request.tobytes()
+                if len(flow.response):
+                    responses[name] = flow.response.tobytes()
+    finally:
+        reader.close()
+
+    return requests, responses
+
+
+def get_head_part(message: bytes) -> bytes:
+    _, remained = message.split(b'\r\n', 1)
+    return remained.split(b'\r\n\r\n', 1)[0]
+
+
+def build_cases(requests: dict[str, bytes], responses: dict[str, bytes]) -> dict[str, tuple[Callable, object]]:
+    '''
+    name: (function, argument). Serializing cases take an already parsed object, so only the
+    serialization is measured.
+    '''
+    cases = {}
+    for name, message in requests.items():
+        cases[f'headers.parse/{name}'] = (Headers, get_head_part(message))
+    for name, message in requests.items():
+        cases[f'headers.bytes/{name}'] = (bytes, Headers(get_head_part(message)))
+
+    for name, message in requests.items():
+        cases[f'request.parse/{name}'] = (RequestMessage, message)
+    for name, message in requests.items():
+        cases[f'request.bytes/{name}'] = (bytes, RequestMessage(message))
+
+    for name, message in responses.items():
+        cases[f'response.parse/{name}'] = (ResponseMessage, message)
+    for name, message in responses.items():
+        cases[f'response.bytes/{name}'] = (bytes, ResponseMessage(message))
+
+    queries = {
+        'short': 'q=proxy&page=2',
+        'long': '&'.join(f'q{i}=%E6%A4%9C%E7%B4%A2{i}' for i in range(40)),
+        'utm': 'utm_source=newsletter&utm_medium=email&utm_campaign=spring_sale&utm_term=shoes&utm_content=a',
+    }
+    for name, query in queries.items():
+        cases[f'query.parse/{name}'] = (Query, query)
+    for name, query in queries.items():
+        cases[f'query.str/{name}'] = (str, Query(query))
+
+    uris = {
+        'short': 'http://example.com/',
+        'port': 'https://api.example.com:8443/v2/items/12345',
+        'long': 'https://www.example.com/search/results/page?' + queries['long'] + '#top',
+    }
+    for name, uri in uris.items():
+        cases[f'uri.parse/{name}'] = (URI, uri)
+
+    media_types = {
+        'plain': 'text/html',
+        'charset': 'text/html; charset=utf-8',
+        'suffix': 'application/vnd.api+json',
+        'multipart': 'multipart/form-data; boundary=----WebKitFormBoundary7MA4YWxkTrZu0gW',
+    }
+    for name, media_type in media_types.items():
+        cases[f'media_type.parse/{name}'] = (MediaType, media_type)
+
+    content = get_json(2000)
+    chunked = {
+        'small_chunks': get_chunked(content, 256),
+        'large_chunks': get_chunked(content, 16 * 1024),
+    }
+    for name, raw_body in chunked.items():
+        cases[f'chunked_conv/{name}'] = (util.chunked_conv, raw_body)
+
+    for name, (encoded, coding) in build_encoded().items():
+        cases[f'decode/{name}'] = (lambda x: encoding.decode(*x), (encoded, coding))
+
+    return cases
+
+
+def measure_time(function: Callable, argument, min_time: float = MIN_TIME, repeat: int = REPEAT) -> float:
+    '''
+    ns/op, the best of repeat runs that each take at least min_time, like timeit.
+    '''
+    loops = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            function(argument)
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= min_time * 1e9:
+            break
+        loops *= 2 if elapsed * 10 > min_time * 1e9 else 10
+
+    best = elapsed / loops
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat - 1):
+            start = time.perf_counter_ns()
+            for _ in range(loops):
+                function(argument)
+            best = min(best, (time.perf_counter_ns() - start) / loops)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return best
+
+
+def measure_allocations(function: Callable, argument, rounds: int = ALLOCATION_ROUNDS) -> tuple[int, float]:
+    '''
+    Peak bytes allocated while one operation runs, and the number of memory blocks the operation leaves
+    allocated (its result included) per op.
+    '''
+    # 初回だけの確保（キャッシュ、import）を除く
+    function(argument)
+
+    tracemalloc.start()
+    try:
+        peak = 0
+        for _ in range(rounds):
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            result = function(argument)
+            _, top = tracemalloc.get_traced_memory()
+            peak = max(peak, top - base)
+            del result
+
+        results = []
+        before = tracemalloc.take_snapshot()
+        for _ in range(rounds):
+            results.append(function(argument))
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    # results のリスト自体の確保はこのファイルに付くので数えない
+    stats = after.filter_traces([tracemalloc.Filter(False, __file__)]).compare_to(
+        before.filter_traces([tracemalloc.Filter(False, __file__)]), 'filename')
+    blocks = sum(x.count_diff for x in stats if x.count_diff > 0)
+    del results
+
+    return peak, blocks / rounds
+
+
+def run(cases: dict[str, tuple[Callable, object]], min_time: float = MIN_TIME) -> dict[str, dict]:
+    results = {}
+    for name, (function, argument) in cases.items():
+        ns = measure_time(function, argument, min_time)
+        peak, blocks = measure_allocations(function, argument)
+        results[name] = {'ns_per_op': ns, 'peak_bytes_per_op': peak, 'blocks_per_op': blocks,
+                         'input_bytes': len(argument) if isinstance(argument, (bytes, str)) else None}
+        print(format_result(name, results[name]), flush=True)
+
+    return results
+
+
+def format_result(name: str, result: dict) -> str:
+    size = '-' if result['input_bytes'] is None else str(result['input_bytes'])
+    return '%-34s %12.0f %12d %10.1f %9s' % (
+        name, result['ns_per_op'], result['peak_bytes_per_op'], result['blocks_per_op'], size)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.micro', description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('-f', '--filter', help='run only the cases whose name matches this regular expression')
+    parser.add_argument('-l', '--list', action='store_true', help='list the cases and exit')
+    parser.add_argument('--min-time', type=float, default=MIN_TIME, help='seconds per timing run')
+    parser.add_argument('-d', '--capture-dir', help='add the last flows of this capture directory to the corpus')
+    parser.add_argument('--capture-flows', type=int, default=CAPTURE_FLOWS,
+                        help='number of captured flows to add (default: %(default)s)')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('-b', '--baseline', help='compare with the results in this JSON file')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='allowed regression against the baseline (default: 0.1 = 10%%)')
+    args = parser.parse_args(argv)
+
+    requests, responses = build_requests(), build_responses()
+    if args.capture_dir:
+        captured_requests, captured_responses = load_captured(args.capture_dir, args.capture_flows)
+        requests.update(captured_requests)
+        responses.update(captured_responses)
+
+    cases = build_cases(requests, responses)
+    if args.filter:
+        try:
+            pattern = re.compile(args.filter)
+        except re.error as e:
+            parser.error(f'Invalid filter: {e}')
+        cases = {k: v for k, v in cases.items() if pattern.search(k)}
+
+    if args.list:
+        for name in cases:
+            print(name)
+        return 0
+
+    results = {
+        'time': time.time(),
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cases': {},
+    }
+
+    print('%-34s %12s %12s %10s %9s' % ('case', 'ns/op', 'peak B/op', 'blocks/op', 'input B'))
+    results['cases'] = run(cases, args.min_time)
+
+    if args.output:
+        with open(args.output, 'wt') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, 'cases', METRICS)
+        if regressions:
+            print('\nRegressions against %s:' % args.baseline)
+            for regression in regressions:
+                print('  ' + regression)
+            return 1
+        print('\nNo regressions against %s.' % args.baseline)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,44 @@
+'''
+Helpers shared by the benchmark suites.
+'''
+import os
+import subprocess
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def compare(results: dict, baseline: dict, threshold: float, key: str, higher_is_worse: tuple[str, ...],
+            lower_is_worse: tuple[str, ...] = ()) -> list[str]:
+    '''
+    Metrics of results[key] that got worse than the baseline by more than threshold (0.1 = 10%),
+    and entries with more errors than in the baseline.
+    '''
+    regressions = []
+    for name, result in results[key].items():
+        base = baseline.get(key, {}).get(name)
+        if not base:
+            continue
+
+        for metric in higher_is_worse + lower_is_worse:
+            value, base_value = result.get(metric), base.get(metric)
+            if not value or not base_value:
+                continue
+            change = (value - base_value) / base_value
+            if metric in lower_is_worse:
+                change = -change
+            if change > threshold:
+                regressions.append('%s %s: %.4g -> %.4g (%+.1f%%)' % (name, metric, base_value, value,
+                                                                     (value - base_value) / base_value * 100))
+        if result.get('errors', 0) > base.get('errors', 0):
+            regressions.append('%s errors: %d -> %d' % (name, base.get('errors', 0), result['errors']))
+
+    return regressions
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
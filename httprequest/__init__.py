@@ -1,4 +1,9 @@
+from .aio import AsyncSession, adelete, aget, apatch, apost, aput
+from .buffer import Buffer
+from .cache import Cache
 from .exceptions import (
+    ChunkedEncodingError,
+    DecompressionLimitError,
     HeaderNotSetError,
     NotHttp11RequestMessageError,
     NotHttp11ResponseMessageError,
@@ -8,6 +13,8 @@ from .exceptions import (
     NotPortNumberError,
     NotRequestLineError,
     NotURIError,
+    StreamNotProcessedError,
+    UnsupportedContentEncodingError,
 )
 from .http import (
     URI,
@@ -18,8 +25,12 @@ from .http import (
     RequestMessage,
     Response,
     ResponseMessage,
+    ResponseStream,
 )
 from .httprequest import delete, get, patch, post, put
+from .resolver import Resolver
+from .session import Session
+from .timing import Timing
 from .tube import Tube
 
 """
@@ -48,4 +59,18 @@ response = request_message.send('host', port, is_ssl)
 prepared_request = httprequest.PreparedRequest('host', port, is_ssl, request_message)
 response = prepared_request.send()
 
+with httprequest.Session(headers={'User-Agent': 'crawler/1.0'}) as session:
+    response = session.get('https://example.com')
+    for url, response in session.fetch_many(urls, concurrency=32):
+        print(url, response.message.status_code)
+
+response = await httprequest.aget('https://example.com')
+
+async with httprequest.AsyncSession() as session:
+    async for url, response in session.fetch_many(urls, concurrency=200):
+        print(url, response.message.status_code)
+    async with session.stream('GET', 'https://example.com/large') as response:
+        async for data in response:
+            f.write(data)
+
 """
@@ -0,0 +1,517 @@
+import asyncio
+import ssl
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Callable, Iterable, Iterator
+from contextlib import asynccontextmanager, contextmanager
+from itertools import islice
+
+import h11
+
+from . import encoding, exceptions, resolver
+from .buffer import Buffer
+from .http import Headers, PreparedRequest, Request, RequestMessage, Response, ResponseBody, ResponseMessage
+from .httprequest import prepare
+from .resolver import Resolver
+from .session import CONCURRENCY, IDEMPOTENT_METHODS, IDLE_TIMEOUT, MAX_IDLE_PER_HOST, TIMEOUT, FetchItem
+from .timing import Timing
+from .tube import Tube, create_ssl_context
+
+RECV_SIZE = 65536
+
+Origin = tuple[str, int, bool]
+
+
+class AsyncConnection:
+    """
+    One HTTP/1.1 connection over asyncio streams. Requests are framed and responses parsed with h11,
+    one h11.Connection per exchange, so a HEAD or 304 response without a body is read correctly.
+
+    >>> connection = await AsyncConnection.open("example.com", 443, True)
+    >>> await connection.send_message(message)
+    >>> response_message = await connection.recv_head()
+    >>> async for data in connection.iter_body():
+    ...     pass
+    """
+
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    timing: Timing
+    keep_alive: bool
+
+    def __init__(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, timeout: float = TIMEOUT
+    ) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.timing = Timing()
+        self.keep_alive = False
+        self._conn = h11.Connection(our_role=h11.CLIENT)
+
+    @classmethod
+    async def open(
+        cls,
+        host: str,
+        port: int,
+        is_ssl: bool,
+        timeout: float = TIMEOUT,
+        dns_resolver: Resolver | None = None,
+        ssl_context: ssl.SSLContext | None = None,
+    ) -> "AsyncConnection":
+        # 名前解決と Happy Eyeballs の接続は Tube の実装をスレッドで使い、張れたソケットをストリームに渡す
+        timing = Timing()
+        tube = Tube(timing, dns_resolver)
+        await asyncio.to_thread(tube.open_connection, host, port, False, timeout)
+        try:
+            reader, writer = await asyncio.open_connection(sock=tube.socket, limit=RECV_SIZE)
+        except BaseException:
+            tube.close()
+            raise
+
+        if is_ssl:
+            timing.mark("tls_start")
+            try:
+                await asyncio.wait_for(
+                    writer.start_tls(ssl_context or create_ssl_context(), server_hostname=host), timeout
+                )
+            except BaseException:
+                writer.transport.abort()
+                raise
+            timing.mark("tls_end")
+
+        connection = cls(reader, writer, timeout)
+        connection.timing = timing
+        return connection
+
+    def is_reusable(self) -> bool:
+        # 待機中に閉じられた、または何か届いた接続は使わない
+        return self.keep_alive and not self.writer.is_closing() and not self.reader.at_eof()
+
+    async def send_message(self, message: RequestMessage) -> None:
+        self._conn = h11.Connection(our_role=h11.CLIENT)
+        self.keep_alive = False
+
+        headers = [(key, message.headers[key]) for key in message.headers]
+        data = self._conn.send(h11.Request(method=message.method, target=message.request_target, headers=headers))
+        if message.body:
+            data += self._conn.send(h11.Data(data=bytes(message.body)))
+        data += self._conn.send(h11.EndOfMessage())
+
+        self.timing.mark("request_start")
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+        self.timing.mark("request_end")
+
+    async def recv_head(self) -> ResponseMessage:
+        while True:
+            event = await self._next_event()
+            if type(event) is h11.Response:
+                break
+            if type(event) is h11.ConnectionClosed:
+                raise exceptions.NotHttp11ResponseMessageError()
+
+        # 1xx は読み飛ばし、最終レスポンスのステータス行とヘッダーを組み立てる
+        lines = [(b"HTTP/%s %d %s" % (event.http_version, event.status_code, event.reason)).rstrip()]
+        for key, value in event.headers.raw_items():
+            lines.append(key + b": " + value)
+
+        return ResponseMessage(b"\r\n".join(lines) + b"\r\n\r\n")
+
+    async def iter_body(self) -> AsyncIterator[bytes]:
+        """
+        The body after the transfer coding (chunked) is removed.
+        """
+        while True:
+            event = await self._next_event()
+            if type(event) is h11.Data:
+                yield bytes(event.data)
+            elif type(event) in (h11.EndOfMessage, h11.ConnectionClosed):
+                break
+
+        self.timing.mark("response_end")
+        self.keep_alive = self._conn.our_state is h11.DONE and self._conn.their_state is h11.DONE
+
+    async def _next_event(self):
+        while True:
+            event = self._conn.next_event()
+            if event is not h11.NEED_DATA:
+                return event
+
+            data = await asyncio.wait_for(self.reader.read(RECV_SIZE), self.timeout)
+            if self.timing.first_byte is None:
+                self.timing.mark("first_byte")
+            self._conn.receive_data(data)
+
+    def abort(self) -> None:
+        self.writer.transport.abort()
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+
+
+class AsyncConnectionPool:
+    """
+    Idle keep-alive AsyncConnections per origin, the async counterpart of session.TubePool.
+    It belongs to one event loop, so it needs no locks.
+    """
+
+    def __init__(
+        self,
+        max_idle_per_host: int = MAX_IDLE_PER_HOST,
+        idle_timeout: float = IDLE_TIMEOUT,
+        dns_resolver: Resolver | None = None,
+        timeout: float = TIMEOUT,
+    ) -> None:
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.dns_resolver = dns_resolver
+        self.timeout = timeout
+        self.created = 0
+        self.reused = 0
+        self.closed = False
+
+        self._idle: dict[Origin, deque[tuple[AsyncConnection, float]]] = {}
+        self._idle_limits: list[int] = []
+        self._ssl_context = create_ssl_context()
+
+    async def acquire(self, host: str, port: int, is_ssl: bool) -> tuple[AsyncConnection, bool]:
+        idle = self._idle.get((host, port, is_ssl))
+        while idle:
+            connection, released = idle.pop()
+            if time.monotonic() - released < self.idle_timeout and connection.is_reusable():
+                connection.timing = Timing()
+                self.reused += 1
+                return connection, True
+            connection.abort()
+
+        connection = await AsyncConnection.open(
+            host, port, is_ssl, self.timeout, self.dns_resolver, self._ssl_context if is_ssl else None
+        )
+        self.created += 1
+        return connection, False
+
+    def release(self, connection: AsyncConnection, host: str, port: int, is_ssl: bool) -> None:
+        if connection.is_reusable() and not self.closed:
+            idle = self._idle.setdefault((host, port, is_ssl), deque())
+            if len(idle) < max([self.max_idle_per_host, *self._idle_limits]):
+                idle.append((connection, time.monotonic()))
+                return
+
+        connection.abort()
+
+    @contextmanager
+    def idle_limit(self, count: int) -> Iterator[None]:
+        """
+        See TubePool.idle_limit().
+        """
+        self._idle_limits.append(count)
+        try:
+            yield
+        finally:
+            self._idle_limits.remove(count)
+            limit = max([self.max_idle_per_host, *self._idle_limits])
+            for idle in self._idle.values():
+                while len(idle) > limit:
+                    idle.popleft()[0].abort()
+
+    def get_idle_count(self) -> int:
+        return sum(len(x) for x in self._idle.values())
+
+    async def close(self) -> None:
+        self.closed = True
+        connections = [connection for idle in self._idle.values() for connection, _ in idle]
+        self._idle.clear()
+
+        for connection in connections:
+            await connection.close()
+
+
+class StreamingResponse(Response):
+    """
+    A Response whose body has not been read yet: message has the status line and headers,
+    and message.body stays empty until aread(). Iterating over it yields the body as it arrives.
+
+    >>> async with session.stream("GET", url) as response:
+    ...     async for data in response:
+    ...         f.write(data)
+    """
+
+    def __init__(
+        self,
+        request: Request,
+        response_time: float,
+        message: ResponseMessage,
+        connection: AsyncConnection,
+        release: Callable[[AsyncConnection], None],
+        decode_content: bool = False,
+    ) -> None:
+        super().__init__(request, response_time, message, connection.timing)
+        self.connection = connection
+        self.consumed = False
+        self._release = release
+        self._decoder: encoding.Decoder | None = None
+
+        # decode_content=True の場合は読みながら展開し、Content-Encoding を外す
+        if decode_content and "Content-Encoding" in message.headers:
+            try:
+                self._decoder = encoding.get_decoder(message.headers["Content-Encoding"])
+            except exceptions.UnsupportedContentEncodingError:
+                self._decoder = None
+            else:
+                del message.headers["Content-Encoding"]
+                if "Content-Length" in message.headers:
+                    del message.headers["Content-Length"]
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self.iter_bytes()
+
+    async def iter_bytes(self) -> AsyncIterator[bytes]:
+        if self.consumed:
+            raise RuntimeError("The body has already been read.")
+        self.consumed = True
+
+        async for data in self.connection.iter_body():
+            if self._decoder is None:
+                yield data
+                continue
+            for chunk in self._decoder.decompress(data):
+                yield chunk
+        if self._decoder is not None:
+            for chunk in self._decoder.flush():
+                yield chunk
+
+        self._release(self.connection)
+
+    async def aread(self) -> bytes:
+        body = Buffer(blocking=False)
+        async for data in self.iter_bytes():
+            body.write(data)
+
+        # PreparedRequest.send() と同じく、chunked を外して Content-Length を付ける
+        self.message.body = ResponseBody(body)
+        if self.message.is_chunked():
+            del self.message.headers["Transfer-Encoding"]
+            self.message.headers["Content-Length"] = str(len(body))
+        elif self._decoder is not None:
+            self.message.headers["Content-Length"] = str(len(body))
+        self.message.set_content_encoding()
+
+        return bytes(body)
+
+    async def aclose(self) -> None:
+        # 読み切っていない接続は使い回せない
+        if not self.consumed or not self.connection.keep_alive:
+            self.connection.abort()
+
+
+class AsyncSession:
+    """
+    The asyncio counterpart of Session: a keep-alive pool, a DNS cache and default headers, with
+    connections on asyncio streams so thousands of requests can be in flight on one event loop.
+    Responses are the same Response and ResponseMessage as the synchronous API returns.
+
+    Unlike Session, TLS sessions are not resumed, as asyncio streams do not accept an ssl.SSLSession.
+
+    >>> async with AsyncSession(headers={"User-Agent": "crawler/1.0"}) as session:
+    ...     response = await session.get("https://example.com/")
+    ...     async for url, response in session.fetch_many(urls, concurrency=200):
+    ...         print(url, response.message.status_code)
+    """
+
+    headers: Headers
+    dns_resolver: Resolver
+    pool: AsyncConnectionPool
+
+    def __init__(
+        self,
+        headers: dict | None = None,
+        max_idle_per_host: int = MAX_IDLE_PER_HOST,
+        idle_timeout: float = IDLE_TIMEOUT,
+        timeout: float = TIMEOUT,
+        decode_content: bool = False,
+        dns_resolver: Resolver | None = None,
+    ) -> None:
+        self.headers = Headers(headers)
+        self.decode_content = decode_content
+        self.dns_resolver = dns_resolver or Resolver()
+        self.pool = AsyncConnectionPool(max_idle_per_host, idle_timeout, self.dns_resolver, timeout)
+
+    async def __aenter__(self) -> "AsyncSession":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    def prepare(
+        self, method: str, url: str, headers: dict | None = None, body: bytes | None = None
+    ) -> PreparedRequest:
+        prepared_request = prepare(method, url, headers, body)
+        message_headers = prepared_request.message.headers
+        for key in self.headers:
+            if key not in message_headers:
+                message_headers[key] = self.headers.get_as_list(key)
+
+        return prepared_request
+
+    async def send(self, prepared_request: PreparedRequest) -> Response | None:
+        """
+        Sends the request and reads the whole response, like PreparedRequest.send(). None on a timeout.
+        """
+        try:
+            response = await self._open(prepared_request, self.decode_content)
+        except TimeoutError:
+            return None
+
+        try:
+            await response.aread()
+        except TimeoutError:
+            response.connection.abort()
+            return None
+        except BaseException:
+            response.connection.abort()
+            raise
+
+        return response
+
+    @asynccontextmanager
+    async def stream(
+        self, method: str, url: str, headers: dict | None = None, body: bytes | None = None
+    ) -> AsyncIterator[StreamingResponse]:
+        response = await self._open(self.prepare(method, url, headers, body), self.decode_content)
+        try:
+            yield response
+        finally:
+            await response.aclose()
+
+    async def request(
+        self, method: str, url: str, headers: dict | None = None, body: bytes | None = None
+    ) -> Response | None:
+        return await self.send(self.prepare(method, url, headers, body))
+
+    async def get(self, url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+        return await self.request("GET", url, headers, body)
+
+    async def post(self, url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+        return await self.request("POST", url, headers, body)
+
+    async def put(self, url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+        return await self.request("PUT", url, headers, body)
+
+    async def delete(self, url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+        return await self.request("DELETE", url, headers, body)
+
+    async def patch(self, url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+        return await self.request("PATCH", url, headers, body)
+
+    async def fetch_many(
+        self, requests: Iterable[FetchItem], concurrency: int = CONCURRENCY, return_exceptions: bool = False
+    ) -> AsyncIterator[tuple[FetchItem, Response | None | Exception]]:
+        """
+        (item, response) in the order the responses complete, with at most concurrency requests
+        in flight. See Session.fetch_many().
+        """
+        # 同じホストへの応答がまとめて返っても接続を捨てないよう、同時実行数までは待機させておく
+        with self.pool.idle_limit(concurrency):
+            items = iter(requests)
+            pending: dict[asyncio.Task, FetchItem] = {}
+            try:
+                for item in islice(items, concurrency):
+                    pending[asyncio.ensure_future(self._fetch(item))] = item
+
+                while pending:
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        item = pending.pop(task)
+                        for next_item in islice(items, 1):
+                            pending[asyncio.ensure_future(self._fetch(next_item))] = next_item
+
+                        try:
+                            result = task.result()
+                        except Exception as e:
+                            if not return_exceptions:
+                                raise
+                            result = e
+                        yield item, result
+            finally:
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _fetch(self, item: FetchItem) -> Response | None:
+        if isinstance(item, PreparedRequest):
+            return await self.send(item)
+        if isinstance(item, str):
+            return await self.request("GET", item)
+        return await self.request(*item)
+
+    async def _open(self, prepared_request: PreparedRequest, decode_content: bool) -> StreamingResponse:
+        host, port, is_ssl = prepared_request.host, prepared_request.port, prepared_request.is_ssl
+        message = prepared_request.message
+        request = Request(host, port, is_ssl, message)
+
+        if "Host" not in message.headers:
+            message.headers.add("Host", host)
+        # h11 はヘッダーのとおりにボディを区切るので、長さを合わせておく
+        if message.body and "Transfer-Encoding" not in message.headers:
+            message.headers["Content-Length"] = str(len(message.body))
+        elif not message.body and "Content-Length" in message.headers:
+            message.headers["Content-Length"] = "0"
+
+        while True:
+            connection, reused = await self.pool.acquire(host, port, is_ssl)
+            try:
+                request.request_time = time.time()
+                await connection.send_message(message)
+                response_message = await connection.recv_head()
+                break
+            except TimeoutError:
+                connection.abort()
+                raise
+            except (OSError, exceptions.NotHttp11ResponseMessageError, h11.RemoteProtocolError):
+                connection.abort()
+                # 使い回した接続がサーバー側で閉じられていた場合は、新しい接続でやり直す
+                if reused and message.method in IDEMPOTENT_METHODS:
+                    continue
+                raise
+            except BaseException:
+                connection.abort()
+                raise
+
+        def release(connection: AsyncConnection) -> None:
+            self.pool.release(connection, host, port, is_ssl)
+
+        return StreamingResponse(request, time.time(), response_message, connection, release, decode_content)
+
+    async def close(self) -> None:
+        await self.pool.close()
+
+
+async def asend(method: str, url: str, headers: dict | None = None, raw_body: bytes | None = None) -> Response | None:
+    async with AsyncSession(max_idle_per_host=0, dns_resolver=resolver.default_resolver) as session:
+        return await session.request(method, url, headers, raw_body)
+
+
+async def aget(url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+    return await asend("GET", url, headers, body)
+
+
+async def apost(url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+    return await asend("POST", url, headers, body)
+
+
+async def aput(url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+    return await asend("PUT", url, headers, body)
+
+
+async def adelete(url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+    return await asend("DELETE", url, headers, body)
+
+
+async def apatch(url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+    return await asend("PATCH", url, headers, body)
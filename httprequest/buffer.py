@@ -0,0 +1,241 @@
+import io
+import mmap
+import tempfile
+import threading
+from collections.abc import Iterator
+from typing import Any, BinaryIO
+
+# これを超えたボディは無名の一時ファイルに移す
+SPILL_THRESHOLD = 8 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# 予算が空くのを待つ秒数、過ぎたら一時ファイルに移す
+BUDGET_WAIT_TIMEOUT = 5.0
+
+
+class MemoryBudget:
+    """
+    Process-wide limit on the bytes Buffers hold in memory.
+
+    A Buffer that cannot get room blocks the thread writing to it, so that connection stops reading
+    and TCP flow control slows the sender down. After wait_timeout seconds the Buffer moves to its
+    temporary file instead, so buffers waiting on each other cannot deadlock.
+
+    What is charged: bodies received from servers and from clients (Tube), bodies of HTTP/2 streams,
+    decoded content, and bytes wrapped with Buffer.wrap(), which are charged with charge() since they
+    are already in memory. Headers, and the stored responses of cache.Cache, which has its own limit,
+    are not. Sending does not copy large bodies, so it adds nothing to charge.
+
+    used, peak and waiting are gauges for monitoring.
+    """
+
+    limit: int
+    wait_timeout: float
+    used: int
+    peak: int
+    waiting: int
+
+    def __init__(self, limit: int, wait_timeout: float = BUDGET_WAIT_TIMEOUT) -> None:
+        self.limit = limit
+        self.wait_timeout = wait_timeout
+        self.used = 0
+        self.peak = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size: int, blocking: bool = True) -> bool:
+        if size > self.limit:
+            return False
+
+        with self._cond:
+            if self.used + size > self.limit and blocking:
+                self.waiting += 1
+                try:
+                    self._cond.wait_for(lambda: self.used + size <= self.limit, self.wait_timeout)
+                finally:
+                    self.waiting -= 1
+
+            if self.used + size > self.limit:
+                return False
+
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def charge(self, size: int) -> None:
+        # 既にメモリにあるバイト列の分は待たずに数え、後から確保する側を待たせる
+        with self._cond:
+            self.used += size
+            self.peak = max(self.peak, self.used)
+
+    def release(self, size: int) -> None:
+        if not size:
+            return
+
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+
+default_spill_threshold: int | None = SPILL_THRESHOLD
+default_budget: MemoryBudget | None = None
+
+# spill_threshold を省略したことを表す (None は一時ファイルに移さない)
+DEFAULT: Any = object()
+
+
+class Buffer:
+    """
+    Bytes that move to an anonymous temporary file once they grow past spill_threshold.
+
+    A spilled buffer is read back through mmap, so its content lives in the page cache
+    instead of the heap, and it can be written to a socket with sendfile().
+
+    >>> buffer = Buffer(spill_threshold=1024)
+    >>> buffer.write(b"x" * 4096)
+    >>> buffer.is_spilled()
+    True
+    >>> buffer.getbuffer()[:4].tobytes()
+    b'xxxx'
+
+    spill_threshold defaults to default_spill_threshold; None turns off spilling on size.
+
+    Bytes written while in memory are charged to default_budget when one is set.
+    With blocking=False a Buffer that cannot get room spills at once instead of waiting.
+    """
+
+    spill_threshold: int | None
+    blocking: bool
+    _chunks: list[bytes]
+    _file: BinaryIO | None
+    _mmap: mmap.mmap | None
+    _budget: MemoryBudget | None
+    _charged: int
+
+    def __init__(self, data: bytes = b"", spill_threshold: int | None = DEFAULT, blocking: bool = True) -> None:
+        self.spill_threshold = default_spill_threshold if spill_threshold is DEFAULT else spill_threshold
+        self.blocking = blocking
+        self._chunks = []
+        self._size = 0
+        self._file = None
+        self._mmap = None
+        self._budget = default_budget
+        self._charged = 0
+
+        if data:
+            self.write(data)
+
+    def __del__(self) -> None:
+        self._release()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __bytes__(self) -> bytes:
+        if self._file is None:
+            return self._join()
+        return self.getbuffer().tobytes()
+
+    def write(self, data: bytes) -> None:
+        if not data:
+            return
+
+        self._size += len(data)
+        if self._file is not None:
+            # 読み出した後に追記された場合は mmap を作り直す
+            self._mmap = None
+            self._file.seek(0, io.SEEK_END)
+            self._file.write(data)
+            return
+
+        self._chunks.append(data)
+        if self.spill_threshold is not None and self._size > self.spill_threshold:
+            self._spill()
+            return
+
+        # 予算が空かなければメモリを使わずに一時ファイルへ移す
+        if self._budget:
+            if not self._budget.acquire(len(data), self.blocking):
+                self._spill()
+                return
+            self._charged += len(data)
+
+    def is_spilled(self) -> bool:
+        return self._file is not None
+
+    def get_file(self) -> BinaryIO | None:
+        """
+        The temporary file of a spilled buffer, for socket.sendfile().
+        """
+        if self._file is not None:
+            self._file.flush()
+        return self._file
+
+    def getbuffer(self) -> memoryview:
+        if self._file is None:
+            return memoryview(self._join())
+
+        if not self._size:
+            return memoryview(b"")
+        if self._mmap is None:
+            self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(), self._size, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)
+
+    def open(self) -> BinaryIO:
+        """
+        A read-only stream over the content. A spilled buffer is not copied into memory.
+        """
+        if self._file is None or not self._size:
+            return io.BytesIO(self._join())
+
+        self._file.flush()
+        # 呼び出しごとに別の mmap を作り、読み出し位置を共有しない
+        return mmap.mmap(self._file.fileno(), self._size, access=mmap.ACCESS_READ)  # type: ignore[return-value]
+
+    def iter_chunks(self, size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        view = self.getbuffer()
+        for i in range(0, len(view), size):
+            yield view[i : i + size].tobytes()
+
+    @classmethod
+    def wrap(cls, data: bytes, charge: bool = True) -> "Buffer":
+        """
+        Wrap bytes that are already in memory without copying or spilling them.
+        They are charged to default_budget unless charge is False.
+        """
+        buffer = cls()
+        if data:
+            data = bytes(data)
+            buffer._chunks = [data]
+            buffer._size = len(data)
+            if charge and buffer._budget:
+                buffer._budget.charge(len(data))
+                buffer._charged = len(data)
+        return buffer
+
+    def close(self) -> None:
+        self._release()
+        self._chunks = []
+        self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._size = 0
+
+    def _join(self) -> bytes:
+        # 1 つにまとめておけば bytes() はコピーせずに同じオブジェクトを返す
+        if len(self._chunks) > 1:
+            self._chunks = [b"".join(self._chunks)]
+        return self._chunks[0] if self._chunks else b""
+
+    def _spill(self) -> None:
+        self._file = tempfile.TemporaryFile()
+        for chunk in self._chunks:
+            self._file.write(chunk)
+        self._chunks = []
+        self._release()
+
+    def _release(self) -> None:
+        if self._budget and self._charged:
+            self._budget.release(self._charged)
+        self._charged = 0
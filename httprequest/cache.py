@@ -0,0 +1,711 @@
+import email.utils
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from datetime import timezone
+
+from .buffer import CHUNK_SIZE, Buffer
+from .http import Headers, PreparedRequest, Request, RequestMessage, Response, ResponseBody, ResponseMessage
+
+MAX_MEMORY_SIZE = 64 * 1024 * 1024
+MAX_DISK_SIZE = 1024 * 1024 * 1024
+# これより大きいボディはディスクに置く
+DISK_THRESHOLD = 1024 * 1024
+MAX_OBJECT_SIZE = 256 * 1024 * 1024
+# 同じリクエストが同時に来た場合に先行するフェッチを待つ秒数
+COLLAPSE_TIMEOUT = 10.0
+# 保存できなかったキーはしばらくまとめずにそのまま送る
+PASS_TTL = 120.0
+PASS_MAX_ENTRIES = 4096
+
+# RFC 9111 Section 4.2.2. Calculating Heuristic Freshness
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX_LIFETIME = 24 * 60 * 60
+
+# RFC 9110 Section 15.1. Overview of Status Codes (heuristically cacheable)
+HEURISTICALLY_CACHEABLE_STATUS = ("200", "203", "204", "300", "301", "308", "404", "405", "410", "414", "501")
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE")
+
+# 保存しない / 304 で上書きしないフィールド
+HOP_BY_HOP_HEADERS = ("Connection", "Keep-Alive", "Proxy-Connection", "Proxy-Authenticate", "Te", "Trailer", "Upgrade")
+NOT_UPDATED_HEADERS = ("Content-Length", "Content-Encoding", "Transfer-Encoding")
+
+# RFC 9110 Section 15.4.5. 304 Not Modified
+NOT_MODIFIED_HEADERS = ("Cache-Control", "Content-Location", "Date", "Etag", "Expires", "Vary")
+
+HIT = "hit"
+MISS = "miss"
+REVALIDATED = "revalidated"
+COLLAPSED = "collapsed"
+BYPASS = "bypass"
+
+
+def parse_cache_control(headers: Headers) -> dict[str, str | None]:
+    """
+    RFC 9111: HTTP Caching
+                Section 5.2. Cache-Control
+    https://datatracker.ietf.org/doc/html/rfc9111#section-5.2
+
+    >>> parse_cache_control(Headers({"Cache-Control": 'max-age=60, no-cache="Set-Cookie", public'}))
+    {'max-age': '60', 'no-cache': 'Set-Cookie', 'public': None}
+    """
+    directives: dict[str, str | None] = {}
+    if "Cache-Control" in headers:
+        for directive in headers.get_as_list("Cache-Control"):
+            name, sep, value = directive.partition("=")
+            name = name.strip().lower()
+            if name:
+                directives[name] = value.strip().strip('"') if sep else None
+    elif "Pragma" in headers and "no-cache" in (x.lower() for x in headers.get_as_list("Pragma")):
+        # RFC 9111 Section 5.4. Cache-Control が無い場合だけ Pragma: no-cache を見る
+        directives["no-cache"] = None
+
+    return directives
+
+
+def parse_http_date(value: str) -> float | None:
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+def parse_delta_seconds(value: str | None) -> int | None:
+    try:
+        return max(int(value or ""), 0)
+    except ValueError:
+        return None
+
+
+def get_cache_key(host: str, port: int, is_ssl: bool, request_target: str) -> str:
+    # 絶対形式 (http プロキシ) と origin 形式 (https) のどちらでも同じキーになるようにする
+    u = urllib.parse.urlsplit(request_target)
+    path = u.path or "/"
+    if u.query:
+        path += "?" + u.query
+
+    scheme = "https" if is_ssl else "http"
+    return f"{scheme}://{host.lower()}:{port}{path}"
+
+
+def get_vary_values(names: tuple[str, ...], headers: Headers) -> tuple[str | None, ...]:
+    """
+    RFC 9111 Section 4.1. Calculating Cache Keys with the Vary Header Field
+    """
+    return tuple(", ".join(headers.get_as_list(name)) if name in headers else None for name in names)
+
+
+class CachedResponse:
+    """
+    One stored response. The header block is kept in memory;
+    the body is kept in a Buffer too, or on disk when path is set.
+    """
+
+    key: str
+    vary: tuple[str | None, ...]
+    raw_header: bytes
+    body: Buffer | None
+    body_size: int
+    request_time: float
+    response_time: float
+    path: str | None
+
+    def __init__(
+        self,
+        key: str,
+        vary: tuple[str | None, ...],
+        raw_header: bytes,
+        body: Buffer | None,
+        body_size: int,
+        request_time: float,
+        response_time: float,
+        path: str | None = None,
+    ) -> None:
+        self.key = key
+        self.vary = vary
+        self.raw_header = raw_header
+        self.body = body
+        self.body_size = body_size
+        self.request_time = request_time
+        self.response_time = response_time
+        self.path = path
+
+        message = ResponseMessage(raw_header)
+        self.status_code = message.status_code
+        self.headers = message.headers
+        self.directives = parse_cache_control(self.headers)
+
+    @property
+    def size(self) -> int:
+        return len(self.raw_header) + self.body_size
+
+    def get_vary_names(self) -> tuple[str, ...]:
+        if "Vary" not in self.headers:
+            return ()
+        return tuple(sorted(x.lower() for x in self.headers.get_as_list("Vary") if x))
+
+    def get_date(self) -> float:
+        date = parse_http_date(self.headers["Date"]) if "Date" in self.headers else None
+        return date if date is not None else self.response_time
+
+    def get_freshness_lifetime(self) -> float:
+        """
+        RFC 9111 Section 4.2.1. Calculating Freshness Lifetime
+        """
+        for name in ("s-maxage", "max-age"):
+            if name in self.directives:
+                seconds = parse_delta_seconds(self.directives[name])
+                return seconds if seconds is not None else 0
+
+        if "Expires" in self.headers:
+            expires = parse_http_date(self.headers["Expires"])
+            # 不正な Expires は期限切れとして扱う
+            return max(expires - self.get_date(), 0) if expires is not None else 0
+
+        if "Last-Modified" in self.headers and (
+            self.status_code in HEURISTICALLY_CACHEABLE_STATUS or "public" in self.directives
+        ):
+            last_modified = parse_http_date(self.headers["Last-Modified"])
+            if last_modified is not None:
+                lifetime = (self.get_date() - last_modified) * HEURISTIC_FRACTION
+                return min(max(lifetime, 0), HEURISTIC_MAX_LIFETIME)
+
+        return 0
+
+    def get_current_age(self, now: float) -> float:
+        """
+        RFC 9111 Section 4.2.3. Calculating Age
+        """
+        age_value = 0
+        if "Age" in self.headers:
+            age_value = parse_delta_seconds(self.headers["Age"]) or 0
+
+        apparent_age = max(0, self.response_time - self.get_date())
+        response_delay = self.response_time - self.request_time
+        corrected_initial_age = max(apparent_age, age_value + response_delay)
+        resident_time = now - self.response_time
+
+        return corrected_initial_age + resident_time
+
+    def has_validator(self) -> bool:
+        return "ETag" in self.headers or "Last-Modified" in self.headers
+
+    def to_meta(self) -> dict:
+        return {
+            "key": self.key,
+            "vary": list(self.vary),
+            "header_size": len(self.raw_header),
+            "request_time": self.request_time,
+            "response_time": self.response_time,
+        }
+
+
+class Cache:
+    """
+    RFC 9111: HTTP Caching
+    https://datatracker.ietf.org/doc/html/rfc9111
+
+    A shared cache in front of PreparedRequest.send().
+    Small bodies are kept in a memory LRU bounded by bytes, bodies over disk_threshold in disk_path.
+    Stale responses with a validator are revalidated with If-None-Match / If-Modified-Since,
+    and conditional requests from the client are answered with 304 locally.
+
+    Concurrent misses for the same GET are collapsed: the first request fetches from the origin
+    and the others wait up to collapse_timeout seconds, then are served from the stored response.
+    Keys whose responses could not be stored are passed through without waiting for PASS_TTL seconds.
+
+    >>> cache = Cache(disk_path="/var/cache/proxy")
+    >>> response = cache.send(prepared_request)
+    >>> response.cache_status
+    'hit'
+    """
+
+    def __init__(
+        self,
+        max_memory_size: int = MAX_MEMORY_SIZE,
+        disk_path: str | None = None,
+        max_disk_size: int = MAX_DISK_SIZE,
+        disk_threshold: int = DISK_THRESHOLD,
+        max_object_size: int = MAX_OBJECT_SIZE,
+        collapse_timeout: float | None = COLLAPSE_TIMEOUT,
+    ) -> None:
+        self.max_memory_size = max_memory_size
+        self.disk_path = disk_path
+        self.max_disk_size = max_disk_size
+        self.disk_threshold = disk_threshold
+        self.max_object_size = max_object_size
+        self.collapse_timeout = collapse_timeout
+
+        self.memory_size = 0
+        self.disk_size = 0
+        self._memory: OrderedDict[tuple, CachedResponse] = OrderedDict()
+        self._disk: OrderedDict[tuple, CachedResponse] = OrderedDict()
+        # キーごとの Vary に挙げられたフィールド名
+        self._vary: dict[str, tuple[str, ...]] = {}
+        # 実行中のフェッチと、まとめないキーの期限
+        self._flights: dict[tuple, threading.Event] = {}
+        self._pass: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+        if self.disk_path:
+            os.makedirs(self.disk_path, exist_ok=True)
+            self._load_disk()
+
+    def send(
+        self,
+        prepared_request: PreparedRequest,
+        decode_chunked: bool = True,
+        decode_content: bool = False,
+        use_http2: bool = False,
+    ) -> Response | None:
+        host, port, is_ssl = prepared_request.host, prepared_request.port, prepared_request.is_ssl
+        message = prepared_request.message
+        key = get_cache_key(host, port, is_ssl, message.request_target)
+        directives = parse_cache_control(message.headers)
+
+        if message.method not in ("GET", "HEAD") or "no-store" in directives or "Range" in message.headers:
+            response = prepared_request.send(decode_chunked, decode_content, use_http2)
+            # RFC 9111 Section 4.4. Invalidating Stored Responses
+            if response and message.method not in SAFE_METHODS and response.message.status_code[:1] in ("2", "3"):
+                self.invalidate(key)
+            if response:
+                response.cache_status = BYPASS
+            return response
+
+        now = time.time()
+        stored = self.lookup(key, message.headers)
+        if stored and self.is_usable(stored, directives, now):
+            response = self._serve(prepared_request, stored, HIT, decode_content)
+            if response:
+                return response
+            # ディスクから消えていた場合はオリジンに取りに行く
+            stored = None
+
+        if "only-if-cached" in directives:
+            return self._gateway_timeout(prepared_request)
+
+        if message.method != "GET" or not self.collapse_timeout:
+            return self._fetch(prepared_request, key, stored, decode_chunked, decode_content, use_http2)
+
+        with self._lock:
+            flight_key = (key, get_vary_values(self._vary.get(key, ()), message.headers))
+            flight = self._flights.get(flight_key)
+            is_pass = self._pass.get(key, 0) > now
+            if not flight and not is_pass:
+                leader = self._flights[flight_key] = threading.Event()
+
+        if is_pass:
+            return self._fetch(prepared_request, key, stored, decode_chunked, decode_content, use_http2)
+
+        if not flight:
+            try:
+                response = self._fetch(prepared_request, key, stored, decode_chunked, decode_content, use_http2)
+                stored = self.lookup(key, message.headers)
+                if response and (not stored or stored.response_time < now):
+                    self._mark_pass(key)
+                return response
+            finally:
+                with self._lock:
+                    self._flights.pop(flight_key, None)
+                leader.set()
+
+        # 先行するフェッチの結果を保存済みのレスポンスから返す
+        if flight.wait(self.collapse_timeout):
+            stored = self.lookup(key, message.headers)
+            if stored and stored.response_time >= now:
+                response = self._serve(prepared_request, stored, COLLAPSED, decode_content)
+                if response:
+                    return response
+
+        stored = self.lookup(key, message.headers)
+        return self._fetch(prepared_request, key, stored, decode_chunked, decode_content, use_http2)
+
+    def _fetch(
+        self,
+        prepared_request: PreparedRequest,
+        key: str,
+        stored: CachedResponse | None,
+        decode_chunked: bool,
+        decode_content: bool,
+        use_http2: bool,
+    ) -> Response | None:
+        host, port, is_ssl = prepared_request.host, prepared_request.port, prepared_request.is_ssl
+        message = prepared_request.message
+
+        # 期限切れでもバリデータがあれば条件付きリクエストで確認する
+        if stored and stored.has_validator():
+            conditional = RequestMessage(bytes(message))
+            for name in ("If-None-Match", "If-Modified-Since", "If-Match", "If-Unmodified-Since"):
+                if name in conditional.headers:
+                    del conditional.headers[name]
+            if "ETag" in stored.headers:
+                conditional.headers["If-None-Match"] = stored.headers["ETag"]
+            if "Last-Modified" in stored.headers:
+                conditional.headers["If-Modified-Since"] = stored.headers["Last-Modified"]
+            request = PreparedRequest(host, port, is_ssl, conditional)
+        else:
+            request = prepared_request
+
+        response = request.send(decode_chunked, decode_content, use_http2)
+        if not response:
+            return None
+
+        if stored and response.message.status_code == "304":
+            stored = self._update(stored, response)
+            revalidated = self._serve(prepared_request, stored, REVALIDATED, decode_content)
+            if revalidated:
+                return revalidated
+            response = prepared_request.send(decode_chunked, decode_content, use_http2)
+            if not response:
+                return None
+
+        if message.method == "GET":
+            self.store(key, message.headers, response)
+        response.cache_status = MISS
+        return response
+
+    def _mark_pass(self, key: str) -> None:
+        with self._lock:
+            self._pass[key] = time.time() + PASS_TTL
+            self._pass.move_to_end(key)
+            while len(self._pass) > PASS_MAX_ENTRIES:
+                self._pass.popitem(last=False)
+
+    def lookup(self, key: str, headers: Headers) -> CachedResponse | None:
+        with self._lock:
+            if key not in self._vary:
+                return None
+            entry_key = (key, get_vary_values(self._vary[key], headers))
+
+            for tier in (self._memory, self._disk):
+                stored = tier.get(entry_key)
+                if stored:
+                    tier.move_to_end(entry_key)
+                    return stored
+
+        return None
+
+    def is_usable(self, stored: CachedResponse, directives: dict[str, str | None], now: float) -> bool:
+        """
+        RFC 9111 Section 4.2. Freshness
+                 Section 5.2.1. Request Directives
+        """
+        if "no-cache" in stored.directives or "no-cache" in directives:
+            return False
+
+        lifetime = stored.get_freshness_lifetime()
+        age = stored.get_current_age(now)
+
+        if "max-age" in directives:
+            max_age = parse_delta_seconds(directives["max-age"])
+            if max_age is not None and age > max_age:
+                return False
+
+        if "min-fresh" in directives:
+            min_fresh = parse_delta_seconds(directives["min-fresh"]) or 0
+            return lifetime - age >= min_fresh
+
+        if age < lifetime:
+            return True
+
+        # must-revalidate が付いたレスポンスは max-stale でも返さない
+        if "max-stale" in directives and not (
+            "must-revalidate" in stored.directives or "proxy-revalidate" in stored.directives
+        ):
+            max_stale = parse_delta_seconds(directives["max-stale"])
+            return max_stale is None or age - lifetime <= max_stale
+
+        return False
+
+    def is_storable(self, request_headers: Headers, response: Response) -> bool:
+        """
+        RFC 9111 Section 3. Storing Responses in Caches
+        """
+        message = response.message
+        directives = parse_cache_control(message.headers)
+
+        if "no-store" in directives or "private" in directives:
+            return False
+        if message.status_code[:1] == "1" or message.status_code in ("206", "304"):
+            return False
+        if message.is_chunked() or "Content-Range" in message.headers:
+            return False
+        if "Vary" in message.headers and "*" in message.headers.get_as_list("Vary"):
+            return False
+        # 共有キャッシュなので Set-Cookie 付きのレスポンスを他のクライアントに返さない
+        if "Set-Cookie" in message.headers:
+            return False
+        # RFC 9111 Section 3.5. Storing Responses to Authenticated Requests
+        if "Authorization" in request_headers and not (
+            "public" in directives or "must-revalidate" in directives or "s-maxage" in directives
+        ):
+            return False
+
+        return (
+            "max-age" in directives
+            or "s-maxage" in directives
+            or "public" in directives
+            or "Expires" in message.headers
+            or message.status_code in HEURISTICALLY_CACHEABLE_STATUS
+        )
+
+    def store(self, key: str, request_headers: Headers, response: Response) -> None:
+        if not self.is_storable(request_headers, response):
+            return
+
+        message = response.message
+        headers = Headers()
+        for name in message.headers:
+            if name not in HOP_BY_HOP_HEADERS:
+                headers[name] = message.headers.get_as_list(name)
+
+        # フックが後から書き換えても影響しないよう、この時点のバイト列を保存する
+        raw_header = message.get_status_line().encode("utf-8") + bytes(headers) + b"\r\n"
+        body = message.body.get_encoded_buffer()
+        if len(body) > self.max_object_size:
+            return
+
+        request_time = response.request.request_time or response.response_time
+        stored = CachedResponse(key, (), raw_header, body, len(body), request_time, response.response_time)
+        stored.vary = get_vary_values(stored.get_vary_names(), request_headers)
+        self._put(stored)
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._vary.pop(key, None)
+            for entry_key in [x for x in self._memory if x[0] == key]:
+                self._remove(entry_key)
+            for entry_key in [x for x in self._disk if x[0] == key]:
+                self._remove(entry_key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._vary.clear()
+            for entry_key in list(self._memory) + list(self._disk):
+                self._remove(entry_key)
+
+    def _put(self, stored: CachedResponse) -> None:
+        use_disk = self.disk_path and stored.body_size > self.disk_threshold
+        if use_disk:
+            if stored.size > self.max_disk_size:
+                return
+            self._write_disk(stored)
+        elif stored.size > self.max_memory_size:
+            return
+        elif stored.body and not stored.body.is_spilled():
+            # キャッシュの分は max_memory_size で抑えるので、受信中のメモリの予算からは外す
+            stored.body = Buffer.wrap(bytes(stored.body), charge=False)
+
+        entry_key = (stored.key, stored.vary)
+        with self._lock:
+            names = stored.get_vary_names()
+            # Vary が変わった場合は古い変種を捨てる
+            if self._vary.get(stored.key, names) != names:
+                for old_key in [x for x in list(self._memory) + list(self._disk) if x[0] == stored.key]:
+                    self._remove(old_key)
+            self._vary[stored.key] = names
+            self._pass.pop(stored.key, None)
+
+            if entry_key in self._memory or entry_key in self._disk:
+                # 同じファイルに書き直した場合は消さない
+                old = self._memory.get(entry_key) or self._disk.get(entry_key)
+                self._remove(entry_key, delete_file=old is not None and old.path != stored.path)
+
+            if use_disk:
+                self._disk[entry_key] = stored
+                self.disk_size += stored.size
+                while self.disk_size > self.max_disk_size:
+                    self._remove(next(iter(self._disk)))
+            else:
+                self._memory[entry_key] = stored
+                self.memory_size += stored.size
+                while self.memory_size > self.max_memory_size:
+                    self._remove(next(iter(self._memory)))
+
+    def _remove(self, entry_key: tuple, delete_file: bool = True) -> None:
+        # self._lock を持った状態で呼ぶ
+        stored = self._memory.pop(entry_key, None)
+        if stored:
+            self.memory_size -= stored.size
+            return
+
+        stored = self._disk.pop(entry_key, None)
+        if stored:
+            self.disk_size -= stored.size
+            if not delete_file:
+                return
+            try:
+                os.remove(stored.path or "")
+            except OSError:
+                pass
+
+    def _update(self, stored: CachedResponse, response: Response) -> CachedResponse:
+        """
+        RFC 9111 Section 3.2. Updating Stored Header Fields
+        """
+        message = ResponseMessage(stored.raw_header)
+        for name in response.message.headers:
+            if name in HOP_BY_HOP_HEADERS or name in NOT_UPDATED_HEADERS:
+                continue
+            message.headers[name] = response.message.headers.get_as_list(name)
+        raw_header = message.get_status_line().encode("utf-8") + bytes(message.headers) + b"\r\n"
+
+        request_time = response.request.request_time or response.response_time
+        updated = CachedResponse(
+            stored.key, stored.vary, raw_header, stored.body, stored.body_size, request_time, response.response_time
+        )
+        if stored.path:
+            updated.body = self._read_body(stored)
+            if updated.body is None:
+                return stored
+        self._put(updated)
+
+        return updated
+
+    def _serve(
+        self, prepared_request: PreparedRequest, stored: CachedResponse, cache_status: str, decode_content: bool
+    ) -> Response | None:
+        body = stored.body if stored.path is None else self._read_body(stored)
+        if body is None:
+            with self._lock:
+                self._remove((stored.key, stored.vary))
+            return None
+
+        now = time.time()
+        message = ResponseMessage(stored.raw_header)
+        message.body = ResponseBody(body)
+        message.headers["Age"] = str(int(stored.get_current_age(now)))
+
+        request_message = prepared_request.message
+        if self._is_not_modified(request_message.headers, stored):
+            message = self._not_modified(message)
+        elif request_message.method == "HEAD":
+            message.body.set_body(b"")
+        else:
+            message.set_content_encoding(decode_content)
+
+        request = Request(prepared_request.host, prepared_request.port, prepared_request.is_ssl, request_message)
+        request.request_time = now
+        response = Response(request, now, message)
+        response.cache_status = cache_status
+
+        return response
+
+    def _is_not_modified(self, headers: Headers, stored: CachedResponse) -> bool:
+        """
+        RFC 9110 Section 13.2.2. Precedence of Preconditions
+        """
+        if "If-None-Match" in headers:
+            if "ETag" not in stored.headers:
+                return False
+            # 弱い比較
+            etag = stored.headers["ETag"].removeprefix("W/")
+            return any(x == "*" or x.removeprefix("W/") == etag for x in headers.get_as_list("If-None-Match"))
+
+        if "If-Modified-Since" in headers and "Last-Modified" in stored.headers:
+            since = parse_http_date(headers["If-Modified-Since"])
+            last_modified = parse_http_date(stored.headers["Last-Modified"])
+            return since is not None and last_modified is not None and last_modified <= since
+
+        return False
+
+    def _not_modified(self, message: ResponseMessage) -> ResponseMessage:
+        headers = Headers()
+        for name in NOT_MODIFIED_HEADERS + ("Age",):
+            if name in message.headers:
+                headers[name] = message.headers.get_as_list(name)
+
+        status_line = f"{message.http_version} 304 Not Modified\r\n"
+        return ResponseMessage(status_line.encode("utf-8") + bytes(headers) + b"\r\n")
+
+    def _gateway_timeout(self, prepared_request: PreparedRequest) -> Response:
+        # RFC 9111 Section 5.2.1.7. only-if-cached
+        now = time.time()
+        message = ResponseMessage(b"HTTP/1.1 504 Gateway Timeout\r\nContent-Length: 0\r\n\r\n")
+        request = Request(
+            prepared_request.host, prepared_request.port, prepared_request.is_ssl, prepared_request.message
+        )
+        request.request_time = now
+        response = Response(request, now, message)
+        response.cache_status = MISS
+
+        return response
+
+    def _get_path(self, stored: CachedResponse) -> str:
+        name = hashlib.sha256(json.dumps([stored.key, list(stored.vary)]).encode("utf-8")).hexdigest()
+        return os.path.join(self.disk_path or "", name)
+
+    def _write_disk(self, stored: CachedResponse) -> None:
+        """
+        One file per response: a JSON metadata line, the header block and the body.
+        """
+        path = self._get_path(stored)
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_path)
+        with os.fdopen(fd, "wb") as f:
+            f.write(json.dumps(stored.to_meta()).encode("utf-8") + b"\n")
+            f.write(stored.raw_header)
+            for chunk in stored.body.iter_chunks() if stored.body else ():
+                f.write(chunk)
+        os.replace(tmp_path, path)
+
+        stored.path = path
+        stored.body = None
+
+    def _read_body(self, stored: CachedResponse) -> Buffer | None:
+        body = Buffer()
+        try:
+            with open(stored.path or "", "rb") as f:
+                f.readline()
+                f.seek(len(stored.raw_header), os.SEEK_CUR)
+                while chunk := f.read(CHUNK_SIZE):
+                    body.write(chunk)
+        except OSError:
+            return None
+
+        return body
+
+    def _load_disk(self) -> None:
+        # 再起動前に保存したレスポンスを古い順に読み込む
+        paths = [os.path.join(self.disk_path or "", x) for x in os.listdir(self.disk_path or "")]
+        paths = sorted((x for x in paths if os.path.isfile(x)), key=os.path.getmtime)
+
+        for path in paths:
+            try:
+                with open(path, "rb") as f:
+                    line = f.readline()
+                    meta = json.loads(line)
+                    raw_header = f.read(meta["header_size"])
+                body_size = os.path.getsize(path) - len(line) - len(raw_header)
+                stored = CachedResponse(
+                    meta["key"],
+                    tuple(meta["vary"]),
+                    raw_header,
+                    None,
+                    body_size,
+                    meta["request_time"],
+                    meta["response_time"],
+                    path,
+                )
+            except (OSError, ValueError, KeyError, TypeError):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+
+            entry_key = (stored.key, stored.vary)
+            self._vary[stored.key] = stored.get_vary_names()
+            self._disk[entry_key] = stored
+            self.disk_size += stored.size
+
+        while self.disk_size > self.max_disk_size:
+            self._remove(next(iter(self._disk)))
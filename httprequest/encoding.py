@@ -1,37 +1,361 @@
 import gzip
 import zlib
-from io import BytesIO
+from collections.abc import Iterable, Iterator
 
 import brotli
 
+from . import exceptions
 
-def decode(content: bytes, encoding: str) -> bytes:
-    decoders = {"gzip": decode_gzip, "deflate": decode_deflate, "br": decode_brotli}
+CHUNK_SIZE = 64 * 1024
+MAX_DECODED_SIZE = 256 * 1024 * 1024
+MAX_DECODE_RATIO = 1000
+# 小さいボディは圧縮率が極端になりやすいので、この出力サイズを超えるまで比率は確認しない
+RATIO_CHECK_THRESHOLD = 1024 * 1024
 
-    if encoding in decoders:
-        content = decoders[encoding](content)
 
-    return content
+class DecodeLimits:
+    max_size: int | None
+    max_ratio: float | None
 
+    def __init__(self, max_size: int | None = MAX_DECODED_SIZE, max_ratio: float | None = MAX_DECODE_RATIO) -> None:
+        self.max_size = max_size
+        self.max_ratio = max_ratio
 
-def decode_gzip(content: bytes) -> bytes:
-    if not content:
+
+default_limits = DecodeLimits()
+
+
+class Decoder:
+    """
+    RFC 9110: HTTP Semantics
+                Section 8.4. Content-Encoding
+    https://datatracker.ietf.org/doc/html/rfc9110#section-8.4
+
+    Common interface of the streaming content decoders.
+    decompress() and flush() return the decoded chunks, each of about CHUNK_SIZE bytes.
+
+    >>> decoder = get_decoder("gzip, br")
+    >>> chunks = decoder.decompress(content)
+    >>> chunks += decoder.flush()
+    """
+
+    limits: DecodeLimits
+    total_in: int
+    total_out: int
+
+    def __init__(self, limits: DecodeLimits | None = None) -> None:
+        self.limits = limits or default_limits
+        self.total_in = 0
+        self.total_out = 0
+
+    def decompress(self, data: bytes) -> list[bytes]:
+        self.total_in += len(data)
+        return list(self._check(self._decompress(data)))
+
+    def flush(self) -> list[bytes]:
+        return list(self._check(self._flush()))
+
+    def _check(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        max_size = self.limits.max_size
+        max_ratio = self.limits.max_ratio
+
+        for chunk in chunks:
+            self.total_out += len(chunk)
+            if max_size is not None and self.total_out > max_size:
+                raise exceptions.DecompressionLimitError
+            if (
+                max_ratio is not None
+                and self.total_out > RATIO_CHECK_THRESHOLD
+                and self.total_out > self.total_in * max_ratio
+            ):
+                raise exceptions.DecompressionLimitError
+            yield chunk
+
+    def _decompress(self, data: bytes) -> Iterator[bytes]:
+        yield data
+
+    def _flush(self) -> Iterator[bytes]:
+        yield from ()
+
+
+class IdentityDecoder(Decoder):
+    pass
+
+
+class ZlibDecoder(Decoder):
+    wbits: int = zlib.MAX_WBITS
+
+    def __init__(self, limits: DecodeLimits | None = None) -> None:
+        super().__init__(limits)
+        self._decompressor = zlib.decompressobj(self.wbits)
+
+    def _decompress(self, data: bytes) -> Iterator[bytes]:
+        while data and not self._decompressor.eof:
+            chunk = self._decompressor.decompress(data, CHUNK_SIZE)
+            if chunk:
+                yield chunk
+            data = self._decompressor.unconsumed_tail
+
+    def _flush(self) -> Iterator[bytes]:
+        chunk = self._decompressor.flush()
+        if chunk:
+            yield chunk
+
+
+class GzipDecoder(ZlibDecoder):
+    wbits = 16 + zlib.MAX_WBITS
+
+    def _decompress(self, data: bytes) -> Iterator[bytes]:
+        # 複数メンバーの gzip は続きを新しい decompressobj で処理する
+        # 次のメンバーは後の呼び出しで届くこともある
+        while data:
+            if self._decompressor.eof:
+                # メンバーの後ろのゼロ埋めは読み飛ばす (gzip._GzipReader と同じ)
+                data = data.lstrip(b"\0")
+                if not data:
+                    break
+                self._decompressor = zlib.decompressobj(self.wbits)
+            yield from super()._decompress(data)
+            data = self._decompressor.unused_data if self._decompressor.eof else b""
+
+
+class DeflateDecoder(ZlibDecoder):
+    _detected: bool = False
+
+    def _decompress(self, data: bytes) -> Iterator[bytes]:
+        # zlib ヘッダーのない raw deflate を送ってくるサーバーがある
+        if not self._detected and data:
+            self._detected = True
+            try:
+                chunk = self._decompressor.decompress(data, CHUNK_SIZE)
+            except zlib.error:
+                self.wbits = -zlib.MAX_WBITS
+                self._decompressor = zlib.decompressobj(self.wbits)
+            else:
+                if chunk:
+                    yield chunk
+                data = self._decompressor.unconsumed_tail
+
+        yield from super()._decompress(data)
+
+
+class BrotliDecoder(Decoder):
+    def __init__(self, limits: DecodeLimits | None = None) -> None:
+        super().__init__(limits)
+        self._decompressor = brotli.Decompressor()
+
+    def _decompress(self, data: bytes) -> Iterator[bytes]:
+        if not hasattr(self._decompressor, "can_accept_more_data"):
+            # output_buffer_limit に対応していない古い brotli
+            chunk = self._decompressor.process(data)
+            if chunk:
+                yield chunk
+            return
+
+        # 出力が途中で止まった場合は空の入力で続きを取り出す
+        chunk = self._decompressor.process(data, output_buffer_limit=CHUNK_SIZE)
+        while chunk:
+            yield chunk
+            if self._decompressor.is_finished():
+                break
+            chunk = self._decompressor.process(b"", output_buffer_limit=CHUNK_SIZE)
+
+
+class MultiDecoder(Decoder):
+    """
+    Content-Encoding: gzip, br
+
+    The codings are listed in the order they were applied, so they are decoded in reverse.
+    """
+
+    decoders: list[Decoder]
+
+    def __init__(self, decoders: list[Decoder], limits: DecodeLimits | None = None) -> None:
+        super().__init__(limits)
+        self.decoders = decoders
+
+    def _decompress(self, data: bytes) -> Iterator[bytes]:
+        return self._pipe(0, [data])
+
+    def _flush(self) -> Iterator[bytes]:
+        for i, decoder in enumerate(self.decoders):
+            yield from self._pipe(i + 1, decoder.flush())
+
+    def _pipe(self, index: int, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        if index == len(self.decoders):
+            yield from chunks
+            return
+
+        decoder = self.decoders[index]
+        for chunk in chunks:
+            yield from self._pipe(index + 1, decoder._decompress(chunk))
+
+
+DECODERS: dict[str, type[Decoder]] = {
+    "gzip": GzipDecoder,
+    "x-gzip": GzipDecoder,
+    "deflate": DeflateDecoder,
+    "br": BrotliDecoder,
+    "identity": IdentityDecoder,
+}
+
+
+class Encoder:
+    """
+    Common interface of the streaming content encoders.
+
+    >>> encoder = get_encoder("gzip", level=6)
+    >>> raw_body = encoder.compress(content) + encoder.flush()
+    """
+
+    def __init__(self, level: int | None = None) -> None:
+        pass
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
         return b""
-    gfile = gzip.GzipFile(fileobj=BytesIO(content))
-    return gfile.read()
 
 
-def decode_deflate(content: bytes) -> bytes:
+class IdentityEncoder(Encoder):
+    pass
+
+
+class GzipEncoder(Encoder):
+    wbits: int = 16 + zlib.MAX_WBITS
+
+    def __init__(self, level: int | None = None) -> None:
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, self.wbits)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+
+class DeflateEncoder(GzipEncoder):
+    wbits = zlib.MAX_WBITS
+
+
+class BrotliEncoder(Encoder):
+    def __init__(self, level: int | None = None) -> None:
+        if level is None:
+            self._compressor = brotli.Compressor()
+        else:
+            self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        res: bytes = self._compressor.process(data)
+        return res
+
+    def flush(self) -> bytes:
+        res: bytes = self._compressor.finish()
+        return res
+
+
+ENCODERS: dict[str, type[Encoder]] = {
+    "gzip": GzipEncoder,
+    "x-gzip": GzipEncoder,
+    "deflate": DeflateEncoder,
+    "br": BrotliEncoder,
+    "identity": IdentityEncoder,
+}
+
+
+def parse_content_encoding(encoding: str) -> list[str]:
+    return [coding.strip().lower() for coding in encoding.split(",") if coding.strip()]
+
+
+def get_decoder(encoding: str, limits: DecodeLimits | None = None) -> Decoder:
+    codings = parse_content_encoding(encoding)
+
+    for coding in codings:
+        if coding not in DECODERS:
+            raise exceptions.UnsupportedContentEncodingError(coding)
+
+    if len(codings) == 1:
+        return DECODERS[codings[0]](limits)
+    if not codings:
+        return IdentityDecoder(limits)
+
+    unlimited = DecodeLimits(None, None)
+    return MultiDecoder([DECODERS[coding](unlimited) for coding in reversed(codings)], limits)
+
+
+def iter_decode(stream: Iterable[bytes], encoding: str, limits: DecodeLimits | None = None) -> Iterator[bytes]:
+    decoder = get_decoder(encoding, limits)
+    for data in stream:
+        yield from decoder.decompress(data)
+    yield from decoder.flush()
+
+
+def get_encoder(encoding: str, level: int | None = None) -> Encoder:
+    encoding = encoding.strip().lower()
+    if encoding not in ENCODERS:
+        raise exceptions.UnsupportedContentEncodingError(encoding)
+
+    return ENCODERS[encoding](level)
+
+
+def iter_encode(stream: Iterable[bytes], encoding: str, level: int | None = None) -> Iterator[bytes]:
+    encoder = get_encoder(encoding, level)
+    for data in stream:
+        chunk = encoder.compress(data)
+        if chunk:
+            yield chunk
+    yield encoder.flush()
+
+
+def decode(content: bytes, encoding: str, limits: DecodeLimits | None = None) -> bytes:
     if not content:
         return b""
+
     try:
-        return zlib.decompress(content)
-    except zlib.error:
-        return zlib.decompress(content, -15)
+        decoder = get_decoder(encoding, limits)
+    except exceptions.UnsupportedContentEncodingError:
+        return content
+
+    return b"".join(decoder.decompress(content) + decoder.flush())
+
+
+def encode(content: bytes, encoding: str) -> bytes:
+    encoders = {"gzip": encode_gzip, "x-gzip": encode_gzip, "deflate": encode_deflate, "br": encode_brotli}
+    codings = [coding for coding in parse_content_encoding(encoding) if coding != "identity"]
+
+    # デコードできないコーディングが含まれる場合は decode と同様にそのまま返す
+    if any(coding not in encoders for coding in codings):
+        return content
+
+    for coding in codings:
+        content = encoders[coding](content)
+
+    return content
+
+
+def decode_gzip(content: bytes) -> bytes:
+    return decode(content, "gzip")
+
+
+def decode_deflate(content: bytes) -> bytes:
+    return decode(content, "deflate")
 
 
 def decode_brotli(content: bytes) -> bytes:
-    if not content:
-        return b""
-    res: bytes = brotli.decompress(content)
+    return decode(content, "br")
+
+
+def encode_gzip(content: bytes) -> bytes:
+    return gzip.compress(content)
+
+
+def encode_deflate(content: bytes) -> bytes:
+    return zlib.compress(content)
+
+
+def encode_brotli(content: bytes) -> bytes:
+    res: bytes = brotli.compress(content)
     return res
@@ -32,3 +32,19 @@ class NotPortNumberError(Exception):
 
 class NotHttpSchemeError(Exception):
     pass
+
+
+class ChunkedEncodingError(Exception):
+    pass
+
+
+class UnsupportedContentEncodingError(Exception):
+    pass
+
+
+class DecompressionLimitError(Exception):
+    pass
+
+
+class StreamNotProcessedError(ConnectionResetError):
+    pass
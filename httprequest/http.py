@@ -1,18 +1,20 @@
 import email
 import io
 import json
+import time
 import urllib.parse
 from cgi import FieldStorage
 from collections.abc import Iterator, Mapping, MutableMapping
-from datetime import datetime
-from typing import Optional
+from http import HTTPStatus
+from typing import BinaryIO, Optional
 
-from dateutil import tz  # type: ignore
+import h11
 
-from . import encoding, exceptions, util
-from .tube import Tube
+from . import encoding, exceptions, http2, util
+from .buffer import Buffer
+from .timing import Timing
+from .tube import Tube, create_client_connection
 
-TIME_ZONE = "Asia/Tokyo"
 HTTP_VERSIONS = ("HTTP/1.0", "HTTP/1.1", "HTTP/2", "HTTP/3")
 HTTP_METHODS = ("GET", "HEAD", "POST", "PUT", "DELETE", "CONNECT", "OPTIONS", "TRACE", "PATCH")
 
@@ -452,12 +454,93 @@ class MediaType:
 
 
 class Body:
+    """
+    With content_encoding, raw_body is kept as received and decoded only when read.
+
+    Content is held in a buffer.Buffer, which moves to a temporary file past buffer.default_spill_threshold.
+    getbuffer() and open() read such content through mmap without copying it into memory;
+    bytes(body) always returns a copy.
+
+    >>> body = Body(gzip.compress(b"test"), content_encoding="gzip")
+    >>> body.is_modified()
+    False
+    >>> bytes(body)
+    b'test'
+    >>> body.set_body(b"modified")
+    >>> body.get_encoded() == gzip.compress(b"modified")
+    True
+    """
+
     media_type: MediaType | None
-    _raw_body: bytes
+    content_encoding: str | None
+    _content: Buffer | None
+    _encoded_body: Buffer | None
 
-    def __init__(self, raw_body: bytes, media_type: MediaType | None = None) -> None:
-        self._raw_body = raw_body
+    def __init__(
+        self, raw_body: bytes | Buffer, media_type: MediaType | None = None, content_encoding: str | None = None
+    ) -> None:
         self.media_type = media_type
+        self.content_encoding = content_encoding
+        if not isinstance(raw_body, Buffer):
+            raw_body = Buffer.wrap(raw_body)
+
+        if content_encoding:
+            self._content = None
+            self._encoded_body = raw_body
+        else:
+            self._content = raw_body
+            self._encoded_body = raw_body
+
+    @property
+    def _raw_body(self) -> bytes:
+        return bytes(self.get_content_buffer())
+
+    @_raw_body.setter
+    def _raw_body(self, raw_body: bytes | Buffer) -> None:
+        self._content = raw_body if isinstance(raw_body, Buffer) else Buffer.wrap(raw_body)
+        self._encoded_body = None if self.content_encoding else self._content
+
+    def is_modified(self) -> bool:
+        return self._encoded_body is None
+
+    def get_content_buffer(self) -> Buffer:
+        if self._content is None:
+            self._content = self._decode(self._encoded_body or Buffer())
+        return self._content
+
+    def get_encoded_buffer(self) -> Buffer:
+        if self._encoded_body is None:
+            self._encoded_body = Buffer.wrap(encoding.encode(self._raw_body, self.content_encoding or ""))
+        return self._encoded_body
+
+    def get_encoded(self) -> bytes:
+        return bytes(self.get_encoded_buffer())
+
+    def getbuffer(self) -> memoryview:
+        return self.get_content_buffer().getbuffer()
+
+    def open(self) -> BinaryIO:
+        return self.get_content_buffer().open()
+
+    def _decode(self, encoded: Buffer) -> Buffer:
+        if not len(encoded):
+            return Buffer()
+
+        try:
+            decoder = encoding.get_decoder(self.content_encoding or "")
+        except exceptions.UnsupportedContentEncodingError:
+            return encoded
+
+        # 展開後に大きくなるボディも一時ファイルに書けるよう、ストリームでデコードする
+
+        content = Buffer()
+        for data in encoded.iter_chunks():
+            for chunk in decoder.decompress(data):
+                content.write(chunk)
+        for chunk in decoder.flush():
+            content.write(chunk)
+
+        return content
 
     def __bytes__(self) -> bytes:
         return self._raw_body
@@ -466,17 +549,19 @@ class Body:
         return self._raw_body.decode("utf-8")
 
     def __len__(self) -> int:
-        return len(self._raw_body)
+        return len(self.get_content_buffer())
 
-    def set_body(self, raw_body: bytes, media_type: MediaType | None = None) -> None:
+    def set_body(self, raw_body: bytes | Buffer, media_type: MediaType | None = None) -> None:
         self._raw_body = raw_body
         if media_type:
             self.media_type = media_type
 
 
 class RequestBody(Body):
-    def __init__(self, raw_body: bytes, media_type: MediaType | None = None) -> None:
-        super().__init__(raw_body, media_type)
+    def __init__(
+        self, raw_body: bytes | Buffer, media_type: MediaType | None = None, content_encoding: str | None = None
+    ) -> None:
+        super().__init__(raw_body, media_type, content_encoding)
 
     def guess_media_type(self) -> MediaType | None:
         try:
@@ -558,8 +643,10 @@ class RequestBody(Body):
 
 
 class ResponseBody(Body):
-    def __init__(self, raw_body: bytes, media_type: MediaType | None = None) -> None:
-        super().__init__(raw_body, media_type)
+    def __init__(
+        self, raw_body: bytes | Buffer, media_type: MediaType | None = None, content_encoding: str | None = None
+    ) -> None:
+        super().__init__(raw_body, media_type, content_encoding)
 
 
 class RequestMessage:
@@ -665,12 +752,27 @@ class RequestMessage:
     def set_body(self, raw_body: bytes) -> None:
         self.body = RequestBody(raw_body)
 
-    def send(self, host: str, port: int, is_ssl: bool) -> Optional["Response"]:
+    def send(
+        self,
+        host: str,
+        port: int,
+        is_ssl: bool,
+        decode_chunked: bool = True,
+        decode_content: bool = False,
+        use_http2: bool = False,
+        tube: Tube | None = None,
+        stream: bool = False,
+    ) -> Optional["Response"]:
+        """
+        With tube, the request goes over that already open connection (a Session reuses keep-alive ones),
+        and tube.keep_alive tells afterwards whether it can be used again.
+
+        With stream, send returns once the response header is received: the body is left unread in
+        response.stream, to be relayed as it arrives or read with response.read_body(). Over HTTP/2 the
+        body is read as usual and response.stream is None.
+        """
         request = Request(host, port, is_ssl, self)
 
-        # HTTP/1.1に変換
-        if self.http_version == "HTTP/2":
-            self.http_version = "HTTP/1.1"
         if "Host" not in self.headers:
             self.headers.add("Host", host)
 
@@ -680,41 +782,105 @@ class RequestMessage:
             else:
                 self.headers["Content-Length"] = str(len(self.body))
 
-        raw_request = self.__bytes__()
-        tube = Tube()
-        tube.open_connection(request.host, request.port, request.is_ssl)
+        timing = tube.timing if tube else Timing()
+        connection: http2.H2Connection | Tube | None = tube
 
-        request.request_time = datetime.now(tz.gettz(TIME_ZONE)).timestamp()
-        tube.send(raw_request)
+        # ALPN で h2 が選ばれたオリジンには共有の HTTP/2 コネクションで送る
+        if use_http2 and is_ssl and tube is None:
+            connection = http2.default_pool.connect(request.host, request.port, timing)
 
         try:
-            raw_response = tube.recv_raw_http_response()
+            if isinstance(connection, http2.H2Connection):
+                try:
+                    raw_header, raw_body = self._send_http2(request, connection, timing)
+                except exceptions.StreamNotProcessedError:
+                    # RFC 9113 6.8: 処理されていないストリームは、新しいコネクションで 1 回だけ送り直す
+                    connection = http2.default_pool.connect(request.host, request.port, timing)
+                    if isinstance(connection, http2.H2Connection):
+                        raw_header, raw_body = self._send_http2(request, connection, timing)
+                    else:
+                        raw_header, raw_body = self._send_http11(request, connection, timing)
+            elif stream:
+                return self._send_http11_stream(request, connection, timing)
+            else:
+                raw_header, raw_body = self._send_http11(request, connection, timing)
         except TimeoutError:
             return None
 
-        response_time = datetime.now(tz.gettz(TIME_ZONE)).timestamp()
+        response_time = time.time()
 
-        response_message = ResponseMessage(raw_response)
+        # 大きいボディは一時ファイルに置いたまま扱う
+        response_message = ResponseMessage(raw_header)
+        response_message.body = ResponseBody(raw_body)
+        response_message.prepare_body(decode_chunked, decode_content)
 
-        # chunkedされているボディを変換
-        if "Transfer-Encoding" in response_message.headers:
-            if response_message.headers["Transfer-Encoding"] == "chunked":
-                raw_body = util.chunked_conv(bytes(response_message.body))
-                response_message.set_body(raw_body)
-                del response_message.headers["Transfer-Encoding"]
-
-        # エンコーディングされているボディをデコード
-        if "Content-Encoding" in response_message.headers:
-            content_encoding = response_message.headers["Content-Encoding"]
-            raw_body = encoding.decode(bytes(response_message.body), content_encoding)
-            response_message.set_body(raw_body)
-            response_message.headers["Content-Length"] = str(len(response_message.body))
-            del response_message.headers["Content-Encoding"]
-
-        response = Response(request, response_time, response_message)
+        response = Response(request, response_time, response_message, timing)
 
         return response
 
+    def _send_http11(self, request: "Request", tube: Tube | None, timing: Timing) -> tuple[bytes, Buffer]:
+        tube, conn = self._write_http11(request, tube, timing)
+
+        return tube.recv_http_response(conn)
+
+    def _send_http11_stream(self, request: "Request", tube: Tube | None, timing: Timing) -> "Response":
+        tube, conn = self._write_http11(request, tube, timing)
+
+        raw_header, remained = tube.recv_http_response_head(conn)
+
+        response = Response(request, time.time(), ResponseMessage(raw_header), timing)
+        response.stream = ResponseStream(tube, conn, remained)
+
+        return response
+
+    def _write_http11(self, request: "Request", tube: Tube | None, timing: Timing) -> tuple[Tube, h11.Connection]:
+        # HTTP/1.1に変換
+        if self.http_version == "HTTP/2":
+            self.http_version = "HTTP/1.1"
+
+        raw_request = self.__bytes__()
+        headers = [(key, self.headers[key]) for key in self.headers]
+        conn = create_client_connection(self.method, self.request_target, headers, self.http_version)
+        if tube is None:
+            tube = Tube(timing)
+            tube.open_connection(request.host, request.port, request.is_ssl)
+
+        request.request_time = time.time()
+        timing.mark("request_start")
+        tube.send(raw_request)
+        timing.mark("request_end")
+
+        return tube, conn
+
+    def _send_http2(
+        self, request: "Request", connection: "http2.H2Connection", timing: Timing
+    ) -> tuple[bytes, Buffer]:
+        path = urllib.parse.urlparse(self.request_target)._replace(scheme="", netloc="", fragment="").geturl()
+        headers = [(key, self.headers[key]) for key in self.headers]
+        raw_body = bytes(self.body) if self.body else b""
+
+        request.request_time = time.time()
+        status, response_headers, raw_body = connection.request(
+            self.method, self.headers["Host"], path or "/", headers, raw_body, timing
+        )
+
+        # クライアントとは HTTP/1.1 で話すので、HTTP/1.1 のレスポンスとして組み立てる
+        try:
+            reason = HTTPStatus(status).phrase
+        except ValueError:
+            reason = ""
+
+        lines = [f"HTTP/1.1 {status} {reason}".rstrip()]
+        has_content_length = False
+        for key, value in response_headers:
+            if key == "content-length":
+                has_content_length = True
+            lines.append(f"{key}: {value}")
+        if not has_content_length:
+            lines.append(f"content-length: {len(raw_body)}")
+
+        return "\r\n".join(lines).encode("utf-8") + b"\r\n\r\n", raw_body
+
 
 class ResponseMessage:
     """
@@ -762,12 +928,7 @@ class ResponseMessage:
         self.body = ResponseBody(raw_body)
 
     def __bytes__(self) -> bytes:
-        msg: bytes = self.get_status_line().encode("utf-8")
-        msg += bytes(self.headers)
-        msg += b"\r\n"
-        msg += bytes(self.body)
-
-        return msg
+        return self.get_head() + self.body.get_encoded()
 
     def __str__(self) -> str:
         try:
@@ -780,7 +941,8 @@ class ResponseMessage:
             return msg
 
     def __len__(self) -> int:
-        return len(self.__bytes__())
+        # 一時ファイルにあるボディを読み込まずに数える
+        return len(self.get_head()) + len(self.body.get_encoded_buffer())
 
     def get_status_line(self) -> str:
         status_line = " ".join((self.http_version, self.status_code))
@@ -790,11 +952,94 @@ class ResponseMessage:
 
         return status_line
 
+    def get_head(self) -> bytes:
+        # ステータス行とヘッダー (ボディの手前まで)
+        return self.get_status_line().encode("utf-8") + bytes(self.headers) + b"\r\n"
+
     def set_headers(self, raw_header: bytes) -> None:
         self.headers = Headers(raw_header)
 
-    def set_body(self, raw_body: bytes) -> None:
-        self.body = ResponseBody(raw_body)
+    def set_body(self, raw_body: bytes | Buffer) -> None:
+        # 元の Content-Encoding で再エンコードされる
+        self.body.set_body(raw_body)
+        if "Content-Length" in self.headers:
+            self.headers["Content-Length"] = str(len(self.body.get_encoded_buffer()))
+
+    def is_chunked(self) -> bool:
+        if "Transfer-Encoding" not in self.headers:
+            return False
+
+        return self.headers.get_as_list("Transfer-Encoding")[-1].lower() == "chunked"
+
+    def prepare_body(self, decode_chunked: bool = True, decode_content: bool = False) -> None:
+        # 受信したままのボディを、中継・フック用に整える
+        is_chunked = self.is_chunked()
+
+        # chunkedされているボディを変換
+        # decode_chunked=False の場合は chunked のままクライアントへ中継する
+        if is_chunked and decode_chunked:
+            decoder = util.ChunkedDecoder()
+            raw_body = Buffer()
+            for data in self.body.get_encoded_buffer().iter_chunks():
+                for chunk in decoder.feed(data):
+                    raw_body.write(chunk)
+            self.set_body(raw_body)
+            del self.headers["Transfer-Encoding"]
+            self.headers["Content-Length"] = str(len(self.body))
+            is_chunked = False
+
+        if not is_chunked:
+            self.set_content_encoding(decode_content)
+
+    def set_content_encoding(self, decode_content: bool = False) -> None:
+        # エンコーディングされているボディはフックが読み出すまでデコードしない
+        # decode_content=True の場合はデコードして Content-Encoding を外す
+        if "Content-Encoding" not in self.headers:
+            return
+
+        self.body = ResponseBody(self.body.get_encoded_buffer(), content_encoding=self.headers["Content-Encoding"])
+        if decode_content:
+            self.body = ResponseBody(self.body.get_content_buffer())
+            self.headers["Content-Length"] = str(len(self.body))
+            del self.headers["Content-Encoding"]
+
+
+class ResponseStream:
+    """
+    The unread body of a response from send(stream=True), received as it is iterated.
+    Data is yielded as it comes from the server, with the transfer coding (chunked) kept,
+    so it can be relayed as is. It can be iterated only once.
+
+    >>> for data in response.stream:
+    ...     client.send(data)
+    """
+
+    size: int
+
+    def __init__(self, tube: Tube, conn: h11.Connection, remained: bytes) -> None:
+        self.tube = tube
+        self.conn = conn
+        self.remained = remained
+        # 受信したボディのバイト数
+        self.size = 0
+        self.consumed = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        if self.consumed:
+            raise RuntimeError("The response body has already been read")
+        self.consumed = True
+
+        if self.remained:
+            self.size += len(self.remained)
+            yield self.remained
+        for data in self.tube.iter_http_body(self.conn):
+            self.size += len(data)
+            yield data
+
+        self.tube.finish_http_response(self.conn)
+
+    def close(self) -> None:
+        self.tube.close()
 
 
 class RequestMaster:
@@ -831,8 +1076,12 @@ class RequestMaster:
 
 
 class PreparedRequest(RequestMaster):
-    def send(self) -> Optional["Response"]:
-        return self.message.send(self.host, self.port, self.is_ssl)
+    def send(
+        self, decode_chunked: bool = True, decode_content: bool = False, use_http2: bool = False, stream: bool = False
+    ) -> Optional["Response"]:
+        return self.message.send(
+            self.host, self.port, self.is_ssl, decode_chunked, decode_content, use_http2, stream=stream
+        )
 
 
 class Request(RequestMaster):
@@ -841,13 +1090,53 @@ class Request(RequestMaster):
 
 
 class Response:
-    def __init__(self, request: Request, response_time: float, message: ResponseMessage):
+    timing: Timing
+    cache_status: str | None
+    stream: ResponseStream | None
+
+    def __init__(
+        self, request: Request, response_time: float, message: ResponseMessage, timing: Timing | None = None
+    ):
         self.response_time = response_time
         self.message = message
         self.request = request
+        self.timing = timing or Timing()
+        # cache.Cache を通した場合に "hit" / "miss" / "revalidated" / "collapsed" / "bypass" が入る
+        self.cache_status = None
+        # send(stream=True) でボディをまだ受信していない場合
+        self.stream = None
         request.response = self
 
+    def read_body(self, decode_chunked: bool = True, decode_content: bool = False) -> None:
+        """
+        Receives the rest of a streamed body into message.body, as send() without stream would have.
+        """
+        if self.stream is None:
+            return
+
+        raw_body = Buffer()
+        for data in self.stream:
+            raw_body.write(data)
+        self.stream = None
+        self.response_time = time.time()
+
+        self.message.body = ResponseBody(raw_body)
+        self.message.prepare_body(decode_chunked, decode_content)
+
+    def get_size(self) -> int:
+        """
+        Bytes of the response, including a body already relayed from the stream.
+        """
+        if self.stream is None:
+            return len(self.message)
+
+        return len(self.message.get_head()) + self.stream.size
+
     def get_roundtrip_time(self) -> float | None:
+        roundtrip_time = self.timing.roundtrip
+        if roundtrip_time is not None:
+            return roundtrip_time / 1e9
+
         if not self.request or not self.request.request_time or not self.response_time:
             return None
 
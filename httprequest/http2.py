@@ -0,0 +1,357 @@
+import selectors
+import socket
+import ssl
+import threading
+import time
+
+import h2.config
+import h2.connection
+import h2.errors
+import h2.events
+import h2.exceptions
+
+from . import exceptions
+from .buffer import Buffer
+from .timing import Timing
+from .tube import Tube
+
+ALPN_PROTOCOLS = ["h2", "http/1.1"]
+IDLE_TIMEOUT = 60.0
+RECV_SIZE = 65536
+
+# RFC 9113 Section 8.2.2. Connection-Specific Header Fields
+CONNECTION_SPECIFIC_HEADERS = ("connection", "host", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade")
+
+
+class Stream:
+    status: int | None
+    headers: list[tuple[str, str]]
+    data: Buffer
+    error: Exception | None
+    first_byte: int | None
+    response_end: int | None
+
+    def __init__(self) -> None:
+        self.status = None
+        self.headers = []
+        # I/O スレッドを止めないよう、メモリの予算が無ければ待たずに一時ファイルへ移す
+        self.data = Buffer(blocking=False)
+        self.error = None
+        self.first_byte = None
+        self.response_end = None
+        self.done = threading.Event()
+
+
+class H2Connection:
+    """
+    RFC 9113: HTTP/2
+    https://datatracker.ietf.org/doc/html/rfc9113
+
+    One upstream HTTP/2 connection shared by many threads.
+    A single I/O thread owns the socket; request threads only drive the h2 state machine under the lock
+    and wake the I/O thread up to flush the frames.
+
+    A request that the server did not process, because the connection was going away or the stream was
+    above the last_stream_id of its GOAWAY (RFC 9113 Section 6.8), raises StreamNotProcessedError and
+    can be retried on another connection.
+
+    >>> conn = H2Connection(tube.socket)
+    >>> status, headers, body = conn.request("GET", "example.com", "/", [("accept", "*/*")], b"")
+    """
+
+    def __init__(self, sock: socket.socket, idle_timeout: float = IDLE_TIMEOUT) -> None:
+        self.socket = sock
+        self.socket.setblocking(False)
+        self.idle_timeout = idle_timeout
+        self.closed = False
+        self.goaway = False
+        self.streams: dict[int, Stream] = {}
+
+        self._conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=True, header_encoding="utf-8"))
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+
+        with self._lock:
+            self._conn.initiate_connection()
+        self._wakeup()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def is_available(self) -> bool:
+        return not self.closed and not self.goaway
+
+    def request(
+        self,
+        method: str,
+        authority: str,
+        path: str,
+        headers: list[tuple[str, str]],
+        body: bytes,
+        timing: Timing | None = None,
+        timeout: float = 30,
+    ) -> tuple[int, list[tuple[str, str]], Buffer]:
+        stream = Stream()
+        request_headers = [(":method", method), (":scheme", "https"), (":authority", authority), (":path", path)]
+        for key, value in headers:
+            key = key.lower()
+            if key in CONNECTION_SPECIFIC_HEADERS or (key == "te" and value.lower() != "trailers"):
+                continue
+            request_headers.append((key, value))
+
+        deadline = time.monotonic() + timeout
+
+        with self._cond:
+            # 相手の SETTINGS_MAX_CONCURRENT_STREAMS を超えないように待つ
+            while (
+                self.is_available()
+                and self._conn.open_outbound_streams >= self._conn.remote_settings.max_concurrent_streams
+            ):
+                if not self._cond.wait(deadline - time.monotonic()):
+                    raise TimeoutError("timed out")
+            if not self.is_available():
+                # まだ送っていないので、別のコネクションで送り直せる
+                raise exceptions.StreamNotProcessedError("HTTP/2 connection closed")
+
+            stream_id = self._conn.get_next_available_stream_id()
+            self.streams[stream_id] = stream
+            if timing:
+                timing.mark("request_start")
+            self._conn.send_headers(stream_id, request_headers, end_stream=not body)
+        self._wakeup()
+
+        try:
+            self._send_body(stream_id, body, deadline)
+            if timing:
+                timing.mark("request_end")
+
+            if not stream.done.wait(max(deadline - time.monotonic(), 0)):
+                with self._lock:
+                    try:
+                        self._conn.reset_stream(stream_id, h2.errors.ErrorCodes.CANCEL)
+                    except h2.exceptions.ProtocolError:
+                        pass
+                self._wakeup()
+                raise TimeoutError("timed out")
+        finally:
+            with self._lock:
+                self.streams.pop(stream_id, None)
+
+        if stream.error:
+            raise stream.error
+
+        if timing:
+            timing.first_byte = stream.first_byte
+            timing.response_end = stream.response_end
+
+        return stream.status or 0, stream.headers, stream.data
+
+    def close(self) -> None:
+        # GOAWAY を送り、I/O スレッドが書き出してから閉じる
+        with self._lock:
+            if self.closed or self.goaway:
+                return
+            self.goaway = True
+            try:
+                self._conn.close_connection()
+            except h2.exceptions.ProtocolError:
+                pass
+        self._wakeup()
+
+    def _send_body(self, stream_id: int, body: bytes, deadline: float) -> None:
+        offset = 0
+        view = memoryview(body)
+        while offset < len(body):
+            with self._cond:
+                # ストリームとコネクションのフロー制御ウィンドウが開くまで待つ
+                while not self.closed:
+                    size = min(
+                        self._conn.local_flow_control_window(stream_id),
+                        self._conn.max_outbound_frame_size,
+                        len(body) - offset,
+                    )
+                    if size > 0:
+                        break
+                    if not self._cond.wait(deadline - time.monotonic()):
+                        raise TimeoutError("timed out")
+                if self.closed:
+                    raise ConnectionResetError("HTTP/2 connection closed")
+
+                end_stream = offset + size == len(body)
+                self._conn.send_data(stream_id, view[offset : offset + size].tobytes(), end_stream=end_stream)
+                offset += size
+            self._wakeup()
+
+    def _wakeup(self) -> None:
+        try:
+            self._wakeup_w.send(b"\0")
+        except OSError:
+            pass
+
+    def _flush(self) -> None:
+        with self._lock:
+            data = self._conn.data_to_send()
+        if data:
+            self.socket.setblocking(True)
+            try:
+                self.socket.sendall(data)
+            finally:
+                self.socket.setblocking(False)
+
+    def _run(self) -> None:
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        selector.register(self._wakeup_r, selectors.EVENT_READ)
+        last_active = time.monotonic()
+
+        try:
+            while not self.closed:
+                self._flush()
+
+                with self._lock:
+                    idle = not self.streams
+                if self.goaway and idle:
+                    break
+
+                ready = selector.select(self.idle_timeout)
+
+                if not ready:
+                    if idle and time.monotonic() - last_active >= self.idle_timeout:
+                        self.close()
+                    continue
+
+                last_active = time.monotonic()
+                for key, _ in ready:
+                    if key.fileobj is self._wakeup_r:
+                        try:
+                            while self._wakeup_r.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    else:
+                        self._receive()
+        except Exception as e:
+            self._shutdown(e)
+        finally:
+            selector.close()
+            self._shutdown(ConnectionResetError("HTTP/2 connection closed"))
+
+    def _receive(self) -> None:
+        while True:
+            try:
+                data = self.socket.recv(RECV_SIZE)
+            except (BlockingIOError, ssl.SSLWantReadError):
+                return
+
+            if not data:
+                raise ConnectionResetError("HTTP/2 connection closed by peer")
+
+            with self._cond:
+                events = self._conn.receive_data(data)
+                for event in events:
+                    self._handle_event(event)
+                self._cond.notify_all()
+
+            # SSL のバッファに残っているデータも読み切る
+            pending = getattr(self.socket, "pending", None)
+            if not pending or not pending():
+                return
+
+    def _handle_event(self, event: h2.events.Event) -> None:
+        stream = self.streams.get(getattr(event, "stream_id", 0) or 0)
+
+        if isinstance(event, h2.events.ResponseReceived) and stream:
+            stream.first_byte = time.perf_counter_ns()
+            for key, value in event.headers:
+                if key == ":status":
+                    stream.status = int(value)
+                else:
+                    stream.headers.append((key, value))
+        elif isinstance(event, h2.events.TrailersReceived) and stream:
+            stream.headers.extend(event.headers)
+        elif isinstance(event, h2.events.DataReceived):
+            if stream:
+                stream.data.write(event.data)
+            # 受け取った分はすぐにウィンドウを返す
+            self._conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded) and stream:
+            stream.response_end = time.perf_counter_ns()
+            stream.done.set()
+        elif isinstance(event, h2.events.StreamReset) and stream:
+            stream.error = ConnectionResetError(f"HTTP/2 stream reset ({event.error_code})")
+            stream.done.set()
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self.goaway = True
+            # last_stream_id より後のストリームは処理されていない
+            for stream_id, other in self.streams.items():
+                if event.last_stream_id is None or stream_id > event.last_stream_id:
+                    other.error = exceptions.StreamNotProcessedError("HTTP/2 GOAWAY received")
+                    other.done.set()
+
+    def _shutdown(self, error: Exception) -> None:
+        with self._cond:
+            self.closed = True
+            for stream in self.streams.values():
+                if not stream.done.is_set():
+                    stream.error = error
+                    stream.done.set()
+            self._cond.notify_all()
+
+        for sock in (self.socket, self._wakeup_r, self._wakeup_w):
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+
+class ConnectionPool:
+    """
+    One HTTP/2 connection per origin.
+    Origins that did not negotiate h2 over ALPN are remembered and skipped.
+    """
+
+    def __init__(self) -> None:
+        self._connections: dict[tuple[str, int], H2Connection] = {}
+        self._http11_origins: set[tuple[str, int]] = set()
+        self._origin_locks: dict[tuple[str, int], threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def connect(self, host: str, port: int, timing: Timing, timeout: int = 30) -> H2Connection | Tube | None:
+        key = (host, port)
+        if key in self._http11_origins:
+            return None
+
+        with self._lock:
+            origin_lock = self._origin_locks.setdefault(key, threading.Lock())
+
+        # 同じオリジンへの接続は 1 本にまとめる
+        with origin_lock:
+            conn = self._connections.get(key)
+            if conn and conn.is_available():
+                return conn
+
+            tube = Tube(timing)
+            tube.open_connection(host, port, True, timeout, alpn_protocols=ALPN_PROTOCOLS)
+            if tube.get_alpn_protocol() != "h2":
+                self._http11_origins.add(key)
+                return tube
+
+            conn = H2Connection(tube.socket)
+            self._connections[key] = conn
+            return conn
+
+    def get_connection_count(self) -> int:
+        return sum(1 for conn in list(self._connections.values()) if conn.is_available())
+
+    def close(self) -> None:
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+
+        for conn in connections:
+            conn.close()
+
+
+default_pool = ConnectionPool()
@@ -1,21 +1,21 @@
 from . import exceptions
-from .http import URI, Headers, MediaType, RequestBody, RequestMessage, Response
+from .http import URI, Headers, MediaType, PreparedRequest, RequestBody, RequestMessage, Response
 
 TIME_ZONE = "Asia/Tokyo"
 
 
-def send(method: str, url: str, headers: dict | None = None, raw_body: bytes | None = None) -> Response | None:
+def prepare(method: str, url: str, headers: dict | None = None, raw_body: bytes | None = None) -> PreparedRequest:
     uri = URI(url)
     scheme = uri.scheme
     if scheme.lower() == "http":
         is_ssl = False
-    if scheme.lower() == "https":
+    elif scheme.lower() == "https":
         is_ssl = True
     else:
         raise exceptions.NotHttpSchemeError
 
     host = uri.host
-    port = uri.port
+    port = getattr(uri, "port", None)
 
     if not port:
         if is_ssl:
@@ -41,10 +41,16 @@ def send(method: str, url: str, headers: dict | None = None, raw_body: bytes | N
             media_type = None
 
         message.body = RequestBody(raw_body, media_type)
+        if "Content-Length" not in message.headers and "Transfer-Encoding" not in message.headers:
+            message.headers["Content-Length"] = str(len(raw_body))
     else:
         message.body = None
 
-    return message.send(host, port, is_ssl)
+    return PreparedRequest(host, port, is_ssl, message)
+
+
+def send(method: str, url: str, headers: dict | None = None, raw_body: bytes | None = None) -> Response | None:
+    return prepare(method, url, headers, raw_body).send()
 
 
 def get(url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
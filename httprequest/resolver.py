@@ -0,0 +1,235 @@
+import errno
+import os
+import selectors
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+DNS_TTL = 60.0
+DNS_NEGATIVE_TTL = 5.0
+DNS_STALE_TTL = 300.0
+DNS_MAX_ENTRIES = 4096
+# RFC 8305 Section 5. Connection Attempt Delay
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+AddrInfo = tuple[socket.AddressFamily, socket.SocketKind, int, str, tuple]
+
+
+class CacheEntry:
+    addrinfo: list[AddrInfo]
+    error: socket.gaierror | None
+    expires: float
+
+    def __init__(self, addrinfo: list[AddrInfo], error: socket.gaierror | None, expires: float) -> None:
+        self.addrinfo = addrinfo
+        self.error = error
+        self.expires = expires
+
+
+class Resolver:
+    """
+    getaddrinfo() with a positive and negative cache shared across threads.
+
+    The system resolver does not expose record TTLs, so cached answers live for a fixed ttl.
+    An expired answer is still served for stale_ttl seconds while it is refreshed in the background.
+
+    >>> resolver = Resolver(ttl=60.0)
+    >>> addrinfo = resolver.resolve("example.com", 443)
+    >>> sock = connect(addrinfo, timeout=30)
+    """
+
+    def __init__(
+        self,
+        ttl: float = DNS_TTL,
+        negative_ttl: float = DNS_NEGATIVE_TTL,
+        stale_ttl: float = DNS_STALE_TTL,
+        max_entries: int = DNS_MAX_ENTRIES,
+    ) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._cache: OrderedDict[tuple[str, int], CacheEntry] = OrderedDict()
+        self._refreshing: set[tuple[str, int]] = set()
+        self._lock = threading.Lock()
+
+    def resolve(self, host: str, port: int) -> list[AddrInfo]:
+        key = (host, port)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry:
+                self._cache.move_to_end(key)
+
+        if entry and now < entry.expires:
+            return self._answer(entry)
+
+        # 期限切れでも stale_ttl の間は古い結果を返し、裏で引き直す
+        if entry and not entry.error and now < entry.expires + self.stale_ttl:
+            self._refresh_in_background(key)
+            return self._answer(entry)
+
+        return self._answer(self._lookup(key))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def _answer(self, entry: CacheEntry) -> list[AddrInfo]:
+        if entry.error:
+            raise entry.error
+        return entry.addrinfo
+
+    def _lookup(self, key: tuple[str, int]) -> CacheEntry:
+        entry = self._query(key)
+        self._store(key, entry)
+        return entry
+
+    def _query(self, key: tuple[str, int]) -> CacheEntry:
+        host, port = key
+        try:
+            addrinfo = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+            return CacheEntry(addrinfo, None, time.monotonic() + self.ttl)
+        except socket.gaierror as e:
+            return CacheEntry([], e, time.monotonic() + self.negative_ttl)
+
+    def _store(self, key: tuple[str, int], entry: CacheEntry) -> None:
+        with self._lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def _refresh_in_background(self, key: tuple[str, int]) -> None:
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh() -> None:
+            try:
+                entry = self._query(key)
+                # 引き直しに失敗した場合は stale_ttl が切れるまで古い結果を使い続ける
+                if not entry.error:
+                    self._store(key, entry)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+
+default_resolver = Resolver()
+
+
+def sort_addrinfo(addrinfo: list[AddrInfo]) -> list[AddrInfo]:
+    """
+    RFC 8305: Happy Eyeballs Version 2: Better Connectivity Using Concurrency
+                Section 4. Sorting Addresses
+    https://datatracker.ietf.org/doc/html/rfc8305#section-4
+
+    Interleave the address families, starting with the family getaddrinfo() preferred.
+    """
+    if not addrinfo:
+        return []
+
+    first_family = addrinfo[0][0]
+    preferred = [x for x in addrinfo if x[0] == first_family]
+    others = [x for x in addrinfo if x[0] != first_family]
+
+    result = []
+    for i in range(max(len(preferred), len(others))):
+        if i < len(preferred):
+            result.append(preferred[i])
+        if i < len(others):
+            result.append(others[i])
+
+    return result
+
+
+def connect(
+    addrinfo: list[AddrInfo], timeout: float | None = None, delay: float = CONNECTION_ATTEMPT_DELAY
+) -> socket.socket:
+    """
+    RFC 8305: Happy Eyeballs Version 2: Better Connectivity Using Concurrency
+                Section 5. Connection Attempts
+    https://datatracker.ietf.org/doc/html/rfc8305#section-5
+
+    Start a connection attempt every delay seconds (or as soon as one fails)
+    and return the first socket that connects. The others are closed.
+    """
+    addrinfo = sort_addrinfo(addrinfo)
+    if not addrinfo:
+        raise OSError(errno.EHOSTUNREACH, "no addresses to connect to")
+
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    selector = selectors.DefaultSelector()
+    pending: list[socket.socket] = []
+    errors: list[OSError] = []
+    next_index = 0
+    next_attempt = time.monotonic()
+
+    try:
+        while True:
+            now = time.monotonic()
+
+            if next_index < len(addrinfo) and (now >= next_attempt or not pending):
+                family, type_, proto, _, sockaddr = addrinfo[next_index]
+                next_index += 1
+                next_attempt = now + delay
+
+                sock = socket.socket(family, type_, proto)
+                sock.setblocking(False)
+                err = sock.connect_ex(sockaddr)
+                if err == 0:
+                    pending.append(sock)
+                    return _won(sock, pending)
+                if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                    errors.append(OSError(err, os.strerror(err)))
+                    sock.close()
+                    continue
+                selector.register(sock, selectors.EVENT_WRITE)
+                pending.append(sock)
+
+            if not pending:
+                raise errors[-1]
+
+            if deadline is not None and now >= deadline:
+                raise TimeoutError("timed out")
+
+            wait = None
+            if next_index < len(addrinfo):
+                wait = max(next_attempt - now, 0)
+            if deadline is not None:
+                wait = deadline - now if wait is None else min(wait, deadline - now)
+
+            for key, _ in selector.select(wait):
+                sock = key.fileobj  # type: ignore[assignment]
+                selector.unregister(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    return _won(sock, pending)
+
+                errors.append(OSError(err, os.strerror(err)))
+                pending.remove(sock)
+                sock.close()
+                # 失敗した場合は待たずに次のアドレスへ
+                next_attempt = now
+    except BaseException:
+        for sock in pending:
+            sock.close()
+        raise
+    finally:
+        selector.close()
+
+
+def _won(sock: socket.socket, pending: list[socket.socket]) -> socket.socket:
+    for other in pending:
+        if other is not sock:
+            other.close()
+    pending.clear()
+
+    sock.setblocking(True)
+    return sock
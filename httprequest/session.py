@@ -0,0 +1,292 @@
+import ssl
+import threading
+import time
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from itertools import islice
+
+from . import exceptions
+from .http import Headers, PreparedRequest, Response
+from .httprequest import prepare
+from .resolver import Resolver
+from .timing import Timing
+from .tube import Tube, create_ssl_context
+
+MAX_IDLE_PER_HOST = 10
+IDLE_TIMEOUT = 30.0
+TIMEOUT = 30
+CONCURRENCY = 10
+
+# RFC 9110 Section 9.2.2. Idempotent Methods
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE", "PUT", "DELETE")
+
+Origin = tuple[str, int, bool]
+FetchItem = str | tuple | PreparedRequest
+
+
+class TubePool:
+    """
+    RFC 9112: HTTP/1.1
+                Section 9.3. Persistence
+    https://datatracker.ietf.org/doc/html/rfc9112#section-9.3
+
+    Idle keep-alive connections per origin. The most recently released connection is taken first;
+    connections idle for longer than idle_timeout, or closed by the server meanwhile, are dropped.
+    The TLS session of an origin is kept so that new connections to it resume the session.
+
+    >>> pool = TubePool()
+    >>> tube, reused = pool.acquire("example.com", 443, True)
+    >>> pool.release(tube, "example.com", 443, True)
+    """
+
+    def __init__(
+        self,
+        max_idle_per_host: int = MAX_IDLE_PER_HOST,
+        idle_timeout: float = IDLE_TIMEOUT,
+        dns_resolver: Resolver | None = None,
+        timeout: int = TIMEOUT,
+    ) -> None:
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.dns_resolver = dns_resolver
+        self.timeout = timeout
+        self.created = 0
+        self.reused = 0
+        self.closed = False
+
+        self._idle: dict[Origin, deque[tuple[Tube, float]]] = {}
+        self._idle_limits: list[int] = []
+        self._ssl_context = create_ssl_context()
+        self._ssl_sessions: dict[Origin, ssl.SSLSession] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host: str, port: int, is_ssl: bool) -> tuple[Tube, bool]:
+        """
+        An open connection to the origin, and whether it was reused.
+        """
+        key = (host, port, is_ssl)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                tube, released = idle.pop()
+
+            # 待機中に読めるようになった接続は、サーバーが閉じたもの
+            if time.monotonic() - released < self.idle_timeout and not tube.is_readable():
+                tube.timing = Timing()
+                with self._lock:
+                    self.reused += 1
+                return tube, True
+            tube.close()
+
+        tube = Tube(Timing(), self.dns_resolver)
+        if is_ssl:
+            tube.open_connection(
+                host, port, True, self.timeout, ssl_context=self._ssl_context, ssl_session=self._ssl_sessions.get(key)
+            )
+        else:
+            tube.open_connection(host, port, False, self.timeout)
+
+        with self._lock:
+            self.created += 1
+        return tube, False
+
+    def release(self, tube: Tube, host: str, port: int, is_ssl: bool) -> None:
+        """
+        Returns a connection after its response has been read. It is closed unless it can be kept alive.
+        """
+        key = (host, port, is_ssl)
+        if is_ssl:
+            # TLS 1.3 のセッションチケットはハンドシェイク後に届くので、レスポンスを読んだ後に取り出す
+            session = tube.get_ssl_session()
+            if session is not None:
+                with self._lock:
+                    self._ssl_sessions[key] = session
+
+        if tube.keep_alive:
+            with self._lock:
+                idle = self._idle.setdefault(key, deque())
+                if not self.closed and len(idle) < max([self.max_idle_per_host, *self._idle_limits]):
+                    idle.append((tube, time.monotonic()))
+                    return
+
+        tube.close()
+
+    @contextmanager
+    def idle_limit(self, count: int) -> Iterator[None]:
+        """
+        Keeps up to count idle connections per origin inside the block, then closes the ones over
+        max_idle_per_host, oldest first.
+        """
+        with self._lock:
+            self._idle_limits.append(count)
+        try:
+            yield
+        finally:
+            tubes = []
+            with self._lock:
+                self._idle_limits.remove(count)
+                limit = max([self.max_idle_per_host, *self._idle_limits])
+                for idle in self._idle.values():
+                    while len(idle) > limit:
+                        tubes.append(idle.popleft()[0])
+
+            for tube in tubes:
+                tube.close()
+
+    def get_idle_count(self) -> int:
+        with self._lock:
+            return sum(len(x) for x in self._idle.values())
+
+    def close(self) -> None:
+        with self._lock:
+            self.closed = True
+            tubes = [tube for idle in self._idle.values() for tube, _ in idle]
+            self._idle.clear()
+
+        for tube in tubes:
+            tube.close()
+
+
+class Session:
+    """
+    Requests that share a keep-alive connection pool, a DNS cache, TLS sessions and default headers.
+    Unlike httprequest.get() and the other module-level helpers, a connection is opened only when
+    no idle one to the origin is left in the pool.
+
+    fetch_many() sends many requests concurrently over the pool and yields them as they complete.
+    Items are URLs (GET), (method, url[, headers[, body]]) tuples or PreparedRequests.
+
+    >>> with Session(headers={"User-Agent": "crawler/1.0"}) as session:
+    ...     response = session.get("https://example.com/")
+    ...     for url, response in session.fetch_many(urls, concurrency=32):
+    ...         print(url, response.message.status_code)
+    """
+
+    headers: Headers
+    dns_resolver: Resolver
+    pool: TubePool
+
+    def __init__(
+        self,
+        headers: dict | None = None,
+        max_idle_per_host: int = MAX_IDLE_PER_HOST,
+        idle_timeout: float = IDLE_TIMEOUT,
+        timeout: int = TIMEOUT,
+        decode_content: bool = False,
+        dns_resolver: Resolver | None = None,
+    ) -> None:
+        self.headers = Headers(headers)
+        self.decode_content = decode_content
+        self.dns_resolver = dns_resolver or Resolver()
+        self.pool = TubePool(max_idle_per_host, idle_timeout, self.dns_resolver, timeout)
+
+    def __enter__(self) -> "Session":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def prepare(
+        self, method: str, url: str, headers: dict | None = None, body: bytes | None = None
+    ) -> PreparedRequest:
+        prepared_request = prepare(method, url, headers, body)
+        message_headers = prepared_request.message.headers
+        for key in self.headers:
+            if key not in message_headers:
+                message_headers[key] = self.headers.get_as_list(key)
+
+        return prepared_request
+
+    def send(self, prepared_request: PreparedRequest) -> Response | None:
+        host, port, is_ssl = prepared_request.host, prepared_request.port, prepared_request.is_ssl
+        message = prepared_request.message
+
+        while True:
+            tube, reused = self.pool.acquire(host, port, is_ssl)
+            try:
+                response = message.send(host, port, is_ssl, decode_content=self.decode_content, tube=tube)
+            except (OSError, exceptions.NotHttp11ResponseMessageError):
+                tube.close()
+                # 使い回した接続がサーバー側で閉じられていた場合は、新しい接続でやり直す
+                if reused and message.method in IDEMPOTENT_METHODS:
+                    continue
+                raise
+            except BaseException:
+                tube.close()
+                raise
+
+            if response is None:
+                tube.close()
+            else:
+                self.pool.release(tube, host, port, is_ssl)
+            return response
+
+    def request(self, method: str, url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+        return self.send(self.prepare(method, url, headers, body))
+
+    def get(self, url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+        return self.request("GET", url, headers, body)
+
+    def post(self, url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+        return self.request("POST", url, headers, body)
+
+    def put(self, url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+        return self.request("PUT", url, headers, body)
+
+    def delete(self, url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+        return self.request("DELETE", url, headers, body)
+
+    def patch(self, url: str, headers: dict | None = None, body: bytes | None = None) -> Response | None:
+        return self.request("PATCH", url, headers, body)
+
+    def fetch_many(
+        self, requests: Iterable[FetchItem], concurrency: int = CONCURRENCY, return_exceptions: bool = False
+    ) -> Iterator[tuple[FetchItem, Response | None | Exception]]:
+        """
+        (item, response) in the order the responses complete. The response is None on a timeout.
+
+        At most concurrency requests are in flight, and items are taken from requests only as slots
+        free up, so requests can be a generator over millions of URLs. While it runs, the pool keeps up
+        to concurrency idle connections per host. With return_exceptions, an exception is yielded in place
+        of the response instead of being raised.
+        """
+        # 同じホストへの応答がまとめて返っても接続を捨てないよう、同時実行数までは待機させておく
+        with self.pool.idle_limit(concurrency):
+            items = iter(requests)
+            executor = ThreadPoolExecutor(max_workers=concurrency)
+            pending: dict[Future, FetchItem] = {}
+            try:
+                for item in islice(items, concurrency):
+                    pending[executor.submit(self._fetch, item)] = item
+
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        item = pending.pop(future)
+                        for next_item in islice(items, 1):
+                            pending[executor.submit(self._fetch, next_item)] = next_item
+
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            if not return_exceptions:
+                                raise
+                            result = e
+                        yield item, result
+            finally:
+                # 途中で止めた場合は、まだ始まっていないリクエストを送らない
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    def _fetch(self, item: FetchItem) -> Response | None:
+        if isinstance(item, PreparedRequest):
+            return self.send(item)
+        if isinstance(item, str):
+            return self.request("GET", item)
+        return self.request(*item)
+
+    def close(self) -> None:
+        self.pool.close()
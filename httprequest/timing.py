@@ -0,0 +1,107 @@
+import time
+
+
+class Timing:
+    """
+    Monotonic timestamps (time.perf_counter_ns) of the phases of one request.
+
+    dns_start   connect_start   tls_start   request_start   request_end   first_byte   response_end
+        |   dns   |   connect     |   tls     | request_write  |    ttfb     | transfer  |
+
+    Phases that did not happen (reused connection, plain http) stay None.
+    Durations spent in the proxy itself (hooks, cert minting, client write) are kept in overhead,
+    and in spans with their start and end when recorded with add_span().
+
+    >>> response.timing.get_phases()
+    {'dns': 0.0012, 'connect': 0.0101, 'tls': 0.0253, 'request_write': 0.0001, 'ttfb': 0.0412, 'transfer': 0.0023}
+    """
+
+    PHASES = ("dns", "connect", "tls", "request_write", "ttfb", "transfer")
+
+    dns_start: int | None
+    dns_end: int | None
+    connect_start: int | None
+    connect_end: int | None
+    tls_start: int | None
+    tls_end: int | None
+    request_start: int | None
+    request_end: int | None
+    first_byte: int | None
+    response_end: int | None
+    overhead: dict[str, int]
+    spans: list[tuple[str, int, int]]
+
+    def __init__(self) -> None:
+        self.dns_start = None
+        self.dns_end = None
+        self.connect_start = None
+        self.connect_end = None
+        self.tls_start = None
+        self.tls_end = None
+        self.request_start = None
+        self.request_end = None
+        self.first_byte = None
+        self.response_end = None
+        self.overhead = {}
+        self.spans = []
+
+    def mark(self, name: str) -> None:
+        setattr(self, name, time.perf_counter_ns())
+
+    def add_overhead(self, name: str, duration: int) -> None:
+        self.overhead[name] = self.overhead.get(name, 0) + duration
+
+    def add_span(self, name: str, start: int, end: int) -> None:
+        self.spans.append((name, start, end))
+        self.add_overhead(name, end - start)
+
+    @staticmethod
+    def _duration(start: int | None, end: int | None) -> int | None:
+        if start is None or end is None:
+            return None
+        return end - start
+
+    @property
+    def dns(self) -> int | None:
+        return self._duration(self.dns_start, self.dns_end)
+
+    @property
+    def connect(self) -> int | None:
+        return self._duration(self.connect_start, self.connect_end)
+
+    @property
+    def tls(self) -> int | None:
+        return self._duration(self.tls_start, self.tls_end)
+
+    @property
+    def request_write(self) -> int | None:
+        return self._duration(self.request_start, self.request_end)
+
+    @property
+    def ttfb(self) -> int | None:
+        return self._duration(self.request_end, self.first_byte)
+
+    @property
+    def transfer(self) -> int | None:
+        return self._duration(self.first_byte, self.response_end)
+
+    @property
+    def roundtrip(self) -> int | None:
+        return self._duration(self.request_start, self.response_end)
+
+    @property
+    def total(self) -> int | None:
+        starts = (self.dns_start, self.connect_start, self.tls_start, self.request_start)
+        start = next((x for x in starts if x is not None), None)
+        return self._duration(start, self.response_end)
+
+    def get_phases(self) -> dict[str, float | None]:
+        phases: dict[str, float | None] = {}
+        for name in self.PHASES:
+            duration = getattr(self, name)
+            phases[name] = duration / 1e9 if duration is not None else None
+
+        return phases
+
+    def get_overhead(self) -> dict[str, float]:
+        return {name: duration / 1e9 for name, duration in self.overhead.items()}
@@ -1,28 +1,104 @@
+import select
 import socket
 import ssl
+from collections.abc import Callable, Iterator
 
 import h11
 
+from . import resolver
+from .buffer import Buffer
+from .resolver import Resolver
+from .timing import Timing
+
+# これ以下のボディはヘッダーとつなげて 1 回で送る
+SEND_COPY_SIZE = 64 * 1024
+
+
+def create_client_connection(
+    method: str, target: str, headers: list[tuple[str, str]], http_version: str = "HTTP/1.1"
+) -> h11.Connection:
+    """
+    A client h11.Connection that has been told about the request, so it knows that a response to HEAD,
+    or a 304, has no body (RFC 9112 6.3), and whether the request asked to close the connection.
+    The request itself is sent over the tube as raw bytes, unchanged.
+    """
+    conn = h11.Connection(our_role=h11.CLIENT)
+    try:
+        conn.send(h11.Request(method=method, target=target, headers=headers, http_version=http_version[5:]))
+    except h11.LocalProtocolError:
+        # h11 が受け付けないリクエストは、レスポンスだけで終わりを判断する
+        conn = h11.Connection(our_role=h11.CLIENT)
+
+    return conn
+
 
 class Tube:
     timeout: int
+    timing: Timing
+    dns_resolver: Resolver | None
+    keep_alive: bool
 
-    def __init__(self) -> None:
-        pass
+    def __init__(self, timing: Timing | None = None, dns_resolver: Resolver | None = None) -> None:
+        self.timing = timing or Timing()
+        self.dns_resolver = dns_resolver
+        self.keep_alive = False
 
     def send(self, msg: bytes) -> None:
         self.socket.sendall(msg)
 
+    def send_message(self, head: bytes, body: Buffer) -> None:
+        file = body.get_file()
+        if file is None:
+            # 大きいボディはヘッダーとつなげてコピーせずに送る
+            if len(body) <= SEND_COPY_SIZE:
+                self.socket.sendall(head + bytes(body))
+            elif isinstance(self.socket, ssl.SSLSocket):
+                self.socket.sendall(head)
+                self.socket.sendall(body.getbuffer())
+            else:
+                self._sendmsg([memoryview(head), body.getbuffer()])
+            return
+
+        self.socket.sendall(head)
+        # 平文のソケットには一時ファイルから sendfile() で送る
+        if isinstance(self.socket, ssl.SSLSocket):
+            self.socket.sendall(body.getbuffer())
+        else:
+            self.socket.sendfile(file, 0, len(body))
+
+    def _sendmsg(self, views: list[memoryview]) -> None:
+        # sendmsg() は途中までしか送らないことがある
+        while views:
+            sent = self.socket.sendmsg(views)
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if views:
+                views[0] = views[0][sent:]
+
     def recv_http_body(self, conn: h11.Connection) -> bytes:
-        raw_body = b""
+        # 受信中のボディもメモリの予算に数え、予算がなければ送信側を待たせる
+        received = Buffer()
+        self._recv_http_body(conn, received.write)
+
+        return bytes(received)
+
+    def _recv_http_body(self, conn: h11.Connection, write: Callable[[bytes], None]) -> None:
+        for received_data in self.iter_http_body(conn):
+            write(received_data)
 
+    def iter_http_body(self, conn: h11.Connection) -> Iterator[bytes]:
+        """
+        The rest of the message as it is received, with the transfer coding kept.
+        """
         while True:
             event = conn.next_event()
 
             if event is h11.NEED_DATA:
-                received_data = self.socket.recv(4096)
+                received_data = self.socket.recv(65536)
                 conn.receive_data(received_data)
-                raw_body += received_data
+                if received_data:
+                    yield received_data
 
             if not event:
                 break
@@ -31,23 +107,24 @@ class Tube:
             if type(event) is h11.ConnectionClosed:
                 break
 
-        return raw_body
-
     def recv_http_header(self, conn: h11.Connection) -> bytes:
-        raw_header = b""
+        received: list[bytes] = []
         while True:
             event = conn.next_event()
 
             if event is h11.NEED_DATA:
                 received_data = self.socket.recv(4096)
+                if not received:
+                    self.timing.mark("first_byte")
                 conn.receive_data(received_data)
-                raw_header += received_data
+                received.append(received_data)
             else:
-                return raw_header
+                return b"".join(received)
 
     def recv_raw_http_msg(self, conn: h11.Connection) -> bytes:
         raw_header = self.recv_http_header(conn)
         raw_body = self.recv_http_body(conn)
+        self.timing.mark("response_end")
 
         raw_msg = raw_header + raw_body
 
@@ -56,6 +133,34 @@ class Tube:
     def recv_raw_http_response(self) -> bytes:
         return self.recv_raw_http_msg(h11.Connection(our_role=h11.CLIENT))
 
+    def recv_http_response(self, conn: h11.Connection | None = None) -> tuple[bytes, Buffer]:
+        """
+        The header block and the body as received. A large body spills to a temporary file.
+        conn is the connection from create_client_connection() for the request that was sent.
+        """
+        conn = conn or h11.Connection(our_role=h11.CLIENT)
+        raw_header, remained = self.recv_http_response_head(conn)
+
+        raw_body = Buffer(remained)
+        self._recv_http_body(conn, raw_body.write)
+        self.finish_http_response(conn)
+
+        return raw_header, raw_body
+
+    def recv_http_response_head(self, conn: h11.Connection) -> tuple[bytes, bytes]:
+        """
+        The header block, and the part of the body received with it.
+        The rest is read with iter_http_body(conn), then finish_http_response(conn).
+        """
+        raw_header, sep, remained = self.recv_http_header(conn).partition(b"\r\n\r\n")
+        return raw_header + sep, remained
+
+    def finish_http_response(self, conn: h11.Connection) -> None:
+        self.timing.mark("response_end")
+
+        # Content-Length か chunked で終わりが分かり、Connection: close でなければ次のリクエストに使える
+        self.keep_alive = conn.their_state is h11.DONE
+
     def recv_raw_http_request(self) -> bytes:
         return self.recv_raw_http_msg(h11.Connection(our_role=h11.SERVER))
 
@@ -69,21 +174,60 @@ class Tube:
 
         return raw_response
 
-    def open_connection(self, host: str, port: int, is_ssl: bool, timeout: int = 30) -> None:
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((host, port))
+    def open_connection(
+        self,
+        host: str,
+        port: int,
+        is_ssl: bool,
+        timeout: int = 30,
+        alpn_protocols: list[str] | None = None,
+        ssl_context: ssl.SSLContext | None = None,
+        ssl_session: ssl.SSLSession | None = None,
+    ) -> None:
+        """
+        With ssl_context and ssl_session, the TLS handshake resumes a session of an earlier connection.
+        """
+        dns_resolver = self.dns_resolver or resolver.default_resolver
+
+        self.timing.mark("dns_start")
+        addrinfo = dns_resolver.resolve(host, port)
+        self.timing.mark("dns_end")
+
+        self.timing.mark("connect_start")
+        self.socket = resolver.connect(addrinfo, timeout)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.settimeout(timeout)
+        self.timing.mark("connect_end")
 
         if is_ssl:
-            ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-            ctx.check_hostname = False
-            ctx.verify_mode = ssl.CERT_NONE
-            self.socket = ctx.wrap_socket(self.socket, server_hostname=host)
+            self.timing.mark("tls_start")
+            ctx = ssl_context or create_ssl_context(alpn_protocols)
+            self.socket = ctx.wrap_socket(self.socket, server_hostname=host, session=ssl_session)
+            self.timing.mark("tls_end")
 
     def close(self) -> None:
         self.socket.close()
 
+    def is_readable(self) -> bool:
+        """
+        An idle keep-alive connection becomes readable only when the server has closed it (or sent garbage).
+        """
+        try:
+            readable, _, _ = select.select([self.socket], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def get_ssl_session(self) -> ssl.SSLSession | None:
+        if isinstance(self.socket, ssl.SSLSocket):
+            return self.socket.session
+        return None
+
+    def get_alpn_protocol(self) -> str | None:
+        if isinstance(self.socket, ssl.SSLSocket):
+            return self.socket.selected_alpn_protocol()
+        return None
+
     def set_timeout(self, timeout: int) -> None:
         self.socket.settimeout(timeout)
 
@@ -91,3 +235,12 @@ class Tube:
     def upgrade_socket(self, ctx: ssl.SSLContext) -> None:
         self.socket = ctx.wrap_socket(self.socket, server_side=True)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+
+def create_ssl_context(alpn_protocols: list[str] | None = None) -> ssl.SSLContext:
+    ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    if alpn_protocols:
+        ctx.set_alpn_protocols(alpn_protocols)
+    return ctx
@@ -1,17 +1,153 @@
-def chunked_conv(raw_body: bytes) -> bytes:
-    new_raw_body = b""
-    head = 0
-    while True:
-        res = raw_body.find(b"\r\n", head)
-        try:
-            data_len = int(raw_body[head:res], 16)
-        except ValueError:
-            break
-        if data_len == 0:
+import re
+from collections.abc import Iterable, Iterator
+
+from . import exceptions
+
+MAX_CHUNK_LINE_LENGTH = 4096
+
+# chunk-size = 1*HEXDIG
+CHUNK_SIZE_PATTERN = re.compile(rb"[0-9A-Fa-f]+")
+
+
+class ChunkedDecoder:
+    """
+    RFC 9112: HTTP/1.1
+                Section 7.1. Chunked Transfer Coding
+    https://datatracker.ietf.org/doc/html/rfc9112#section-7.1
+
+    chunked-body   = *chunk
+                     last-chunk
+                     trailer-section
+                     CRLF
+
+    chunk          = chunk-size [ chunk-ext ] CRLF
+                     chunk-data CRLF
+
+    >>> decoder = ChunkedDecoder()
+    >>> decoder.feed(b"5;name=value\r\nhel")
+    [b'hel']
+    >>> decoder.feed(b"lo\r\n0\r\n\r\n")
+    [b'lo']
+    >>> decoder.finished
+    True
+    """
+
+    SIZE = 0
+    DATA = 1
+    DATA_END = 2
+    TRAILER = 3
+    DONE = 4
+
+    trailers: list[bytes]
+    unused_data: bytes
+
+    def __init__(self) -> None:
+        self._state = self.SIZE
+        self._remaining = 0
+        self._buffer = bytearray()
+        self.trailers = []
+        self.unused_data = b""
+
+    @property
+    def finished(self) -> bool:
+        return self._state == self.DONE
+
+    def feed(self, data: bytes) -> list[bytes]:
+        if self._state == self.DONE:
+            self.unused_data += data
+            return []
+
+        chunks: list[bytes] = []
+        buffer = self._buffer
+        buffer += data
+        pos = 0
+
+        while pos < len(buffer) and self._state != self.DONE:
+            if self._state == self.DATA:
+                size = min(self._remaining, len(buffer) - pos)
+                chunks.append(bytes(buffer[pos : pos + size]))
+                pos += size
+                self._remaining -= size
+                if self._remaining == 0:
+                    self._state = self.DATA_END
+
+            elif self._state == self.DATA_END:
+                if len(buffer) - pos < 2:
+                    break
+                if buffer[pos : pos + 2] != b"\r\n":
+                    raise exceptions.ChunkedEncodingError
+                pos += 2
+                self._state = self.SIZE
+
+            else:
+                end = buffer.find(b"\r\n", pos)
+                if end < 0:
+                    if len(buffer) - pos > MAX_CHUNK_LINE_LENGTH:
+                        raise exceptions.ChunkedEncodingError
+                    break
+                line = bytes(buffer[pos:end])
+                pos = end + 2
+
+                if self._state == self.SIZE:
+                    # chunk-ext は読み飛ばす
+                    size_str = line.split(b";", 1)[0].strip()
+                    # int() は "0x1f" や "+5"、"5_0" も受け付けてしまう
+                    if not CHUNK_SIZE_PATTERN.fullmatch(size_str):
+                        raise exceptions.ChunkedEncodingError
+                    self._remaining = int(size_str, 16)
+                    self._state = self.DATA if self._remaining else self.TRAILER
+                elif line:
+                    self.trailers.append(line)
+                else:
+                    self._state = self.DONE
+
+        if self._state == self.DONE:
+            self.unused_data = bytes(buffer[pos:])
+            buffer.clear()
+        else:
+            del buffer[:pos]
+
+        return chunks
+
+
+class ChunkedEncoder:
+    """
+    >>> encoder = ChunkedEncoder()
+    >>> encoder.encode(b"hello")
+    b'5\\r\\nhello\\r\\n'
+    >>> encoder.end()
+    b'0\\r\\n\\r\\n'
+    """
+
+    def encode(self, data: bytes) -> bytes:
+        if not data:
+            return b""
+        return b"".join((b"%x\r\n" % len(data), data, b"\r\n"))
+
+    def end(self, trailers: list[bytes] | None = None) -> bytes:
+        if not trailers:
+            return b"0\r\n\r\n"
+        return b"0\r\n" + b"".join(trailer + b"\r\n" for trailer in trailers) + b"\r\n"
+
+
+def chunked_decode(stream: Iterable[bytes]) -> Iterator[bytes]:
+    decoder = ChunkedDecoder()
+    for data in stream:
+        yield from decoder.feed(data)
+        if decoder.finished:
             break
-        head = res + 2
-        tail = head + data_len
-        new_raw_body += raw_body[head:tail]
-        head = tail + 2
 
-    return new_raw_body
+    if not decoder.finished:
+        raise exceptions.ChunkedEncodingError
+
+
+def chunked_encode(stream: Iterable[bytes]) -> Iterator[bytes]:
+    encoder = ChunkedEncoder()
+    for data in stream:
+        if data:
+            yield encoder.encode(data)
+    yield encoder.end()
+
+
+def chunked_conv(raw_body: bytes) -> bytes:
+    return b"".join(ChunkedDecoder().feed(raw_body))
@@ -2,20 +2,18 @@
 import sys
 import proxy
 from httprequest import PreparedRequest, Response
-from termcolor import colored
 
 
 def request_process(request: PreparedRequest):
     pass
 
 
+# ヘッダーだけを見るフックなら、ボディは受信しながらクライアントへ送られる
+# ボディを読む場合は body=True にする (hosts や content_types で対象を絞れる)
+@proxy.hook(body=False)
 def response_process(response: Response):
-    request = response.request
-
-    print(colored(request.message.method, 'cyan') +
-            ' ' + str(request.get_uri()))
-    print('    ' + colored(response.message.status_code, 'yellow') + ' ' + str(round(len(response.message) /
-            1024, 3)) + ' kB ' + str(round(response.get_roundtrip_time(), 3)) + ' sec\n', end='')
+    # アクセスログは proxy.conf の access_log で、別スレッドから書き出される
+    pass
 
 
 if __name__ == '__main__':
@@ -1 +1,2 @@
+from .hooks import hook
 from .main import run_proxy
@@ -0,0 +1,150 @@
+from httprequest import PreparedRequest, Response
+from collections import deque
+from typing import TextIO
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+
+BUFFER_SIZE = 8192
+BATCH_SIZE = 512
+FLUSH_INTERVAL = 0.5
+TEXT_FORMAT = '{time} {method} {uri} {status} {bytes} {duration} {cache}'
+
+FIELDS = ('time', 'method', 'uri', 'status', 'bytes', 'duration', 'cache')
+
+
+class AccessLog():
+    '''
+    Access log written by a background thread, so a slow terminal, pipe or disk never stalls a flow.
+
+    add() only appends a tuple to a bounded ring buffer. When the buffer is full the oldest record is
+    dropped and counted in dropped, as are the records of a batch that failed to write. The writer
+    formats the records as text or JSON lines and writes them in batches. With a path and max_bytes
+    the file is rotated like logging.handlers.RotatingFileHandler.
+
+    >>> access_log = AccessLog('access.log', 'json', max_bytes=100 * 1024 * 1024, backup_count=5)
+    >>> access_log.add(prepared_request, response)
+    '''
+
+    def __init__(self, path: str | None = None, format: str = 'text', text_format: str = TEXT_FORMAT,
+                 buffer_size: int = BUFFER_SIZE, max_bytes: int = 0, backup_count: int = 5,
+                 flush_interval: float = FLUSH_INTERVAL):
+        if format not in ('text', 'json'):
+            raise ValueError(f'Unknown access log format: {format}')
+
+        self.path = path
+        self.format = format
+        self.text_format = text_format
+        self.buffer_size = buffer_size
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+
+        self.records: deque[tuple] = deque(maxlen=buffer_size)
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.closed = False
+        self.file: TextIO | None = None
+        self.size = 0
+        self.open_file()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def add(self, prepared_request: PreparedRequest, response: Response | None):
+        message = prepared_request.message
+        if response:
+            record = (time.time(), message.method, prepared_request.get_uri(), response.message.status_code,
+                      response.get_size(), response.get_roundtrip_time(), response.cache_status)
+        else:
+            record = (time.time(), message.method, prepared_request.get_uri(), None, 0, None, None)
+        with self.lock:
+            if len(self.records) >= self.buffer_size:
+                # deque(maxlen) が一番古いものを捨てる
+                self.dropped += 1
+            self.records.append(record)
+
+        if len(self.records) >= BATCH_SIZE:
+            self.event.set()
+
+    def run(self):
+        while not self.closed:
+            self.event.wait(self.flush_interval)
+            self.event.clear()
+            self.write_batch()
+
+    def write_batch(self):
+        while self.records:
+            with self.lock:
+                records = [self.records.popleft() for _ in range(min(len(self.records), BATCH_SIZE))]
+            lines = [self.format_record(x) for x in records]
+
+            data = ''.join(lines)
+            try:
+                self.file.write(data)
+                self.file.flush()
+            except (OSError, ValueError):
+                with self.lock:
+                    self.dropped += len(lines)
+                continue
+
+            self.written += len(lines)
+            self.size += len(data)
+            if self.max_bytes and self.size >= self.max_bytes:
+                self.rotate()
+
+    def format_record(self, record: tuple) -> str:
+        fields = dict(zip(FIELDS, record))
+        fields['uri'] = str(fields['uri'])
+        if self.format == 'json':
+            fields['time'] = round(fields['time'], 3)
+            return json.dumps(fields, ensure_ascii=False) + '\n'
+
+        fields['time'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(fields['time']))
+        fields['duration'] = '-' if fields['duration'] is None else '%.3f' % fields['duration']
+        for name in ('status', 'cache'):
+            if fields[name] is None:
+                fields[name] = '-'
+        return self.text_format.format(**fields) + '\n'
+
+    def open_file(self):
+        if not self.path:
+            self.file = sys.stdout
+            return
+
+        self.file = open(self.path, 'at', encoding='utf-8')
+        self.size = self.file.tell()
+
+    def rotate(self):
+        if not self.path:
+            return
+
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f'{self.path}.{i}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{i + 1}')
+        if self.backup_count:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.open_file()
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.event.set()
+        self.thread.join(self.flush_interval + 1)
+        self.write_batch()
+        if self.path and self.file:
+            self.file.close()
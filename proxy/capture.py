@@ -0,0 +1,513 @@
+from httprequest import PreparedRequest, RequestMessage, Response, ResponseMessage
+from array import array
+from collections.abc import Iterator
+
+import atexit
+import hashlib
+import json
+import mmap
+import os
+import queue
+import struct
+import sys
+import threading
+import urllib.parse
+import zlib
+
+
+SEGMENT_SIZE = 256 * 1024 * 1024
+QUEUE_SIZE = 10000
+QUEUE_BYTES = 64 * 1024 * 1024
+BATCH_SIZE = 256
+
+VERSION = 1
+# magic, version
+SEGMENT_HEADER = struct.Struct('<8sI')
+SEGMENT_MAGIC = b'PXCAPSEG'
+# payload length, crc32 of payload
+RECORD_HEADER = struct.Struct('<QI')
+# request time, response time, timing (ns, -1 = None), port, is_ssl, host length, request length, response length
+FLOW_HEADER = struct.Struct('<dd7qHBHQQ')
+# record offset, record length, request time, status, host hash, uri hash
+INDEX_ENTRY = struct.Struct('<QQdHIQ')
+
+TIMING_PHASES = ('dns', 'connect', 'tls', 'request_write', 'ttfb', 'transfer', 'total')
+
+# (name, array typecode)、文字列の列は SegmentSummary.strings への番号
+SUMMARY_COLUMNS = (
+    ('offset', 'Q'),
+    ('time', 'd'),
+    ('status', 'H'),
+    ('method', 'I'),
+    ('host', 'I'),
+    ('path', 'I'),
+    ('size', 'Q'),
+    ('latency', 'q'),
+    ('ttfb', 'q'),
+)
+SUMMARY_STRINGS = ('method', 'host', 'path')
+
+
+def get_host_hash(host: str) -> int:
+    return zlib.crc32(host.lower().encode('utf-8'))
+
+
+def get_uri_hash(uri: str) -> int:
+    return int.from_bytes(hashlib.blake2b(uri.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def get_segment_path(directory: str, segment_id: int, suffix: str) -> str:
+    return os.path.join(directory, f'{segment_id:08d}{suffix}')
+
+
+def list_segments(directory: str) -> list[int]:
+    if not os.path.isdir(directory):
+        return []
+
+    segment_ids = []
+    for name in os.listdir(directory):
+        stem, ext = os.path.splitext(name)
+        if ext == '.seg' and stem.isdigit():
+            segment_ids.append(int(stem))
+
+    return sorted(segment_ids)
+
+
+class CapturedFlow():
+    '''
+    One flow read back from a segment. request and response are views of the mapped segment.
+    '''
+
+    def __init__(self, segment_id: int, offset: int, request_time: float, response_time: float,
+                 timing: dict[str, int | None], host: str, port: int, is_ssl: bool,
+                 request: memoryview, response: memoryview):
+        self.segment_id = segment_id
+        self.offset = offset
+        self.request_time = request_time
+        self.response_time = response_time
+        self.timing = timing
+        self.host = host
+        self.port = port
+        self.is_ssl = is_ssl
+        self.request = request
+        self.response = response
+
+    def get_request_message(self) -> RequestMessage:
+        return RequestMessage(self.request.tobytes())
+
+    def get_response_message(self) -> ResponseMessage:
+        return ResponseMessage(self.response.tobytes())
+
+    def get_prepared_request(self) -> PreparedRequest:
+        return PreparedRequest(self.host, self.port, self.is_ssl, message=self.get_request_message())
+
+
+def get_path(request_target: str) -> str:
+    # absolute-form でも origin-form でもパスだけにする
+    return urllib.parse.urlsplit(request_target).path or '/'
+
+
+class SegmentSummary():
+    '''
+    Columnar summary of one segment, so flows can be filtered without reading the records.
+
+    Every column in SUMMARY_COLUMNS is a compact array with one item per flow. Methods, hosts and
+    paths are stored as numbers into the string tables in strings. Durations are in ns, -1 when unknown.
+
+    The .sum file is a JSON header line, padded to 8 bytes, followed by the raw columns, so a loaded
+    summary is a set of views over the mapped file.
+    '''
+
+    def __init__(self):
+        self.columns: dict[str, array | memoryview] = {name: array(typecode) for name, typecode in SUMMARY_COLUMNS}
+        self.strings: dict[str, list[str]] = {name: [] for name in SUMMARY_STRINGS}
+        self.string_ids: dict[str, dict[str, int]] = {name: {} for name in SUMMARY_STRINGS}
+        # 時間の範囲に掛からないセグメントを飛ばすため
+        self.start_time: float | None = None
+        self.end_time: float | None = None
+
+    def __len__(self) -> int:
+        return len(self.columns['offset'])
+
+    def get_string_id(self, name: str, value: str) -> int:
+        string_ids = self.string_ids[name]
+        if value not in string_ids:
+            string_ids[value] = len(self.strings[name])
+            self.strings[name].append(value)
+        return string_ids[value]
+
+    def add(self, offset: int, request_time: float, status: int, method: str, host: str, path: str, size: int,
+            latency: int | None, ttfb: int | None):
+        values = {
+            'offset': offset,
+            'time': request_time,
+            'status': status,
+            'method': self.get_string_id('method', method),
+            'host': self.get_string_id('host', host.lower()),
+            'path': self.get_string_id('path', path),
+            'size': size,
+            'latency': -1 if latency is None else latency,
+            'ttfb': -1 if ttfb is None else ttfb,
+        }
+        for name, value in values.items():
+            self.columns[name].append(value)
+
+        self.start_time = request_time if self.start_time is None else min(self.start_time, request_time)
+        self.end_time = request_time if self.end_time is None else max(self.end_time, request_time)
+
+    def get_row(self, i: int) -> dict:
+        row = {name: self.columns[name][i] for name, _ in SUMMARY_COLUMNS}
+        for name in SUMMARY_STRINGS:
+            row[name] = self.strings[name][row[name]]
+        return row
+
+    def dump(self, path: str):
+        header = json.dumps({
+            'version': VERSION,
+            'count': len(self),
+            'byteorder': sys.byteorder,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'columns': SUMMARY_COLUMNS,
+            'strings': self.strings,
+        }, ensure_ascii=False).encode('utf-8')
+        # 列が 8 バイト境界から始まるように詰める
+        header += b' ' * (-(len(header) + 1) % 8) + b'\n'
+
+        with open(path + '.tmp', 'wb') as f:
+            f.write(header)
+            for name, _ in SUMMARY_COLUMNS:
+                f.write(self.columns[name])
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path: str) -> 'SegmentSummary':
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        end = data.find(b'\n') + 1
+        header = json.loads(data[:end])
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError(f'{path} was written with another byte order.')
+
+        summary = cls()
+        summary.strings = header['strings']
+        summary.start_time = header['start_time']
+        summary.end_time = header['end_time']
+        summary.string_ids = {name: {x: i for i, x in enumerate(values)} for name, values in summary.strings.items()}
+        view = memoryview(data)
+        position = end
+        for name, typecode in header['columns']:
+            size = header['count'] * array(typecode).itemsize
+            summary.columns[name] = view[position:position + size].cast(typecode)
+            position += size
+
+        return summary
+
+
+class EncodedFlow():
+    '''
+    A flow serialized into its record payload, with the fields the index and summary need.
+    Built on the flow thread, so the queue holds only bytes and not the live request and response.
+    '''
+
+    def __init__(self, prepared_request: PreparedRequest, response: Response):
+        host = prepared_request.host.encode('utf-8')
+        raw_request = bytes(prepared_request.message)
+        head = response.message.get_head()
+        body = response.message.body.get_encoded_buffer().getbuffer()
+
+        timing = []
+        for phase in TIMING_PHASES:
+            duration = getattr(response.timing, phase)
+            timing.append(-1 if duration is None else duration)
+
+        self.request_time = response.request.request_time or response.response_time
+        flow_header = FLOW_HEADER.pack(
+            self.request_time, response.response_time, *timing, prepared_request.port, prepared_request.is_ssl,
+            len(host), len(raw_request), len(head) + len(body))
+        # ボディはここで 1 回だけコピーする
+        self.payload = b''.join((flow_header, host, raw_request, head, body))
+        self.crc = zlib.crc32(self.payload)
+
+        self.status = int(response.message.status_code) if response.message.status_code.isdigit() else 0
+        self.host = prepared_request.host
+        self.method = prepared_request.message.method
+        self.uri = str(prepared_request.get_uri())
+        self.path = get_path(prepared_request.message.request_target)
+        self.size = len(head) + len(body)
+        self.total = response.timing.total
+        self.ttfb = response.timing.ttfb
+
+
+class CaptureStore():
+    '''
+    Append-only store of request/response flows.
+
+    The directory holds numbered segments (.seg) and a sidecar index (.idx) for each of them.
+    A segment is a header followed by records:
+
+        payload length (8) | crc32 (4) | FLOW_HEADER | host | raw request | raw response
+
+    The index holds one fixed-size INDEX_ENTRY per record (offset, length, time, status, host hash,
+    uri hash), so flows can be found without reading the segments. A new segment is started once the
+    current one reaches segment_size, and the oldest are deleted beyond max_segments.
+    A SegmentSummary (.sum) is written when a segment is closed.
+
+    add() serializes the flow and puts the bytes on a queue bounded by queue_size flows and queue_bytes
+    bytes; a background thread writes them. Flows that do not fit, or fail to serialize or write, are
+    counted in dropped.
+
+    >>> store = CaptureStore('captures')
+    >>> store.add(prepared_request, response)
+    '''
+
+    def __init__(self, directory: str, segment_size: int = SEGMENT_SIZE, max_segments: int | None = None,
+                 queue_size: int = QUEUE_SIZE, queue_bytes: int = QUEUE_BYTES):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.queue_bytes = queue_bytes
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.written = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        # 既存のセグメントには追記せず、次の番号から始める
+        segment_ids = list_segments(directory)
+        self.segment_id = segment_ids[-1] + 1 if segment_ids else 1
+        self.segment = None
+        self.index = None
+        self.segment_offset = 0
+        self.summary = SegmentSummary()
+        self.open_segment()
+
+        self.queue: queue.Queue = queue.Queue(queue_size)
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def add(self, prepared_request: PreparedRequest, response: Response):
+        try:
+            flow = EncodedFlow(prepared_request, response)
+        except Exception:
+            with self.lock:
+                self.dropped += 1
+            return
+
+        with self.lock:
+            if self.queued_bytes + len(flow.payload) > self.queue_bytes:
+                self.dropped += 1
+                return
+            try:
+                self.queue.put_nowait(flow)
+            except queue.Full:
+                self.dropped += 1
+                return
+            self.queued_bytes += len(flow.payload)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            items = [item]
+            while len(items) < BATCH_SIZE:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.closed = True
+                    break
+                items.append(item)
+
+            for flow in items:
+                try:
+                    self.write_flow(flow)
+                except Exception:
+                    with self.lock:
+                        self.dropped += 1
+                with self.lock:
+                    self.queued_bytes -= len(flow.payload)
+            try:
+                self.segment.flush()
+                self.index.flush()
+            except Exception:
+                pass
+
+            if self.closed:
+                break
+
+    def write_flow(self, flow: EncodedFlow):
+        length = len(flow.payload)
+        offset = self.segment_offset
+        self.segment.write(RECORD_HEADER.pack(length, flow.crc))
+        self.segment.write(flow.payload)
+        self.segment_offset += RECORD_HEADER.size + length
+
+        self.index.write(INDEX_ENTRY.pack(
+            offset, RECORD_HEADER.size + length, flow.request_time, flow.status, get_host_hash(flow.host),
+            get_uri_hash(flow.uri)))
+        self.summary.add(
+            offset, flow.request_time, flow.status, flow.method, flow.host, flow.path, flow.size, flow.total,
+            flow.ttfb)
+        self.written += 1
+
+        if self.segment_offset >= self.segment_size:
+            self.rotate()
+
+    def open_segment(self):
+        self.segment = open(get_segment_path(self.directory, self.segment_id, '.seg'), 'wb')
+        self.index = open(get_segment_path(self.directory, self.segment_id, '.idx'), 'wb')
+        self.segment.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, VERSION))
+        self.segment_offset = SEGMENT_HEADER.size
+
+    def close_segment(self):
+        self.segment.close()
+        self.index.close()
+        self.summary.dump(get_segment_path(self.directory, self.segment_id, '.sum'))
+        self.summary = SegmentSummary()
+
+    def rotate(self):
+        self.close_segment()
+        self.segment_id += 1
+        self.open_segment()
+
+        if self.max_segments:
+            for segment_id in list_segments(self.directory)[:-self.max_segments]:
+                for suffix in ('.seg', '.idx', '.sum'):
+                    path = get_segment_path(self.directory, segment_id, suffix)
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if not self.segment.closed:
+            self.close_segment()
+
+
+class CaptureReader():
+    '''
+    Reads a capture directory through mmap. Segments still being written are read up to their
+    last complete record.
+
+    >>> reader = CaptureReader('captures')
+    >>> for flow in reader.find(host='example.com', status=500):
+    ...     print(flow.get_request_message())
+    '''
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.maps: dict[tuple[int, str], mmap.mmap] = {}
+
+    def get_segment_ids(self) -> list[int]:
+        return list_segments(self.directory)
+
+    def get_map(self, segment_id: int, suffix: str = '.seg') -> mmap.mmap | None:
+        key = (segment_id, suffix)
+        if key not in self.maps:
+            path = get_segment_path(self.directory, segment_id, suffix)
+            if not os.path.exists(path) or not os.path.getsize(path):
+                return None
+            with open(path, 'rb') as f:
+                self.maps[key] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[key]
+
+    def read_index(self, segment_id: int) -> list[tuple[int, int, float, int, int, int]]:
+        index = self.get_map(segment_id, '.idx')
+        segment = self.get_map(segment_id)
+        if index is None or segment is None:
+            return []
+
+        # 書き込み途中のエントリは読まない
+        size = len(index) - len(index) % INDEX_ENTRY.size
+        entries = []
+        for entry in INDEX_ENTRY.iter_unpack(memoryview(index)[:size]):
+            if entry[0] + entry[1] <= len(segment):
+                entries.append(entry)
+        return entries
+
+    def read(self, segment_id: int, offset: int) -> CapturedFlow:
+        segment = self.get_map(segment_id)
+        if segment is None:
+            raise ValueError(f'Segment {segment_id} does not exist.')
+
+        view = memoryview(segment)
+        length, crc = RECORD_HEADER.unpack_from(view, offset)
+        payload = view[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            raise ValueError(f'Broken record at {segment_id}:{offset}')
+
+        fields = FLOW_HEADER.unpack_from(payload)
+        request_time, response_time = fields[0:2]
+        timing = {phase: (None if value < 0 else value) for phase, value in zip(TIMING_PHASES, fields[2:9])}
+        port, is_ssl, host_length, request_length, response_length = fields[9:]
+
+        position = FLOW_HEADER.size
+        host = payload[position:position + host_length].tobytes().decode('utf-8')
+        position += host_length
+        request = payload[position:position + request_length]
+        position += request_length
+        response = payload[position:position + response_length]
+
+        return CapturedFlow(segment_id, offset, request_time, response_time, timing, host, port, bool(is_ssl),
+                            request, response)
+
+    def get_summary(self, segment_id: int) -> SegmentSummary:
+        '''
+        The .sum file of a closed segment, or a summary built from the records of one still being written.
+        '''
+        path = get_segment_path(self.directory, segment_id, '.sum')
+        if os.path.exists(path):
+            return SegmentSummary.load(path)
+
+        summary = SegmentSummary()
+        for offset, _, request_time, status, _, _ in self.read_index(segment_id):
+            flow = self.read(segment_id, offset)
+            # RequestMessage を作らずにリクエスト行だけ読む
+            request_line = flow.request[:8192].tobytes().split(b'\r\n', 1)[0].decode('utf-8', 'replace')
+            method, _, rest = request_line.partition(' ')
+            request_target = rest.rsplit(' ', 1)[0]
+            summary.add(offset, request_time, status, method, flow.host, get_path(request_target),
+                        len(flow.response), flow.timing['total'], flow.timing['ttfb'])
+
+        return summary
+
+    def find(self, start: float | None = None, end: float | None = None, host: str | None = None,
+             status: int | None = None, uri: str | None = None) -> Iterator[CapturedFlow]:
+        host_hash = get_host_hash(host) if host is not None else None
+        uri_hash = get_uri_hash(uri) if uri is not None else None
+
+        for segment_id in self.get_segment_ids():
+            for offset, _, request_time, entry_status, entry_host, entry_uri in self.read_index(segment_id):
+                if start is not None and request_time < start:
+                    continue
+                if end is not None and request_time >= end:
+                    continue
+                if status is not None and entry_status != status:
+                    continue
+                if host_hash is not None and entry_host != host_hash:
+                    continue
+                if uri_hash is not None and entry_uri != uri_hash:
+                    continue
+
+                flow = self.read(segment_id, offset)
+                # ハッシュの衝突を除く
+                if host is not None and flow.host.lower() != host.lower():
+                    continue
+                yield flow
+
+    def close(self):
+        for segment in self.maps.values():
+            try:
+                segment.close()
+            except BufferError:
+                # CapturedFlow が参照している間は閉じられない
+                pass
+        self.maps = {}
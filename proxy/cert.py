@@ -1,4 +1,5 @@
 from OpenSSL import crypto
+import ipaddress
 import random
 import socket
 import ssl
@@ -48,15 +49,24 @@ def get_target_cert_informations(host, port):
 
     subject = x509.get_subject()
 
-    altname = host.encode('utf-8')
+    altname = get_altname(host)
     for i in range(x509.get_extension_count()):
         x509extension_obj = x509.get_extension(i)
         if x509extension_obj.get_short_name() == b'subjectAltName':
-            altname = str(x509extension_obj).encode('utf-8')
+            # 表示形式の "IP Address:" は設定の書式では "IP:"
+            altname = str(x509extension_obj).replace('IP Address:', 'IP:').encode('utf-8')
 
     return subject, altname
 
 
+def get_altname(host):
+    try:
+        ipaddress.ip_address(host)
+        return b'IP:' + host.encode('utf-8')
+    except ValueError:
+        return b'DNS:' + host.encode('utf-8')
+
+
 def generate_keypair():
     keypair = crypto.PKey()
     keypair.generate_key(crypto.TYPE_RSA, 2048)
@@ -102,7 +112,8 @@ def create_csr(private_key, subject):
     if subject.O is not None: csr.get_subject().O = subject.O
     if subject.OU is not None: csr.get_subject().OU = subject.OU
 
-    csr.set_version(2)
+    # PKCS #10 の version は 0 のみ
+    csr.set_version(0)
     csr.set_pubkey(private_key)
     csr.sign(private_key, 'sha256')
 
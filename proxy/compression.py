@@ -0,0 +1,188 @@
+from httprequest import encoding, Response, ResponseMessage
+from httprequest.http import ResponseBody
+from collections import OrderedDict
+
+import hashlib
+import threading
+
+
+COMPRESSIBLE_TYPES = (
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/x-javascript',
+    'application/manifest+json',
+    'image/svg+xml',
+)
+
+# br を優先する
+SUPPORTED_CODINGS = ('br', 'gzip')
+
+
+def parse_accept_encoding(values: list[str]) -> dict[str, float]:
+    '''
+    RFC 9110: HTTP Semantics
+                Section 12.5.3. Accept-Encoding
+    https://datatracker.ietf.org/doc/html/rfc9110#section-12.5.3
+
+    >>> parse_accept_encoding(['gzip', 'br;q=0.5', 'identity;q=0'])
+    {'gzip': 1.0, 'br': 0.5, 'identity': 0.0}
+    '''
+    codings = {}
+    for value in values:
+        coding, _, params = value.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+
+        q = 1.0
+        for param in params.split(';'):
+            name, _, q_value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(q_value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+
+    return codings
+
+
+def is_compressible(media_type: str) -> bool:
+    media_type = media_type.split(';', 1)[0].strip().lower()
+    if media_type.startswith('text/'):
+        return True
+    if media_type.endswith('+json') or media_type.endswith('+xml'):
+        return True
+
+    return media_type in COMPRESSIBLE_TYPES
+
+
+class CompressedBodyCache():
+    '''
+    LRU of compressed bodies, bounded by the total size of the compressed bytes.
+    '''
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict[tuple, bytes] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple) -> bytes | None:
+        with self.lock:
+            raw_body = self.entries.get(key)
+            if raw_body is not None:
+                self.entries.move_to_end(key)
+            return raw_body
+
+    def put(self, key: tuple, raw_body: bytes):
+        if len(raw_body) > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = raw_body
+            self.size += len(raw_body)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class Compressor():
+    def __init__(self, min_size: int = 1024, max_size: int = 16 * 1024 * 1024, level: int = 6,
+                 brotli_quality: int = 4, cache_size: int = 64 * 1024 * 1024):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.levels = {'gzip': level, 'br': brotli_quality}
+        self.cache = CompressedBodyCache(cache_size) if cache_size else None
+
+    def choose_coding(self, accept_encoding: list[str]) -> str | None:
+        accepted = parse_accept_encoding(accept_encoding)
+        wildcard = accepted.get('*', 0.0)
+
+        best = None
+        best_q = 0.0
+        for coding in SUPPORTED_CODINGS:
+            q = accepted.get(coding, wildcard)
+            if q > best_q:
+                best, best_q = coding, q
+
+        return best
+
+    def is_eligible(self, response: Response) -> bool:
+        request_message = response.request.message
+        response_message = response.message
+        headers = response_message.headers
+
+        if request_message.method == 'HEAD':
+            return False
+        if response_message.status_code in ('204', '206', '304'):
+            return False
+        if 'Content-Encoding' in headers or 'Content-Range' in headers:
+            return False
+        # chunked のまま中継している場合はボディを組み替えない
+        if response_message.is_chunked():
+            return False
+        if 'Cache-Control' in headers and 'no-transform' in headers.get_as_list('Cache-Control'):
+            return False
+        if 'Content-Type' not in headers or not is_compressible(headers['Content-Type']):
+            return False
+
+        return self.min_size <= len(response_message.body) <= self.max_size
+
+    def is_cacheable(self, response_message: ResponseMessage) -> bool:
+        headers = response_message.headers
+        return 'ETag' in headers or 'Last-Modified' in headers
+
+    def compress(self, content: bytes, coding: str) -> bytes:
+        encoder = encoding.get_encoder(coding, self.levels[coding])
+        chunks = [encoder.compress(content[i:i + encoding.CHUNK_SIZE])
+                  for i in range(0, len(content), encoding.CHUNK_SIZE)]
+        chunks.append(encoder.flush())
+
+        return b''.join(chunks)
+
+    def process(self, response: Response | None):
+        if not response or not self.is_eligible(response):
+            return
+
+        request_headers = response.request.message.headers
+        if 'Accept-Encoding' not in request_headers:
+            return
+
+        coding = self.choose_coding(request_headers.get_as_list('Accept-Encoding'))
+        if not coding:
+            return
+
+        response_message = response.message
+        content = bytes(response_message.body)
+
+        key = None
+        raw_body = None
+        if self.cache and self.is_cacheable(response_message):
+            key = (coding, self.levels[coding], hashlib.blake2b(content, digest_size=16).digest())
+            raw_body = self.cache.get(key)
+
+        if raw_body is None:
+            raw_body = self.compress(content, coding)
+            if key:
+                self.cache.put(key, raw_body)
+
+        if len(raw_body) >= len(content):
+            return
+
+        headers = response_message.headers
+        response_message.body = ResponseBody(raw_body, response_message.body.media_type, coding)
+        headers['Content-Encoding'] = coding
+        headers['Content-Length'] = str(len(raw_body))
+        if 'Vary' not in headers:
+            headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in (x.lower() for x in headers.get_as_list('Vary')):
+            headers.add('Vary', 'Accept-Encoding')
+
+        # 圧縮後は別の表現になるので強い ETag は弱い ETag にする
+        if 'ETag' in headers and not headers['ETag'].startswith('W/'):
+            headers['ETag'] = 'W/' + headers['ETag']
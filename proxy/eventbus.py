@@ -0,0 +1,295 @@
+from httprequest import PreparedRequest, Response
+from collections import deque
+
+import atexit
+import os
+import socket
+import struct
+import threading
+
+
+QUEUE_SIZE = 10000
+QUEUE_BYTES = 64 * 1024 * 1024
+BATCH_SIZE = 256
+MAX_BODY_SIZE = 1024 * 1024
+
+VERSION = 1
+# magic, version
+STREAM_HEADER = struct.Struct('<8sI')
+STREAM_MAGIC = b'PXEVENTS'
+# payload length, event count
+BATCH_HEADER = struct.Struct('<II')
+# request time, response time, total, ttfb (ns, -1 = None), response bytes, port, status, flags,
+# then the lengths of method, host, uri, request head, response head, request body, response body
+EVENT_HEADER = struct.Struct('<ddqqQHHBBHIIIII')
+
+FLAG_SSL = 1
+FLAG_NO_RESPONSE = 2
+FLAG_REQUEST_BODY = 4
+FLAG_RESPONSE_BODY = 8
+FLAG_TRUNCATED = 16
+
+
+class FlowEvent():
+    '''
+    One flow as published by EventBus. The heads and bodies are raw bytes; the bodies are b'' unless
+    the bus includes them (see flags), and are cut at the bus's max_body_size.
+    '''
+
+    def __init__(self, request_time: float, response_time: float, total: int | None, ttfb: int | None,
+                 size: int, port: int, status: int, flags: int, method: str, host: str, uri: str,
+                 request_head: bytes, response_head: bytes, request_body: bytes, response_body: bytes):
+        self.request_time = request_time
+        self.response_time = response_time
+        self.total = total
+        self.ttfb = ttfb
+        self.size = size
+        self.port = port
+        self.status = status
+        self.flags = flags
+        self.method = method
+        self.host = host
+        self.uri = uri
+        self.request_head = request_head
+        self.response_head = response_head
+        self.request_body = request_body
+        self.response_body = response_body
+
+    @property
+    def is_ssl(self) -> bool:
+        return bool(self.flags & FLAG_SSL)
+
+    @classmethod
+    def decode(cls, data: memoryview, offset: int) -> tuple['FlowEvent', int]:
+        # (イベント, 次のイベントの位置)
+        (request_time, response_time, total, ttfb, size, port, status, flags,
+         *lengths) = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+
+        parts = []
+        for length in lengths:
+            parts.append(data[offset:offset + length].tobytes())
+            offset += length
+        method, host, uri = (x.decode('utf-8') for x in parts[:3])
+
+        event = cls(request_time, response_time, None if total < 0 else total, None if ttfb < 0 else ttfb,
+                    size, port, status, flags, method, host, uri, *parts[3:])
+        return event, offset
+
+    def to_dict(self) -> dict:
+        return {
+            'time': self.request_time, 'method': self.method, 'uri': self.uri, 'status': self.status,
+            'bytes': self.size, 'total': self.total, 'ttfb': self.ttfb,
+            'request_body': len(self.request_body), 'response_body': len(self.response_body),
+        }
+
+
+def encode_event(prepared_request: PreparedRequest, response: Response | None, include_bodies: bool,
+                 max_body_size: int) -> bytes:
+    message = prepared_request.message
+    flags = FLAG_SSL if prepared_request.is_ssl else 0
+    request_head = message.get_request_line().encode('utf-8') + bytes(message.headers) + b'\r\n'
+    request_body = b''
+    if include_bodies and message.body:
+        request_body = bytes(message.body)
+        flags |= FLAG_REQUEST_BODY
+
+    if response:
+        response_head = response.message.get_head()
+        response_body = b''
+        # 受信しながらクライアントへ送ったボディは残っていない
+        if include_bodies and response.stream is None:
+            response_body = response.message.body.get_encoded_buffer().getbuffer()
+            flags |= FLAG_RESPONSE_BODY
+        request_time = response.request.request_time or response.response_time
+        response_time = response.response_time
+        total, ttfb = response.timing.total, response.timing.ttfb
+        status = int(response.message.status_code) if response.message.status_code.isdigit() else 0
+        size = response.get_size()
+    else:
+        flags |= FLAG_NO_RESPONSE
+        response_head = response_body = b''
+        request_time = response_time = 0.0
+        total = ttfb = None
+        status = size = 0
+
+    if len(request_body) > max_body_size or len(response_body) > max_body_size:
+        flags |= FLAG_TRUNCATED
+        request_body = request_body[:max_body_size]
+        response_body = response_body[:max_body_size]
+
+    parts = (message.method.encode('utf-8'), prepared_request.host.encode('utf-8'),
+             str(prepared_request.get_uri()).encode('utf-8'), request_head, response_head,
+             request_body, response_body)
+    header = EVENT_HEADER.pack(
+        request_time, response_time, -1 if total is None else total, -1 if ttfb is None else ttfb,
+        size, prepared_request.port, status, flags, *(len(x) for x in parts))
+
+    return b''.join((header, *parts))
+
+
+class Subscriber():
+    '''
+    A connected subscriber and its queue of encoded events, bounded by count and by bytes.
+    '''
+
+    def __init__(self, sock: socket.socket, queue_size: int, queue_bytes: int):
+        self.socket = sock
+        self.queue_size = queue_size
+        self.queue_bytes = queue_bytes
+        self.events: deque[bytes] = deque()
+        self.queued_bytes = 0
+        self.condition = threading.Condition()
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, event: bytes):
+        with self.condition:
+            if self.closed:
+                return
+            if len(self.events) >= self.queue_size or self.queued_bytes + len(event) > self.queue_bytes:
+                self.dropped += 1
+                return
+            self.events.append(event)
+            self.queued_bytes += len(event)
+            self.condition.notify()
+
+    def get_batch(self) -> list[bytes]:
+        # 溜まっている分をまとめて取り出す。閉じられて空になったら []
+        with self.condition:
+            while not self.events and not self.closed:
+                self.condition.wait()
+            events = [self.events.popleft() for _ in range(min(len(self.events), BATCH_SIZE))]
+            self.queued_bytes -= sum(len(x) for x in events)
+        return events
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class EventBus():
+    '''
+    Publishes flows to other processes over a Unix domain socket, so analyzers run at their own pace
+    instead of inside the flow.
+
+    A subscriber connects to path and reads a STREAM_HEADER, then batches: a BATCH_HEADER (payload
+    length, event count) followed by that many events, each an EVENT_HEADER and its variable-length
+    fields (see encode_event). Bodies are included only with include_bodies, up to max_body_size each.
+
+    publish() encodes the flow once on the calling thread, so no live request or response is kept,
+    and puts the bytes on the queue of each subscriber. The queues are bounded by queue_size events
+    and queue_bytes bytes, and a thread per subscriber writes them in batches, so a slow subscriber
+    only loses its own events: they are counted in its dropped. Flows that fail to encode are counted
+    in the bus's dropped. Nothing is encoded while no subscriber is connected.
+
+    >>> bus = EventBus('events.sock', include_bodies=True)
+    >>> bus.publish(prepared_request, response)
+
+    Subscribers read them with proxy.subscribe.read_events().
+    '''
+
+    def __init__(self, path: str, queue_size: int = QUEUE_SIZE, queue_bytes: int = QUEUE_BYTES,
+                 include_bodies: bool = False, max_body_size: int = MAX_BODY_SIZE):
+        self.path = path
+        self.queue_size = queue_size
+        self.queue_bytes = queue_bytes
+        self.include_bodies = include_bodies
+        self.max_body_size = max_body_size
+        self.dropped = 0
+        self.published = 0
+
+        self.subscribers: list[Subscriber] = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+        # 前回のプロセスが残したソケットファイルを消す
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+
+        threading.Thread(target=self.accept, daemon=True).start()
+        atexit.register(self.close)
+
+    def publish(self, prepared_request: PreparedRequest, response: Response | None):
+        if not self.subscribers:
+            return
+
+        # メソッドが長すぎるなど、どんな失敗でもフローは止めない
+        try:
+            event = encode_event(prepared_request, response, self.include_bodies, self.max_body_size)
+        except Exception:
+            with self.lock:
+                self.dropped += 1
+            return
+
+        with self.lock:
+            self.published += 1
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+    def accept(self):
+        while not self.closed:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                break
+
+            subscriber = Subscriber(sock, self.queue_size, self.queue_bytes)
+            with self.lock:
+                self.subscribers.append(subscriber)
+            threading.Thread(target=self.send, args=(subscriber,), daemon=True).start()
+
+    def send(self, subscriber: Subscriber):
+        try:
+            subscriber.socket.sendall(STREAM_HEADER.pack(STREAM_MAGIC, VERSION))
+            while True:
+                events = subscriber.get_batch()
+                if not events:
+                    break
+
+                # 溜まっている分をまとめて 1 回で書く
+                payload = b''.join(events)
+                subscriber.socket.sendall(BATCH_HEADER.pack(len(payload), len(events)) + payload)
+                subscriber.sent += len(events)
+        except OSError:
+            # 購読側が切断した
+            pass
+        finally:
+            subscriber.close()
+            with self.lock:
+                if subscriber in self.subscribers:
+                    self.subscribers.remove(subscriber)
+            subscriber.socket.close()
+
+    def get_subscriber_dropped(self) -> int:
+        return sum(x.dropped for x in list(self.subscribers))
+
+    def get_queued(self) -> int:
+        return sum(len(x.events) for x in list(self.subscribers))
+
+    def get_stats(self) -> dict:
+        return {
+            'published': self.published,
+            'dropped': self.dropped,
+            'subscribers': [{'sent': x.sent, 'dropped': x.dropped, 'queued': len(x.events)}
+                            for x in list(self.subscribers)],
+        }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        self.server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        # 各購読者のスレッドは残りを書いてから終わる
+        for subscriber in list(self.subscribers):
+            subscriber.close()
@@ -0,0 +1,279 @@
+from httprequest.http import RequestMaster
+from proxy.metrics import Metrics
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+import asyncio
+import atexit
+import fnmatch
+import inspect
+import threading
+import time
+import traceback
+
+
+WORKERS = 4
+QUEUE_SIZE = 1000
+CLOSE_TIMEOUT = 30.0
+OVERFLOW_POLICIES = ('drop', 'queue')
+STAGES = ('request', 'response')
+
+
+def hook(function: Callable | None = None, *, offload: bool = False, name: str | None = None,
+         hosts: list[str] | None = None, methods: list[str] | None = None,
+         content_types: list[str] | None = None, body: bool = True):
+    '''
+    Marks a hook for run_proxy. An offloaded hook only observes the flow and runs outside of it.
+
+    hosts, methods and content_types declare the flows the hook is interested in, and it is not called
+    for the others. hosts are patterns like '*.example.com', and content_types media types like
+    'application/json' or 'text/*', of the request for a request hook and of the response for a response
+    hook. A response hook with body=False reads only the status line and headers: the body of a response
+    that no interested hook reads is relayed to the client as it is received, without being buffered.
+
+    >>> @hook(offload=True)
+    ... async def response_process(response):
+    ...     await database.insert(response)
+
+    >>> @hook(hosts=['api.example.com'], content_types=['application/json'])
+    ... def response_process(response):
+    ...     check(response.message.body.get_json())
+    '''
+    def decorate(function: Callable) -> Callable:
+        function.hook_options = {
+            'offload': offload, 'name': name, 'hosts': hosts, 'methods': methods,
+            'content_types': content_types, 'body': body,
+        }
+        return function
+
+    return decorate(function) if function else decorate
+
+
+class Hook():
+    def __init__(self, function: Callable, offload: bool | None = None, name: str | None = None,
+                 hosts: list[str] | None = None, methods: list[str] | None = None,
+                 content_types: list[str] | None = None, body: bool | None = None):
+        options = getattr(function, 'hook_options', {})
+        self.function = function
+        self.offload = options.get('offload', False) if offload is None else offload
+        self.name = name or options.get('name') or getattr(function, '__qualname__', repr(function))
+        self.hosts = [x.lower() for x in hosts or options.get('hosts') or []]
+        self.methods = [x.upper() for x in methods or options.get('methods') or []]
+        self.content_types = [x.lower() for x in content_types or options.get('content_types') or []]
+        self.body = options.get('body', True) if body is None else body
+        self.is_coroutine = inspect.iscoroutinefunction(function)
+        self.calls = 0
+        self.errors = 0
+        self.dropped = 0
+        # 関心の対象外で呼ばなかったフロー
+        self.skipped = 0
+        # ns
+        self.total_time = 0
+
+    def matches(self, request: RequestMaster | None, message=None) -> bool:
+        '''
+        Whether the hook is interested in the flow of request. The content_types filter is checked
+        against message (the request or response message) only when it is given.
+        '''
+        if request is None:
+            return not (self.hosts or self.methods or self.content_types)
+
+        if self.hosts and not any(fnmatch.fnmatchcase(request.host.lower(), x) for x in self.hosts):
+            return False
+        if self.methods and request.message.method not in self.methods:
+            return False
+        if self.content_types and message is not None:
+            media_type = message.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if not any(fnmatch.fnmatchcase(media_type, x) for x in self.content_types):
+                return False
+
+        return True
+
+
+def get_flow(stage: str, flow) -> tuple[RequestMaster | None, object]:
+    # (リクエスト, ステージのメッセージ)
+    if flow is None:
+        return None, None
+    if stage == 'request':
+        return flow, flow.message
+    return flow.request, flow.message
+
+
+def get_hooks(hooks: Callable | Hook | list | tuple | None) -> list[Hook]:
+    if hooks is None:
+        return []
+    if not isinstance(hooks, (list, tuple)):
+        hooks = [hooks]
+    return [x if isinstance(x, Hook) else Hook(x) for x in hooks if x is not None]
+
+
+class HookRunner():
+    '''
+    Runs the request and response hooks given to run_proxy. Each stage takes a function, a coroutine
+    function, or a list of them.
+
+    Inline hooks run in the flow, in order, and may modify the request or response. A coroutine hook
+    runs on the runner's event loop while the connection thread waits for it.
+
+    Offloaded hooks (see hook()) must only observe. They are queued to a pool of workers, or to the
+    event loop for coroutines, and the flow does not wait for them: response hooks are queued once the
+    response is ready, so they run while it is sent to the client. At most queue_size offloaded calls
+    are pending; beyond that, overflow 'drop' drops the call and counts it in dropped, and 'queue' makes
+    the flow wait for a free slot.
+
+    A hook is called only for the flows its filters match (see hook()), and needs_body() tells the
+    proxy whether any of them reads the body of a response.
+
+    The time spent in every hook is recorded as proxy_hook_duration_seconds when metrics are enabled.
+    close(), also called at exit, waits up to CLOSE_TIMEOUT seconds for the pending offloaded calls.
+
+    >>> runner = HookRunner([check_request], [save_to_database], workers=4, overflow='drop')
+    >>> runner.run_inline('request', prepared_request)
+    >>> runner.offload('response', response)
+    '''
+
+    def __init__(self, request_hooks=None, response_hooks=None, workers: int = WORKERS,
+                 queue_size: int = QUEUE_SIZE, overflow: str = 'drop', metrics: Metrics | None = None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown hook overflow policy: {overflow}')
+
+        self.hooks = {'request': get_hooks(request_hooks), 'response': get_hooks(response_hooks)}
+        self.overflow = overflow
+        self.metrics = metrics
+        self.dropped = 0
+        # 実行中か待機中の offload 呼び出し
+        self.pending = 0
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.closed = False
+
+        hooks = self.hooks['request'] + self.hooks['response']
+        self.executor = None
+        if any(x.offload and not x.is_coroutine for x in hooks):
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hook')
+
+        self.loop = None
+        if any(x.is_coroutine for x in hooks):
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, name='hook-loop', daemon=True).start()
+        atexit.register(self.close)
+
+    def run_inline(self, stage: str, flow):
+        request, message = get_flow(stage, flow)
+        for hook in self.hooks[stage]:
+            if hook.offload:
+                continue
+            if not hook.matches(request, message):
+                hook.skipped += 1
+                continue
+
+            start = time.perf_counter_ns()
+            try:
+                if hook.is_coroutine:
+                    asyncio.run_coroutine_threadsafe(hook.function(flow), self.loop).result()
+                else:
+                    hook.function(flow)
+            except Exception:
+                self.add_error(hook, stage)
+                raise
+            finally:
+                self.record(hook, stage, 'inline', start)
+
+    def offload(self, stage: str, flow):
+        request, message = get_flow(stage, flow)
+        for hook in self.hooks[stage]:
+            if not hook.offload:
+                continue
+            if not hook.matches(request, message):
+                hook.skipped += 1
+                continue
+
+            if not self.slots.acquire(blocking=self.overflow == 'queue'):
+                hook.dropped += 1
+                self.dropped += 1
+                if self.metrics:
+                    self.metrics.inc('proxy_hook_dropped_total', (hook.name, stage))
+                continue
+
+            with self.lock:
+                self.pending += 1
+            try:
+                if hook.is_coroutine:
+                    future = asyncio.run_coroutine_threadsafe(self.call_coroutine(hook, stage, flow), self.loop)
+                else:
+                    future = self.executor.submit(self.call, hook, stage, flow)
+            except RuntimeError:
+                # 終了処理中
+                self.release()
+                continue
+            future.add_done_callback(self.release)
+
+    def needs_body(self, request: RequestMaster, message=None) -> bool:
+        '''
+        Whether a response hook interested in the flow reads the response body. Without the response
+        message, hooks filtering on content types are counted as interested.
+        '''
+        return any(x.body and x.matches(request, message) for x in self.hooks['response'])
+
+    def release(self, future: Future | None = None):
+        with self.lock:
+            self.pending -= 1
+            if not self.pending:
+                self.idle.notify_all()
+        self.slots.release()
+
+    def call(self, hook: Hook, stage: str, flow):
+        start = time.perf_counter_ns()
+        try:
+            hook.function(flow)
+        except Exception:
+            self.add_error(hook, stage)
+            traceback.print_exc()
+        finally:
+            self.record(hook, stage, 'offload', start)
+
+    async def call_coroutine(self, hook: Hook, stage: str, flow):
+        start = time.perf_counter_ns()
+        try:
+            await hook.function(flow)
+        except Exception:
+            self.add_error(hook, stage)
+            traceback.print_exc()
+        finally:
+            self.record(hook, stage, 'offload', start)
+
+    def add_error(self, hook: Hook, stage: str):
+        hook.errors += 1
+        if self.metrics:
+            self.metrics.inc('proxy_hook_errors_total', (hook.name, stage))
+
+    def record(self, hook: Hook, stage: str, mode: str, start: int):
+        duration = time.perf_counter_ns() - start
+        hook.calls += 1
+        hook.total_time += duration
+        if self.metrics:
+            self.metrics.observe('proxy_hook_duration_seconds', duration / 1e9, (hook.name, stage, mode))
+
+    def get_stats(self) -> dict[str, dict]:
+        return {
+            f'{stage}:{hook.name}': {
+                'offload': hook.offload, 'calls': hook.calls, 'errors': hook.errors, 'dropped': hook.dropped,
+                'skipped': hook.skipped,
+                'mean': hook.total_time / hook.calls / 1e9 if hook.calls else None,
+            }
+            for stage in STAGES for hook in self.hooks[stage]
+        }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        # 待っている offload 呼び出しを終えてから止める
+        with self.idle:
+            self.idle.wait_for(lambda: not self.pending, CLOSE_TIMEOUT)
+        if self.executor:
+            self.executor.shutdown(wait=True)
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,235 @@
+from httprequest import Tube, Headers, RequestMessage, PreparedRequest, util
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+import h2.settings
+import selectors
+import socket
+import ssl
+import threading
+import traceback
+
+
+MAX_CONCURRENT_STREAMS = 100
+RECV_SIZE = 65536
+
+# RFC 9113 Section 8.2.2. Connection-Specific Header Fields
+CONNECTION_SPECIFIC_HEADERS = ('connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade')
+
+
+class PendingResponse():
+    def __init__(self, body: bytes):
+        self.body = memoryview(body)
+        self.offset = 0
+
+
+class H2ServerConnection():
+    '''
+    RFC 9113: HTTP/2
+    https://datatracker.ietf.org/doc/html/rfc9113
+
+    Serves the HTTP/2 streams of one intercepted client connection.
+    The handler thread owns the socket, every stream is passed to communicate() on a worker thread,
+    and the response bodies are written as the flow control windows allow.
+    '''
+
+    def __init__(self, tube: Tube, host: str, port: int, communicate: Callable):
+        self.tube = tube
+        self.socket = tube.socket
+        self.host = host
+        self.port = port
+        self.communicate = communicate
+
+        self.conn = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False, header_encoding='utf-8'))
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_STREAMS)
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+
+    def serve(self):
+        with self.lock:
+            self.conn.initiate_connection()
+            self.conn.update_settings({h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: MAX_CONCURRENT_STREAMS})
+
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.socket.setblocking(False)
+
+        try:
+            while True:
+                self.flush()
+                for key, _ in selector.select():
+                    if key.fileobj is self.wakeup_r:
+                        try:
+                            while self.wakeup_r.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    elif not self.receive():
+                        return
+        except (OSError, h2.exceptions.ProtocolError):
+            return
+        finally:
+            selector.close()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.wakeup_r.close()
+            self.wakeup_w.close()
+
+    def receive(self):
+        while True:
+            try:
+                data = self.socket.recv(RECV_SIZE)
+            except (BlockingIOError, ssl.SSLWantReadError):
+                return True
+
+            if not data:
+                return False
+
+            with self.lock:
+                events = self.conn.receive_data(data)
+
+            for event in events:
+                if isinstance(event, h2.events.ConnectionTerminated):
+                    return False
+                self.handle_event(event)
+
+            if not self.socket.pending():
+                return True
+
+    def handle_event(self, event):
+        if isinstance(event, h2.events.RequestReceived):
+            self.requests[event.stream_id] = [event.headers, []]
+        elif isinstance(event, h2.events.DataReceived):
+            if event.stream_id in self.requests:
+                self.requests[event.stream_id][1].append(event.data)
+            with self.lock:
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            if event.stream_id in self.requests:
+                headers, data = self.requests.pop(event.stream_id)
+                self.executor.submit(self.process_stream, event.stream_id, headers, b''.join(data))
+        elif isinstance(event, h2.events.StreamReset):
+            self.requests.pop(event.stream_id, None)
+            with self.lock:
+                self.pending.pop(event.stream_id, None)
+
+    def process_stream(self, stream_id, headers, raw_body):
+        try:
+            request_message = self.to_request_message(headers, raw_body)
+            prepared_request = PreparedRequest(self.host, self.port, True, message=request_message)
+            response = self.communicate(prepared_request)
+        except Exception as e:
+            verbose = traceback.format_exc()
+            verbose += ''.join([str(x) for x in e.args])
+            print(verbose)
+            response = None
+
+        if response:
+            status, response_headers, body = self.from_response(response)
+        else:
+            status, response_headers, body = '502', [], b''
+
+        self.send_response(stream_id, status, response_headers, body)
+
+    def to_request_message(self, headers, raw_body):
+        pseudo = {}
+        fields = []
+        for key, value in headers:
+            if key.startswith(':'):
+                pseudo[key] = value
+            elif key == 'cookie' and any(x[0] == 'Cookie' for x in fields):
+                # HTTP/2 では cookie が分割されて届く
+                index = next(i for i, x in enumerate(fields) if x[0] == 'Cookie')
+                fields[index] = ('Cookie', fields[index][1] + '; ' + value)
+            else:
+                fields.append(('Cookie' if key == 'cookie' else key, value))
+
+        fields.insert(0, ('Host', pseudo.get(':authority', self.host)))
+        if raw_body and not any(x[0].lower() == 'content-length' for x in fields):
+            fields.append(('Content-Length', str(len(raw_body))))
+
+        request_message = RequestMessage(
+            method=pseudo[':method'], request_target=pseudo.get(':path', '/'), http_version='HTTP/2')
+        request_message.headers = Headers(fields)
+        if raw_body:
+            request_message.set_body(raw_body)
+
+        return request_message
+
+    def from_response(self, response):
+        message = response.message
+        body = message.body.get_encoded_buffer().getbuffer()
+        is_chunked = message.is_chunked()
+        if is_chunked:
+            body = util.chunked_conv(body.tobytes())
+
+        headers = []
+        for key in message.headers:
+            name = key.lower()
+            if name in CONNECTION_SPECIFIC_HEADERS:
+                continue
+            if name == 'content-length' and is_chunked:
+                continue
+            headers.append((name, message.headers[key]))
+        if is_chunked:
+            headers.append(('content-length', str(len(body))))
+
+        return message.status_code, headers, body
+
+    def send_response(self, stream_id, status, headers, body):
+        with self.lock:
+            try:
+                self.conn.send_headers(stream_id, [(':status', str(status))] + headers, end_stream=not body)
+            except h2.exceptions.ProtocolError:
+                return
+            if body:
+                self.pending[stream_id] = PendingResponse(body)
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_w.send(b'\0')
+        except OSError:
+            pass
+
+    def flush(self):
+        with self.lock:
+            # フロー制御ウィンドウが許す分だけ送る
+            for stream_id, pending in list(self.pending.items()):
+                try:
+                    while pending.offset < len(pending.body):
+                        size = min(self.conn.local_flow_control_window(stream_id),
+                                   self.conn.max_outbound_frame_size,
+                                   len(pending.body) - pending.offset)
+                        if size <= 0:
+                            break
+                        chunk = pending.body[pending.offset:pending.offset + size].tobytes()
+                        pending.offset += size
+                        self.conn.send_data(stream_id, chunk, end_stream=pending.offset == len(pending.body))
+                except h2.exceptions.ProtocolError:
+                    del self.pending[stream_id]
+                    continue
+
+                if pending.offset == len(pending.body):
+                    del self.pending[stream_id]
+
+            data = self.conn.data_to_send()
+
+        if data:
+            self.socket.setblocking(True)
+            try:
+                self.socket.sendall(data)
+            finally:
+                self.socket.setblocking(False)
+
+
+def serve(tube: Tube, host: str, port: int, communicate: Callable):
+    H2ServerConnection(tube, host, port, communicate).serve()
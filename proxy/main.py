@@ -1,24 +1,94 @@
-from httprequest import Tube, exceptions, RequestMessage, PreparedRequest, Request
+from httprequest import Tube, buffer, cache, encoding, exceptions, resolver, RequestMessage, PreparedRequest, Request
 from proxy import util
 from proxy import cert
+from proxy import http2
+from proxy.accesslog import AccessLog
+from proxy.capture import CaptureStore
+from proxy.compression import Compressor
+from proxy.eventbus import EventBus
+from proxy.hooks import HookRunner
+from proxy.metrics import Metrics
+from proxy.profiler import FlowProfiler, SamplingProfiler
+from proxy.trace import Tracer
+from proxy import accesslog
+from proxy import capture
+from proxy import eventbus
+from proxy import hooks
+from proxy import metrics
+from proxy import profiler
+from proxy import trace
 from typing import Callable
 
 import base64
 import tempfile
+import signal
 import socketserver
 import traceback
 import ssl
 import json
+import time
 import os
 import re
 
 class Config():
     host: str
     port: int
+    listen_backlog: int
     auth: bool
     private_key_path: str
     cacert_path: str
     auth_base64: str
+    chunked_passthrough: bool
+    decode_content: bool
+    stream_responses: bool
+    max_decoded_size: int | None
+    max_decode_ratio: float | None
+    compress: bool
+    compress_min_size: int
+    compress_level: int
+    compress_brotli_quality: int
+    compress_cache_size: int
+    dns_ttl: float
+    dns_negative_ttl: float
+    dns_stale_ttl: float
+    body_spill_threshold: int | None
+    memory_budget: int | None
+    memory_budget_wait: float
+    upstream_http2: bool
+    client_http2: bool
+    metrics_host: str
+    metrics_port: int | None
+    access_log: bool
+    access_log_path: str | None
+    access_log_format: str
+    access_log_buffer_size: int
+    access_log_max_bytes: int
+    access_log_backup_count: int
+    capture: bool
+    capture_dir: str
+    capture_segment_size: int
+    capture_max_segments: int | None
+    capture_queue_size: int
+    capture_queue_bytes: int
+    event_bus: bool
+    event_bus_path: str
+    event_bus_queue_size: int
+    event_bus_queue_bytes: int
+    event_bus_bodies: bool
+    event_bus_max_body_size: int
+    trace: bool
+    trace_max_flows: int
+    profile_dir: str
+    profile_seconds: float
+    profile_flow_rate: float
+    hook_workers: int
+    hook_queue_size: int
+    hook_overflow: str
+    cache: bool
+    cache_memory_size: int
+    cache_dir: str | None
+    cache_disk_size: int
+    cache_collapse_timeout: float | None
 
 config: Config = Config()
 
@@ -34,13 +104,111 @@ mycert: MyCert = MyCert()
 
 
 class TCPHandler(socketserver.BaseRequestHandler):
-    def communicate(self, prepared_request: PreparedRequest):
-        self.server.request_process(prepared_request)
-        response = prepared_request.send()
-        self.server.response_process(response)
+    def setup(self):
+        # プロキシ内部で掛かった区間 (name, start, end)、レスポンスの timing に記録する
+        self.spans = []
+        if self.server.metrics:
+            self.server.metrics.inc('proxy_client_connections')
+
+    def finish(self):
+        if self.server.metrics:
+            self.server.metrics.inc('proxy_client_connections', value=-1)
+
+    def communicate(self, prepared_request: PreparedRequest, tube: Tube | None = None):
+        # プロファイル中は一部のフローを cProfile の下で動かす
+        return self.server.flow_profiler.run(self.relay, prepared_request, tube)
+
+    def can_stream(self) -> bool:
+        # ボディを扱う処理があればレスポンスを受信し切ってから送る
+        server = self.server
+        return config.stream_responses and not (
+            config.decode_content or server.cache or server.compressor or server.capture
+            or (server.event_bus and server.event_bus.include_bodies))
+
+    def relay(self, prepared_request: PreparedRequest, tube: Tube | None = None):
+        """
+        With the client's tube (HTTP/1.1 clients), a response body that no hook reads is relayed to the
+        client as it is received, and response.stream is left set; the caller sends any other response.
+        """
+        # HTTP/2 では複数のストリームから同時に呼ばれる
+        spans = list(self.spans)
+
+        start = time.perf_counter_ns()
+        self.server.hooks.run_inline('request', prepared_request)
+        spans.append(('request_hook', start, time.perf_counter_ns()))
+        self.server.hooks.offload('request', prepared_request)
+
+        send = self.server.cache.send if self.server.cache else PreparedRequest.send
+        options = {'stream': True} if tube is not None and self.can_stream() else {}
+        if self.server.metrics:
+            self.server.metrics.inc('proxy_upstream_requests')
+        try:
+            response = send(
+                prepared_request, decode_chunked=not config.chunked_passthrough, decode_content=config.decode_content,
+                use_http2=config.upstream_http2, **options)
+        finally:
+            if self.server.metrics:
+                self.server.metrics.inc('proxy_upstream_requests', value=-1)
+        if response:
+            for span in spans:
+                response.timing.add_span(*span)
+
+        # read_body() の後も、フックが例外を投げても、上流の接続は必ず閉じる
+        stream = response.stream if response else None
+        try:
+            # ボディを読むフックが関心を持つレスポンスだけ受信し切る
+            if stream and self.server.hooks.needs_body(prepared_request, response.message):
+                response.read_body(decode_chunked=not config.chunked_passthrough, decode_content=config.decode_content)
+
+            start = time.perf_counter_ns()
+            self.server.hooks.run_inline('response', response)
+            if response:
+                response.timing.add_span('response_hook', start, time.perf_counter_ns())
+
+            if response and response.stream:
+                try:
+                    self.send_to_client(tube, response)
+                except OSError:
+                    # クライアントかサーバーが途中で切断した
+                    pass
+        finally:
+            if stream:
+                stream.close()
+
+        if self.server.compressor and response:
+            start = time.perf_counter_ns()
+            self.server.compressor.process(response)
+            response.timing.add_span('compress', start, time.perf_counter_ns())
+
+        if self.server.metrics:
+            self.server.metrics.record(prepared_request, response)
+        if self.server.access_log:
+            self.server.access_log.add(prepared_request, response)
+        if self.server.capture and response:
+            self.server.capture.add(prepared_request, response)
+        if self.server.event_bus:
+            self.server.event_bus.publish(prepared_request, response)
+        if self.server.tracer and response:
+            name = '%s %s' % (prepared_request.message.method, prepared_request.get_uri())
+            self.server.tracer.add(name, response.timing)
+
+        # 観察だけのフックは、クライアントへの送信と並行して動かす
+        if response:
+            self.server.hooks.offload('response', response)
 
         return response
 
+    def send_to_client(self, tube: Tube, response):
+        start = time.perf_counter_ns()
+        if response.stream:
+            # 受信したまま (chunked もそのまま) 送る
+            tube.send(response.message.get_head())
+            for data in response.stream:
+                tube.send(data)
+        else:
+            tube.send_message(response.message.get_head(), response.message.body.get_encoded_buffer())
+        response.timing.add_span('client_write', start, time.perf_counter_ns())
+
     def process_http(self, tube: Tube, request_message: RequestMessage):
         target = request_message.headers['Host']
         if ':' in target:
@@ -52,12 +220,13 @@ class TCPHandler(socketserver.BaseRequestHandler):
 
         prepared_request = PreparedRequest(host, port, False, message=request_message)
 
-        response = self.communicate(prepared_request)
+        response = self.communicate(prepared_request, tube)
 
         if not response:
             return
 
-        tube.send(bytes(response.message))
+        if not response.stream:
+            self.send_to_client(tube, response)
         tube.close()
         return
 
@@ -73,7 +242,13 @@ class TCPHandler(socketserver.BaseRequestHandler):
             host = target
             port = 443
 
+        start = time.perf_counter_ns()
         _, server_cert_pem = cert.create_server_cert(host, port, mycert.private_key, mycert.cacert)
+        end = time.perf_counter_ns()
+        self.spans.append(('cert', start, end))
+        if self.server.metrics:
+            self.server.metrics.inc('proxy_cert_mint_total')
+            self.server.metrics.observe('proxy_cert_mint_duration_seconds', (end - start) / 1e9)
 
         fp = tempfile.NamedTemporaryFile()
         fp.write(server_cert_pem)
@@ -83,22 +258,36 @@ class TCPHandler(socketserver.BaseRequestHandler):
         client_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         client_ctx.load_cert_chain(certfile=fp.name, keyfile=config.private_key_path)
         fp.close()
+        if config.client_http2:
+            client_ctx.set_alpn_protocols(['h2', 'http/1.1'])
 
         try:
             tube.upgrade_socket(client_ctx)
         except (OSError, ssl.SSLEOFError, BrokenPipeError):
             return
 
+        # h2 を選んだクライアントは 1 本のコネクションで複数のリクエストを送ってくる
+        if tube.get_alpn_protocol() == 'h2':
+            http2.serve(tube, host, port, self.communicate)
+            tube.close()
+            return
+
         raw_request = tube.recv_raw_http_request()
+        start = time.perf_counter_ns()
         request_message = RequestMessage(raw_request)
+        self.spans.append(('parse', start, time.perf_counter_ns()))
 
         prepared_request = PreparedRequest(host, port, True, message=request_message)
 
         # 対象サーバにリクエストを送信する
-        response = self.communicate(prepared_request)
+        response = self.communicate(prepared_request, tube)
+
+        if not response:
+            return
 
         try:
-            tube.send(bytes(response.message))
+            if not response.stream:
+                self.send_to_client(tube, response)
         except OSError as e:
             return
 
@@ -116,7 +305,9 @@ class TCPHandler(socketserver.BaseRequestHandler):
             return
 
         try:
+            start = time.perf_counter_ns()
             request_message = RequestMessage(raw_request)
+            self.spans.append(('parse', start, time.perf_counter_ns()))
         except exceptions.NotHttp11RequestMessageError:
             return
 
@@ -165,13 +356,66 @@ def read_config():
 
         config.host = json_config['host']
         config.port = json_config['port']
+        # socketserver の既定の 5 では接続が集中すると SYN の再送で 1 秒待たされる
+        config.listen_backlog = json_config.get('listen_backlog', 1024)
         config.private_key_path = json_config['private_key_path']
         config.cacert_path = json_config['cacert_path']
         try:
             config.auth = json_config['auth']
         except:
             config.auth = False
-        
+        config.chunked_passthrough = json_config.get('chunked_passthrough', False)
+        config.decode_content = json_config.get('decode_content', False)
+        config.stream_responses = json_config.get('stream_responses', True)
+        config.max_decoded_size = json_config.get('max_decoded_size', encoding.MAX_DECODED_SIZE)
+        config.max_decode_ratio = json_config.get('max_decode_ratio', encoding.MAX_DECODE_RATIO)
+        config.compress = json_config.get('compress', False)
+        config.compress_min_size = json_config.get('compress_min_size', 1024)
+        config.compress_level = json_config.get('compress_level', 6)
+        config.compress_brotli_quality = json_config.get('compress_brotli_quality', 4)
+        config.compress_cache_size = json_config.get('compress_cache_size', 64 * 1024 * 1024)
+        config.dns_ttl = json_config.get('dns_ttl', resolver.DNS_TTL)
+        config.dns_negative_ttl = json_config.get('dns_negative_ttl', resolver.DNS_NEGATIVE_TTL)
+        config.dns_stale_ttl = json_config.get('dns_stale_ttl', resolver.DNS_STALE_TTL)
+        config.body_spill_threshold = json_config.get('body_spill_threshold', buffer.SPILL_THRESHOLD)
+        config.memory_budget = json_config.get('memory_budget')
+        config.memory_budget_wait = json_config.get('memory_budget_wait', buffer.BUDGET_WAIT_TIMEOUT)
+        config.upstream_http2 = json_config.get('upstream_http2', False)
+        config.client_http2 = json_config.get('client_http2', False)
+        config.metrics_host = json_config.get('metrics_host', '127.0.0.1')
+        config.metrics_port = json_config.get('metrics_port')
+        config.access_log = json_config.get('access_log', False)
+        config.access_log_path = json_config.get('access_log_path')
+        config.access_log_format = json_config.get('access_log_format', 'text')
+        config.access_log_buffer_size = json_config.get('access_log_buffer_size', accesslog.BUFFER_SIZE)
+        config.access_log_max_bytes = json_config.get('access_log_max_bytes', 0)
+        config.access_log_backup_count = json_config.get('access_log_backup_count', 5)
+        config.capture = json_config.get('capture', False)
+        config.capture_dir = json_config.get('capture_dir', 'captures')
+        config.capture_segment_size = json_config.get('capture_segment_size', capture.SEGMENT_SIZE)
+        config.capture_max_segments = json_config.get('capture_max_segments')
+        config.capture_queue_size = json_config.get('capture_queue_size', capture.QUEUE_SIZE)
+        config.capture_queue_bytes = json_config.get('capture_queue_bytes', capture.QUEUE_BYTES)
+        config.event_bus = json_config.get('event_bus', False)
+        config.event_bus_path = json_config.get('event_bus_path', 'events.sock')
+        config.event_bus_queue_size = json_config.get('event_bus_queue_size', eventbus.QUEUE_SIZE)
+        config.event_bus_queue_bytes = json_config.get('event_bus_queue_bytes', eventbus.QUEUE_BYTES)
+        config.event_bus_bodies = json_config.get('event_bus_bodies', False)
+        config.event_bus_max_body_size = json_config.get('event_bus_max_body_size', eventbus.MAX_BODY_SIZE)
+        config.trace = json_config.get('trace', False)
+        config.trace_max_flows = json_config.get('trace_max_flows', trace.MAX_FLOWS)
+        config.profile_dir = json_config.get('profile_dir', 'profiles')
+        config.profile_seconds = json_config.get('profile_seconds', profiler.PROFILE_SECONDS)
+        config.profile_flow_rate = json_config.get('profile_flow_rate', profiler.FLOW_SAMPLE_RATE)
+        config.hook_workers = json_config.get('hook_workers', hooks.WORKERS)
+        config.hook_queue_size = json_config.get('hook_queue_size', hooks.QUEUE_SIZE)
+        config.hook_overflow = json_config.get('hook_overflow', 'drop')
+        config.cache = json_config.get('cache', False)
+        config.cache_memory_size = json_config.get('cache_memory_size', cache.MAX_MEMORY_SIZE)
+        config.cache_dir = json_config.get('cache_dir')
+        config.cache_disk_size = json_config.get('cache_disk_size', cache.MAX_DISK_SIZE)
+        config.cache_collapse_timeout = json_config.get('cache_collapse_timeout', cache.COLLAPSE_TIMEOUT)
+
         if config.auth:
             if 'auth_user_name' not in json_config:
                 util.print_error_exit('"proxy.conf: Need auth_user_name')
@@ -181,16 +425,175 @@ def read_config():
             config.auth_base64 = base64.b64encode(b'%s:%s' %(json_config['auth_user_name'].encode(), json_config['auth_password'].encode())).decode()
 
 
-def run_proxy(request_process: Callable = lambda x: x, response_process: Callable = lambda x: x):
+def start_profile(server, seconds: float) -> str:
+    path = profiler.get_output_path(config.profile_dir, 'profile', '.collapsed')
+    if not server.sampling_profiler.start(seconds, path):
+        raise ValueError('A profile is already running.')
+    return path
+
+
+def start_flow_profile(server, seconds: float, rate: float) -> str:
+    path = profiler.get_output_path(config.profile_dir, 'flows', '.pstats')
+    if not server.flow_profiler.start(seconds, rate, path):
+        raise ValueError('A flow profile is already running.')
+    return path
+
+
+def dump_trace(server) -> str:
+    if not server.tracer:
+        raise ValueError('"trace" is disabled in proxy.conf.')
+    path = profiler.get_output_path(config.profile_dir, 'trace', '.json')
+    server.tracer.dump(path)
+    return path
+
+
+def add_profile_routes(server, admin):
+    def get_float(query: dict, name: str, default: float) -> float:
+        return float(query.get(name, [default])[0])
+
+    def profile_route(query: dict):
+        path = start_profile(server, get_float(query, 'seconds', config.profile_seconds))
+        return 'application/json', json.dumps({'path': path}).encode()
+
+    def flow_profile_route(query: dict):
+        path = start_flow_profile(
+            server, get_float(query, 'seconds', config.profile_seconds),
+            get_float(query, 'rate', config.profile_flow_rate))
+        return 'application/json', json.dumps({'path': path}).encode()
+
+    def trace_route(query: dict):
+        if not server.tracer:
+            raise ValueError('"trace" is disabled in proxy.conf.')
+        return 'application/json', json.dumps(server.tracer.export()).encode()
+
+    metrics.add_route(admin, '/profile', profile_route, methods=('POST',))
+    metrics.add_route(admin, '/profile/flows', flow_profile_route, methods=('POST',))
+    metrics.add_route(admin, '/trace', trace_route)
+
+
+def add_profile_signals(server):
+    # SIGUSR1: スタックのサンプリング、SIGUSR2: フローの cProfile とトレースの書き出し
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+
+    def on_usr1(signum, frame):
+        try:
+            print('Profiling to %s' % start_profile(server, config.profile_seconds))
+        except ValueError as e:
+            print(e)
+
+    def on_usr2(signum, frame):
+        try:
+            print('Profiling flows to %s' % start_flow_profile(server, config.profile_seconds, config.profile_flow_rate))
+            if server.tracer:
+                print('Trace written to %s' % dump_trace(server))
+        except ValueError as e:
+            print(e)
+
+    signal.signal(signal.SIGUSR1, on_usr1)
+    signal.signal(signal.SIGUSR2, on_usr2)
+
+
+def run_proxy(request_process: Callable | list | None = None, response_process: Callable | list | None = None):
+    '''
+    request_process and response_process are hooks: functions or coroutine functions, or lists of them.
+    Hooks marked with proxy.hooks.hook(offload=True) run outside of the flow (see HookRunner), and
+    hook(hosts=..., body=False) and the other filters limit the flows a hook sees and what is buffered.
+    '''
     read_config()
 
     print(f"Serving on %s %s" % (config.host, config.port))
 
+    encoding.default_limits = encoding.DecodeLimits(config.max_decoded_size, config.max_decode_ratio)
+    resolver.default_resolver = resolver.Resolver(config.dns_ttl, config.dns_negative_ttl, config.dns_stale_ttl)
+    buffer.default_spill_threshold = config.body_spill_threshold
+    if config.memory_budget:
+        buffer.default_budget = buffer.MemoryBudget(config.memory_budget, config.memory_budget_wait)
+
     mycert.private_key, mycert.private_key_pem = cert.get_private_key(config.private_key_path)
     mycert.cacert, mycert.cacert_pem = cert.get_cacert(config.cacert_path)
 
     socketserver.ThreadingTCPServer.allow_reuse_address = True
+    socketserver.ThreadingTCPServer.request_queue_size = config.listen_backlog
     with socketserver.ThreadingTCPServer((config.host, config.port), TCPHandler) as server:
-        server.request_process = request_process
-        server.response_process = response_process
+        server.compressor = None
+        if config.compress:
+            server.compressor = Compressor(
+                min_size=config.compress_min_size,
+                level=config.compress_level,
+                brotli_quality=config.compress_brotli_quality,
+                cache_size=config.compress_cache_size)
+        server.access_log = None
+        if config.access_log:
+            server.access_log = AccessLog(
+                path=config.access_log_path,
+                format=config.access_log_format,
+                buffer_size=config.access_log_buffer_size,
+                max_bytes=config.access_log_max_bytes,
+                backup_count=config.access_log_backup_count)
+        server.capture = None
+        if config.capture:
+            server.capture = CaptureStore(
+                config.capture_dir,
+                segment_size=config.capture_segment_size,
+                max_segments=config.capture_max_segments,
+                queue_size=config.capture_queue_size,
+                queue_bytes=config.capture_queue_bytes)
+        server.event_bus = None
+        if config.event_bus:
+            server.event_bus = EventBus(
+                config.event_bus_path,
+                queue_size=config.event_bus_queue_size,
+                queue_bytes=config.event_bus_queue_bytes,
+                include_bodies=config.event_bus_bodies,
+                max_body_size=config.event_bus_max_body_size)
+        server.tracer = Tracer(config.trace_max_flows) if config.trace else None
+        server.sampling_profiler = SamplingProfiler()
+        server.flow_profiler = FlowProfiler()
+        add_profile_signals(server)
+        server.metrics = None
+        if config.metrics_port:
+            server.metrics = Metrics()
+            metrics.add_runtime_gauges(server.metrics)
+            if server.access_log:
+                server.metrics.add_gauge('proxy_access_log_dropped', 'Access log records dropped on overflow.',
+                                         lambda: server.access_log.dropped)
+                server.metrics.add_gauge('proxy_access_log_queued', 'Access log records waiting to be written.',
+                                         lambda: len(server.access_log.records))
+            if server.capture:
+                server.metrics.add_gauge('proxy_capture_dropped', 'Flows not captured: queue full or failed.',
+                                         lambda: server.capture.dropped)
+                server.metrics.add_gauge('proxy_capture_queued', 'Flows waiting to be captured.',
+                                         lambda: server.capture.queue.qsize())
+            if server.event_bus:
+                server.metrics.add_gauge('proxy_event_bus_dropped', 'Flow events dropped: queue full or failed.',
+                                         lambda: server.event_bus.dropped + server.event_bus.get_subscriber_dropped())
+                server.metrics.add_gauge('proxy_event_bus_subscribers', 'Connected event bus subscribers.',
+                                         lambda: len(server.event_bus.subscribers))
+                server.metrics.add_gauge('proxy_event_bus_queued', 'Flow events waiting to be sent to subscribers.',
+                                         lambda: server.event_bus.get_queued())
+        server.hooks = HookRunner(
+            request_process, response_process,
+            workers=config.hook_workers,
+            queue_size=config.hook_queue_size,
+            overflow=config.hook_overflow,
+            metrics=server.metrics)
+        if server.metrics:
+            server.metrics.add_gauge('proxy_hook_queued', 'Offloaded hook calls running or waiting.',
+                                     lambda: server.hooks.pending)
+            admin = metrics.serve(server.metrics, config.metrics_host, config.metrics_port)
+            add_profile_routes(server, admin)
+            metrics.add_route(admin, '/hooks', lambda query: (
+                'application/json', json.dumps(server.hooks.get_stats()).encode()))
+            if server.event_bus:
+                metrics.add_route(admin, '/events', lambda query: (
+                    'application/json', json.dumps(server.event_bus.get_stats()).encode()))
+            print(f"Metrics on http://{config.metrics_host}:{config.metrics_port}/metrics")
+        server.cache = None
+        if config.cache:
+            server.cache = cache.Cache(
+                max_memory_size=config.cache_memory_size,
+                disk_path=config.cache_dir,
+                max_disk_size=config.cache_disk_size,
+                collapse_timeout=config.cache_collapse_timeout)
         server.serve_forever()
@@ -0,0 +1,320 @@
+from httprequest import buffer, http2, PreparedRequest, Response
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+import ipaddress
+import threading
+import urllib.parse
+import weakref
+
+
+# Prometheus の既定値と同じ
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PHASES = ('dns', 'connect', 'tls', 'ttfb', 'total')
+
+# name: (type, help, label names)
+METRICS = {
+    'proxy_requests_total': ('counter', 'Requests by method, status and host class.', ('method', 'status', 'host_class')),
+    'proxy_request_bytes_total': ('counter', 'Request body bytes sent upstream.', ('method', 'status', 'host_class')),
+    'proxy_response_bytes_total': ('counter', 'Response bytes received for clients.', ('method', 'status', 'host_class')),
+    'proxy_cache_responses_total': ('counter', 'Responses by cache status.', ('cache_status',)),
+    'proxy_client_connections': ('gauge', 'Open client connections.', ()),
+    'proxy_upstream_requests': ('gauge', 'Upstream requests in flight.', ()),
+    'proxy_phase_duration_seconds': ('histogram', 'Upstream latency by phase.', ('phase',)),
+    'proxy_cert_mint_total': ('counter', 'Server certificates minted.', ()),
+    'proxy_cert_mint_duration_seconds': ('histogram', 'Time spent minting server certificates.', ()),
+    'proxy_hook_duration_seconds': ('histogram', 'Time spent in each user hook.', ('hook', 'stage', 'mode')),
+    'proxy_hook_errors_total': ('counter', 'Exceptions raised by user hooks.', ('hook', 'stage')),
+    'proxy_hook_dropped_total': ('counter', 'Offloaded hook calls dropped on overflow.', ('hook', 'stage')),
+}
+
+
+def get_host_class(host: str) -> str:
+    '''
+    Coarse class of the upstream host, to keep the label cardinality bounded.
+    '''
+    try:
+        address = ipaddress.ip_address(host.strip('[]'))
+    except ValueError:
+        if host == 'localhost' or host.endswith(('.localhost', '.local', '.internal')):
+            return 'internal'
+        return 'domain'
+
+    if address.is_loopback:
+        return 'loopback'
+    if address.is_private:
+        return 'private'
+    return 'ip'
+
+
+class Shard():
+    '''
+    The counters of one thread. Only the owner thread writes to it, so recording takes no lock.
+    '''
+
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.counters: dict[tuple, float] = {}
+        # (name, labels) -> [bucket..., +Inf, sum]
+        self.histograms: dict[tuple, list[float]] = {}
+
+    def merge(self, other: 'Shard'):
+        for key, value in other.counters.copy().items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, values in other.histograms.copy().items():
+            merged = self.histograms.setdefault(key, [0.0] * len(values))
+            for i, value in enumerate(list(values)):
+                merged[i] += value
+
+
+class ShardOwner():
+    '''
+    Kept only in the thread's threading.local, so it is collected when the thread ends.
+    '''
+
+
+class Metrics():
+    '''
+    Counters, gauges and histograms kept in per-thread shards and merged when scraped.
+    The shard of a thread is folded into retired when the thread ends.
+
+    >>> metrics = Metrics()
+    >>> metrics.inc('proxy_cert_mint_total')
+    >>> metrics.observe('proxy_phase_duration_seconds', 0.042, ('ttfb',))
+    >>> print(metrics.render())
+    '''
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.shards: list[Shard] = []
+        # 終了したスレッドのシャードはここにまとめる
+        self.retired = Shard()
+        self.local = threading.local()
+        # retire() はスレッドの終了処理から呼ばれるので、再入できるようにする
+        self.lock = threading.RLock()
+        self.definitions = dict(METRICS)
+        self.gauges: dict[str, Callable[[], float]] = {}
+
+    def get_shard(self) -> Shard:
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = Shard()
+            # スレッドが終わると threading.local の値が捨てられ、その時にシャードをまとめる
+            self.local.owner = ShardOwner()
+            weakref.finalize(self.local.owner, self.retire, shard)
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def retire(self, shard: Shard):
+        with self.lock:
+            if shard in self.shards:
+                self.shards.remove(shard)
+                self.retired.merge(shard)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        counters = self.get_shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: tuple = ()):
+        histograms = self.get_shard().histograms
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0.0] * (len(self.buckets) + 2)
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        histogram[i] += 1
+        histogram[-1] += value
+
+    def add_gauge(self, name: str, help_text: str, function: Callable[[], float]):
+        '''
+        A gauge read when scraped.
+        '''
+        self.definitions.setdefault(name, ('gauge', help_text, ()))
+        self.gauges[name] = function
+
+    def collect(self) -> Shard:
+        with self.lock:
+            alive = []
+            for shard in self.shards:
+                if shard.thread.is_alive():
+                    alive.append(shard)
+                else:
+                    self.retired.merge(shard)
+            self.shards = alive
+
+            total = Shard()
+            total.merge(self.retired)
+            for shard in alive:
+                total.merge(shard)
+
+        return total
+
+    def render(self) -> str:
+        '''
+        Prometheus text exposition format 0.0.4
+        https://prometheus.io/docs/instrumenting/exposition_formats/
+        '''
+        total = self.collect()
+        lines = []
+
+        for name, (metric_type, help_text, label_names) in self.definitions.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+
+            if name in self.gauges:
+                lines.append(f'{name} {format_value(self.gauges[name]())}')
+                continue
+
+            if metric_type == 'histogram':
+                for (key_name, labels), values in sorted(total.histograms.items()):
+                    if key_name == name:
+                        lines.extend(self.render_histogram(name, label_names, labels, values))
+                continue
+
+            for (key_name, labels), value in sorted(total.counters.items()):
+                if key_name == name:
+                    lines.append(f'{name}{format_labels(label_names, labels)} {format_value(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+    def render_histogram(self, name: str, label_names: tuple, labels: tuple, values: list[float]) -> list[str]:
+        lines = []
+        cumulative = 0.0
+        for bound, count in zip(self.buckets + (float('inf'),), values):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else format_value(bound)
+            bucket_labels = format_labels(label_names + ('le',), labels + (le,))
+            lines.append(f'{name}_bucket{bucket_labels} {format_value(cumulative)}')
+
+        lines.append(f'{name}_sum{format_labels(label_names, labels)} {format_value(values[-1])}')
+        lines.append(f'{name}_count{format_labels(label_names, labels)} {format_value(cumulative)}')
+
+        return lines
+
+    def record(self, prepared_request: PreparedRequest, response: Response | None):
+        request_message = prepared_request.message
+        method = request_message.method
+        status = response.message.status_code if response else 'error'
+        labels = (method, status, get_host_class(prepared_request.host))
+
+        self.inc('proxy_requests_total', labels)
+        if request_message.body:
+            self.inc('proxy_request_bytes_total', labels, len(request_message.body))
+        if not response:
+            return
+
+        self.inc('proxy_response_bytes_total', labels, response.get_size())
+        if response.cache_status:
+            self.inc('proxy_cache_responses_total', (response.cache_status,))
+
+        for phase in PHASES:
+            duration = getattr(response.timing, phase)
+            if duration is not None:
+                self.observe('proxy_phase_duration_seconds', duration / 1e9, (phase,))
+
+
+def format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+
+    return '{' + ','.join(pairs) + '}'
+
+
+def add_runtime_gauges(metrics: Metrics):
+    metrics.add_gauge('proxy_threads', 'Live threads.', threading.active_count)
+    metrics.add_gauge('proxy_upstream_http2_connections', 'Pooled upstream HTTP/2 connections.',
+                      http2.default_pool.get_connection_count)
+
+    def budget_gauge(attribute: str) -> Callable[[], float]:
+        # run_proxy の後で差し替えられるので、読むたびに参照する
+        return lambda: getattr(buffer.default_budget, attribute, 0)
+
+    metrics.add_gauge('proxy_memory_budget_used_bytes', 'Bytes held in memory by buffered bodies.',
+                      budget_gauge('used'))
+    metrics.add_gauge('proxy_memory_budget_waiting', 'Threads waiting for the memory budget.',
+                      budget_gauge('waiting'))
+
+
+class AdminHandler(BaseHTTPRequestHandler):
+    '''
+    Serves the routes of the admin listener, /metrics and the ones added with add_route().
+    '''
+
+    def do_GET(self):
+        self.handle_route('GET')
+
+    def do_POST(self):
+        self.handle_route('POST')
+
+    def handle_route(self, method: str):
+        path, _, query = self.path.partition('?')
+        if path not in self.server.routes:
+            self.send_error(404)
+            return
+
+        function, methods = self.server.routes[path]
+        if method not in methods:
+            self.send_response(405)
+            self.send_header('Allow', ', '.join(methods))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        # POST のフォームもクエリ文字列と同じように渡す
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            query += '&' + self.rfile.read(length).decode('utf-8', 'replace')
+
+        try:
+            content_type, body = function(urllib.parse.parse_qs(query))
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def add_route(server: ThreadingHTTPServer, path: str, function: Callable[[dict], tuple[str, bytes]],
+              methods: tuple[str, ...] = ('GET',)):
+    '''
+    function receives the parsed query string (and form body) and returns (content type, body).
+    Routes with side effects take methods=('POST',), so crawlers and prefetches cannot trigger them.
+    '''
+    server.routes[path] = (function, methods)
+
+
+def serve(metrics: Metrics, host: str, port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), AdminHandler)
+    server.daemon_threads = True
+    server.routes = {}
+    add_route(server, '/metrics',
+              lambda query: ('text/plain; version=0.0.4; charset=utf-8', metrics.render().encode('utf-8')))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
@@ -0,0 +1,149 @@
+from collections import Counter
+from typing import Callable
+
+import cProfile
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+
+
+SAMPLE_INTERVAL = 0.005
+PROFILE_SECONDS = 30
+FLOW_SAMPLE_RATE = 0.1
+
+
+def get_output_path(directory: str, prefix: str, suffix: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    name = '%s-%s-%d%s' % (prefix, time.strftime('%Y%m%d-%H%M%S'), os.getpid(), suffix)
+    return os.path.join(directory, name)
+
+
+def collapse_stack(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler():
+    '''
+    Samples the stacks of every thread for a number of seconds and writes them as collapsed stacks,
+    one "frame;frame;frame count" line per stack, for flamegraph.pl or https://www.speedscope.app.
+
+    It measures wall-clock time, so threads blocked on sockets are sampled as well.
+
+    >>> profiler = SamplingProfiler()
+    >>> profiler.start(10, 'profiles/profile.collapsed')
+    '''
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.thread: threading.Thread | None = None
+        self.lock = threading.Lock()
+
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds: float, path: str) -> bool:
+        with self.lock:
+            if self.is_running():
+                return False
+            self.thread = threading.Thread(target=self.run, args=(seconds, path), daemon=True)
+            self.thread.start()
+        return True
+
+    def run(self, seconds: float, path: str):
+        own_id = threading.get_ident()
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    stacks[collapse_stack(frame)] += 1
+            time.sleep(self.interval)
+
+        with open(path, 'wt') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+class FlowProfiler():
+    '''
+    Runs a sample of flows under cProfile for a number of seconds and writes the merged pstats file.
+    The profile of each flow covers only its own thread. Only one flow is profiled at a time, since
+    Python 3.12 allows a single active profiler; flows sampled meanwhile run unprofiled.
+
+    >>> profiler = FlowProfiler()
+    >>> profiler.start(10, 0.1, 'profiles/flows.pstats')
+    >>> response = profiler.run(communicate, prepared_request)
+    '''
+
+    def __init__(self):
+        self.rate = 0.0
+        self.deadline = 0.0
+        self.path: str | None = None
+        self.stats: pstats.Stats | None = None
+        self.lock = threading.Lock()
+        # プロファイル中のフロー
+        self.busy = threading.Lock()
+
+    def start(self, seconds: float, rate: float, path: str) -> bool:
+        with self.lock:
+            if self.path:
+                return False
+            self.rate = rate
+            self.deadline = time.monotonic() + seconds
+            self.path = path
+            self.stats = None
+
+        timer = threading.Timer(seconds, self.stop)
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def stop(self):
+        with self.lock:
+            path, stats = self.path, self.stats
+            self.path = None
+            self.stats = None
+
+        if path and stats:
+            stats.dump_stats(path)
+
+    def run(self, function: Callable, *args):
+        if not self.path or time.monotonic() >= self.deadline or random.random() >= self.rate:
+            return function(*args)
+
+        if not self.busy.acquire(blocking=False):
+            return function(*args)
+
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # 別のプロファイラが動いている
+                return function(*args)
+
+            try:
+                return function(*args)
+            finally:
+                profile.disable()
+                self.add(profile)
+        finally:
+            self.busy.release()
+
+    def add(self, profile: cProfile.Profile):
+        with self.lock:
+            if self.path:
+                if self.stats:
+                    self.stats.add(profile)
+                else:
+                    self.stats = pstats.Stats(profile)
@@ -0,0 +1,317 @@
+from proxy.capture import CaptureReader, SegmentSummary, SUMMARY_STRINGS
+from collections.abc import Iterator
+from datetime import datetime
+
+import argparse
+import json
+import operator
+import re
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '>=': operator.ge,
+    '<=': operator.le,
+    '>': operator.gt,
+    '<': operator.lt,
+}
+
+STRING_OPERATORS = {
+    '=': lambda value, x: value == x,
+    '!=': lambda value, x: value != x,
+    'prefix': lambda value, x: value.startswith(x),
+    'suffix': lambda value, x: value.endswith(x),
+    'contains': lambda value, x: x in value,
+}
+
+DURATION_UNITS = {'ns': 1e-9, 'us': 1e-6, 'ms': 1e-3, 's': 1.0, 'm': 60.0, 'h': 3600.0, 'd': 86400.0}
+SIZE_UNITS = {'': 1, 'b': 1, 'k': 1024, 'kb': 1024, 'm': 1024 ** 2, 'mb': 1024 ** 2, 'g': 1024 ** 3, 'gb': 1024 ** 3}
+
+# 時間の列は ns で持っている
+DURATION_FIELDS = ('latency', 'ttfb')
+NUMBER_FIELDS = ('status', 'size') + DURATION_FIELDS
+
+CONDITION = re.compile(r'(\w+)(>=|<=|!=|=|>|<)(\S+)')
+
+
+def parse_duration(text: str) -> float:
+    '''
+    >>> parse_duration('1h'), parse_duration('250ms')
+    (3600.0, 0.25)
+    '''
+    match = re.fullmatch(r'([\d.]+)([a-z]*)', text.lower())
+    if not match or match.group(2) not in DURATION_UNITS and match.group(2):
+        raise ValueError(f'Invalid duration: {text}')
+    return float(match.group(1)) * DURATION_UNITS[match.group(2) or 's']
+
+
+def parse_size(text: str) -> int:
+    match = re.fullmatch(r'([\d.]+)([a-z]*)', text.lower())
+    if not match or match.group(2) not in SIZE_UNITS:
+        raise ValueError(f'Invalid size: {text}')
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def parse_time(text: str) -> float:
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise ValueError(f'Invalid time: {text}')
+
+
+class Query():
+    '''
+    Filter over captured flows.
+
+    conditions are (field, operator, value). Numeric fields are status, size, latency and ttfb;
+    string fields are method, host and path.
+
+    >>> query = parse_query('host=api.example.com status>=500 last 1h')
+    >>> query = parse_query('path prefix /v2 slower than 2s')
+    '''
+
+    def __init__(self):
+        self.conditions: list[tuple[str, str, float | int | str]] = []
+        self.start: float | None = None
+        self.end: float | None = None
+        self.limit: int | None = None
+
+    def add(self, field: str, op: str, value: str):
+        if field in SUMMARY_STRINGS:
+            if op not in STRING_OPERATORS:
+                raise ValueError(f'"{op}" cannot be used with {field}')
+            if field == 'host':
+                value = value.lower()
+            elif field == 'method':
+                value = value.upper()
+            self.conditions.append((field, op, value))
+        elif field == 'status' and re.fullmatch(r'[1-5]xx', value.lower()):
+            # 5xx などはクラスの範囲にする
+            if op not in ('=', '!='):
+                raise ValueError(f'"{op}" cannot be used with {value}')
+            low = int(value[0]) * 100
+            if op == '=':
+                self.conditions.append(('status', '>=', low))
+                self.conditions.append(('status', '<', low + 100))
+            else:
+                self.conditions.append(('status', 'not in class', low))
+        elif field in NUMBER_FIELDS:
+            if op not in OPERATORS:
+                raise ValueError(f'"{op}" cannot be used with {field}')
+            if field in DURATION_FIELDS:
+                number = int(parse_duration(value) * 1e9)
+            elif field == 'size':
+                number = parse_size(value)
+            else:
+                number = int(value)
+            self.conditions.append((field, op, number))
+        else:
+            raise ValueError(f'Unknown field: {field}')
+
+
+def parse_query(text: str, now: float | None = None) -> Query:
+    '''
+    Words of the query, all of which must match:
+
+        host=api.example.com  method!=GET  status>=500  status=5xx  size>1mb  latency>2s  ttfb<100ms
+        host suffix .example.com  path prefix /v2  path contains login
+        slower than 2s  faster than 100ms
+        last 1h  since 2024-01-01T00:00:00  until 1700000000
+        limit 100
+    '''
+    now = time.time() if now is None else now
+    query = Query()
+    text = re.sub(r'\s*(>=|<=|!=|=|>|<)\s*', r'\1', text)
+    words = text.split()
+
+    i = 0
+    while i < len(words):
+        word = words[i].lower()
+        rest = words[i + 1:]
+
+        if word == 'last' and rest:
+            query.start = now - parse_duration(rest[0])
+            i += 2
+        elif word in ('since', 'until') and rest:
+            if word == 'since':
+                query.start = parse_time(rest[0])
+            else:
+                query.end = parse_time(rest[0])
+            i += 2
+        elif word in ('slower', 'faster') and len(rest) >= 2 and rest[0].lower() == 'than':
+            query.add('latency', '>' if word == 'slower' else '<', rest[1])
+            i += 3
+        elif word == 'limit' and rest:
+            query.limit = int(rest[0])
+            i += 2
+        elif len(rest) >= 2 and rest[0].lower() in ('prefix', 'suffix', 'contains'):
+            query.add(word, rest[0].lower(), rest[1])
+            i += 3
+        else:
+            match = CONDITION.fullmatch(words[i])
+            if not match:
+                raise ValueError(f'Cannot parse "{words[i]}"')
+            query.add(match.group(1).lower(), match.group(2), match.group(3))
+            i += 1
+
+    return query
+
+
+def select(summary: SegmentSummary, query: Query) -> list[int]:
+    '''
+    Rows of the summary matched by the query. Uses numpy over the columns when it is installed.
+    '''
+    if not len(summary):
+        return []
+
+    # 文字列の条件は、先に文字列表を絞って番号の集合にする
+    string_ids = {}
+    for field, op, value in query.conditions:
+        if field in SUMMARY_STRINGS:
+            matched = {i for i, x in enumerate(summary.strings[field]) if STRING_OPERATORS[op](x, value)}
+            string_ids[field] = string_ids[field] & matched if field in string_ids else matched
+            if not string_ids[field]:
+                return []
+
+    if numpy is not None:
+        return select_numpy(summary, query, string_ids)
+
+    columns = summary.columns
+    rows = []
+    for i in range(len(summary)):
+        request_time = columns['time'][i]
+        if query.start is not None and request_time < query.start:
+            continue
+        if query.end is not None and request_time >= query.end:
+            continue
+        if any(columns[field][i] not in ids for field, ids in string_ids.items()):
+            continue
+        if not all(match_number(field, columns[field][i], op, value)
+                   for field, op, value in query.conditions if field in NUMBER_FIELDS):
+            continue
+        rows.append(i)
+
+    return rows
+
+
+def match_number(field: str, number: float, op: str, value: float) -> bool:
+    # 時間が分からないフロー (-1) はどの時間の条件にも合わない
+    if field in DURATION_FIELDS and number < 0:
+        return False
+    if op == 'not in class':
+        return not value <= number < value + 100
+    return OPERATORS[op](number, value)
+
+
+def select_numpy(summary: SegmentSummary, query: Query, string_ids: dict[str, set[int]]) -> list[int]:
+    def get_column(name: str):
+        column = summary.columns[name]
+        return numpy.frombuffer(column, dtype=column.typecode if hasattr(column, 'typecode') else column.format)
+
+    mask = numpy.ones(len(summary), dtype=bool)
+    if query.start is not None:
+        mask &= get_column('time') >= query.start
+    if query.end is not None:
+        mask &= get_column('time') < query.end
+    for field, ids in string_ids.items():
+        mask &= numpy.isin(get_column(field), numpy.fromiter(ids, dtype=numpy.int64))
+    for field, op, value in query.conditions:
+        if field not in NUMBER_FIELDS:
+            continue
+        column = get_column(field)
+        if field in DURATION_FIELDS:
+            mask &= column >= 0
+        if op == 'not in class':
+            mask &= (column < value) | (column >= value + 100)
+        else:
+            mask &= OPERATORS[op](column, value)
+
+    return numpy.flatnonzero(mask).tolist()
+
+
+def run_query(reader: CaptureReader, query: Query) -> Iterator[dict]:
+    '''
+    Rows of the matching flows, in the order they were captured. The segment and offset of a row
+    can be passed to CaptureReader.read() to get the whole flow.
+    '''
+    count = 0
+    for segment_id in reader.get_segment_ids():
+        summary = reader.get_summary(segment_id)
+        if not len(summary):
+            continue
+
+        # 時間の範囲に掛からないセグメントは列を見ない
+        if query.start is not None and summary.end_time < query.start:
+            continue
+        if query.end is not None and summary.start_time >= query.end:
+            continue
+
+        for i in select(summary, query):
+            row = summary.get_row(i)
+            row['segment'] = segment_id
+            yield row
+
+            count += 1
+            if query.limit is not None and count >= query.limit:
+                return
+
+
+def format_row(row: dict) -> str:
+    request_time = datetime.fromtimestamp(row['time']).isoformat(timespec='milliseconds')
+    latency = '-' if row['latency'] < 0 else '%.3fs' % (row['latency'] / 1e9)
+    return f"{request_time} {row['method']} {row['host']}{row['path']} {row['status']} {row['size']} {latency}"
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog='python -m proxy.query', description='Query flows recorded by the capture stage.',
+        epilog='example: python -m proxy.query "host=api.example.com status>=500 last 1h"')
+    parser.add_argument('query', nargs='*', help='words of the query (see parse_query)')
+    parser.add_argument('-d', '--dir', default='captures', help='capture directory')
+    parser.add_argument('-j', '--json', action='store_true', help='print JSON lines')
+    parser.add_argument('-c', '--count', action='store_true', help='print only the number of matching flows')
+    parser.add_argument('-r', '--raw', action='store_true', help='print the raw request and response')
+    args = parser.parse_args(argv)
+
+    try:
+        query = parse_query(' '.join(args.query))
+    except ValueError as e:
+        parser.error(str(e))
+
+    reader = CaptureReader(args.dir)
+    count = 0
+    for row in run_query(reader, query):
+        count += 1
+        if args.count:
+            continue
+
+        if args.json:
+            print(json.dumps(row, ensure_ascii=False))
+        else:
+            print(format_row(row))
+
+        if args.raw:
+            flow = reader.read(row['segment'], row['offset'])
+            sys.stdout.buffer.write(flow.request.tobytes() + b'\n' + flow.response.tobytes() + b'\n\n')
+            sys.stdout.flush()
+
+    if args.count:
+        print(count)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,291 @@
+from httprequest import RequestMessage, Tube
+from httprequest.tube import create_client_connection
+from proxy.capture import CaptureReader, CapturedFlow
+from proxy.query import parse_query, run_query
+from collections import Counter
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+import argparse
+import json
+import math
+import ssl
+import sys
+import threading
+import time
+import urllib.parse
+
+
+TIMEOUT = 30
+PERCENTILES = (50, 90, 95, 99, 99.9)
+
+
+def get_percentile(sorted_values: list[float], percentile: float) -> float | None:
+    # nearest-rank
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(percentile / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def recv_head(sock) -> bytes:
+    data = b''
+    while b'\r\n\r\n' not in data:
+        received = sock.recv(4096)
+        if not received:
+            raise ConnectionResetError('Connection closed by proxy')
+        data += received
+    return data
+
+
+def send_via_proxy(proxy: tuple[str, int], message: RequestMessage, host: str, port: int, is_ssl: bool,
+                   timeout: int = TIMEOUT) -> str:
+    '''
+    Sends the request through an HTTP proxy, in a CONNECT tunnel for https, and returns the status code.
+    '''
+    tube = Tube()
+    tube.open_connection(proxy[0], proxy[1], False, timeout)
+    try:
+        u = urllib.parse.urlsplit(message.request_target)
+        message.http_version = 'HTTP/1.1'
+        if is_ssl:
+            tube.send(f'CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n'.encode())
+            status = recv_head(tube.socket).split(b' ', 2)[1].decode()
+            if status != '200':
+                return status
+
+            ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+            tube.socket = ctx.wrap_socket(tube.socket, server_hostname=host)
+            # トンネルの中では origin-form で送る
+            message.request_target = u._replace(scheme='', netloc='').geturl() or '/'
+        else:
+            message.request_target = u._replace(scheme='http', netloc=f'{host}:{port}').geturl()
+
+        tube.send(bytes(message))
+        headers = [(key, message.headers[key]) for key in message.headers]
+        conn = create_client_connection(message.method, message.request_target, headers, message.http_version)
+        raw_header, raw_body = tube.recv_http_response(conn)
+        raw_body.close()
+        return raw_header.split(b' ', 2)[1].decode()
+    finally:
+        tube.close()
+
+
+class Report():
+    '''
+    Latencies and outcomes of a replay. Statuses are counted by code and errors by exception type.
+    '''
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.end_time: float | None = None
+
+    def add(self, latency: float, status: str | None = None, error: str | None = None):
+        with self.lock:
+            self.latencies.append(latency)
+            if error:
+                self.errors[error] += 1
+            else:
+                self.statuses[status] += 1
+
+    def finish(self):
+        self.end_time = time.monotonic()
+
+    def to_dict(self) -> dict:
+        latencies = sorted(self.latencies)
+        elapsed = (self.end_time or time.monotonic()) - self.start_time
+        return {
+            'requests': len(latencies),
+            'elapsed': elapsed,
+            'throughput': len(latencies) / elapsed if elapsed else 0.0,
+            'statuses': dict(sorted(self.statuses.items())),
+            'errors': dict(self.errors.most_common()),
+            'latency': {
+                'min': latencies[0] if latencies else None,
+                'mean': sum(latencies) / len(latencies) if latencies else None,
+                **{f'p{x:g}': get_percentile(latencies, x) for x in PERCENTILES},
+                'max': latencies[-1] if latencies else None,
+            },
+        }
+
+    def render(self) -> str:
+        report = self.to_dict()
+        lines = [
+            'requests    %d in %.2fs (%.1f req/s)' % (report['requests'], report['elapsed'], report['throughput']),
+            'statuses    ' + (' '.join(f'{k}:{v}' for k, v in report['statuses'].items()) or '-'),
+        ]
+        if report['errors']:
+            lines.append('errors      ' + ' '.join(f'{k}:{v}' for k, v in report['errors'].items()))
+        lines.append('latency')
+        for name, value in report['latency'].items():
+            lines.append('  %-8s  %s' % (name, '-' if value is None else '%.2f ms' % (value * 1000)))
+
+        return '\n'.join(lines)
+
+
+class Replayer():
+    '''
+    Re-issues captured flows with httprequest.
+
+    Without rate or speed the replay is closed-loop: concurrency workers send the next flow as soon
+    as their previous one is answered. With rate (requests per second), or with speed (a factor over
+    the original arrival times, 10 = ten times faster), it is open-loop: flows are scheduled at
+    fixed times and their latency is measured from the scheduled time, so a slow target is not hidden
+    by the replayer waiting for a free worker.
+
+    target sends every flow to one host:port, proxy sends them through an HTTP proxy (CONNECT for
+    https), and rewrites maps original hosts to other ones.
+
+    >>> replayer = Replayer(concurrency=32, speed=10, proxy=('localhost', 8090))
+    >>> report = replayer.run(flows)
+    >>> print(report.render())
+    '''
+
+    def __init__(self, concurrency: int = 10, rate: float | None = None, speed: float | None = None,
+                 target: tuple[str, int] | None = None, proxy: tuple[str, int] | None = None,
+                 rewrites: dict[str, str] | None = None, timeout: int = TIMEOUT):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.speed = speed
+        self.target = target
+        self.proxy = proxy
+        self.rewrites = rewrites or {}
+        self.timeout = timeout
+
+    def run(self, flows: Iterable[CapturedFlow]) -> Report:
+        report = Report()
+        slots = threading.Semaphore(self.concurrency)
+        open_loop = self.rate is not None or self.speed is not None
+
+        def replay(flow: CapturedFlow, scheduled: float):
+            try:
+                status = self.send(flow)
+                report.add(time.monotonic() - scheduled, status=status)
+            except Exception as e:
+                report.add(time.monotonic() - scheduled, error=type(e).__name__)
+            finally:
+                slots.release()
+
+        start = time.monotonic()
+        first_time = None
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for i, flow in enumerate(flows):
+                scheduled = time.monotonic()
+                if open_loop:
+                    if self.speed is not None:
+                        first_time = flow.request_time if first_time is None else first_time
+                        scheduled = start + max(flow.request_time - first_time, 0) / self.speed
+                    else:
+                        scheduled = start + i / self.rate
+                    delay = scheduled - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                slots.acquire()
+                executor.submit(replay, flow, scheduled)
+
+        report.finish()
+        return report
+
+    def rewrite(self, flow: CapturedFlow, message: RequestMessage) -> tuple[str, int]:
+        host, port = flow.host, flow.port
+        new_host = self.rewrites.get(host.lower())
+        if new_host:
+            host, _, new_port = new_host.partition(':')
+            port = int(new_port) if new_port else port
+            authority = host if port == (443 if flow.is_ssl else 80) else f'{host}:{port}'
+            message.headers['Host'] = authority
+
+            u = urllib.parse.urlsplit(message.request_target)
+            if u.netloc:
+                message.request_target = u._replace(netloc=authority).geturl()
+
+        if self.target:
+            host, port = self.target
+
+        return host, port
+
+    def send(self, flow: CapturedFlow) -> str:
+        message = flow.get_request_message()
+        host, port = self.rewrite(flow, message)
+
+        if self.proxy:
+            return send_via_proxy(self.proxy, message, host, port, flow.is_ssl, self.timeout)
+
+        # PreparedRequest.send は既定のタイムアウトで繋ぐので、自分で開いたコネクションを渡す
+        tube = Tube()
+        tube.open_connection(host, port, flow.is_ssl, self.timeout)
+        try:
+            response = message.send(host, port, flow.is_ssl, tube=tube)
+        finally:
+            tube.close()
+        if response is None:
+            raise TimeoutError('timed out')
+
+        status = response.message.status_code
+        response.message.body.get_encoded_buffer().close()
+        return status
+
+
+def iter_flows(reader: CaptureReader, query_text: str, repeat: int = 1) -> Iterator[CapturedFlow]:
+    for _ in range(repeat):
+        for row in run_query(reader, parse_query(query_text)):
+            yield reader.read(row['segment'], row['offset'])
+
+
+def parse_address(text: str) -> tuple[str, int]:
+    host, _, port = text.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(f'Invalid host:port: {text}')
+    return host, int(port)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog='python -m proxy.replay', description='Replay captured flows and report latencies.',
+        epilog='example: python -m proxy.replay --proxy localhost:8090 --speed 10 "host=api.example.com last 1h"')
+    parser.add_argument('query', nargs='*', help='flows to replay, in the syntax of proxy.query')
+    parser.add_argument('-d', '--dir', default='captures', help='capture directory')
+    parser.add_argument('-c', '--concurrency', type=int, default=10, help='number of requests in flight')
+    parser.add_argument('--rate', type=float, help='open-loop at this many requests per second')
+    parser.add_argument('--speed', type=float, help='open-loop at the original arrival times divided by SPEED')
+    parser.add_argument('--target', help='send every flow to HOST:PORT')
+    parser.add_argument('--proxy', help='send the flows through the HTTP proxy at HOST:PORT')
+    parser.add_argument('--rewrite', action='append', default=[], metavar='OLD=NEW[:PORT]',
+                        help='replace a host, can be repeated')
+    parser.add_argument('--repeat', type=int, default=1, help='replay the selected flows this many times')
+    parser.add_argument('--timeout', type=int, default=TIMEOUT)
+    parser.add_argument('-j', '--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    try:
+        rewrites = {}
+        for rewrite in args.rewrite:
+            old, sep, new = rewrite.partition('=')
+            if not sep:
+                raise ValueError(f'Invalid rewrite: {rewrite}')
+            rewrites[old.lower()] = new
+        replayer = Replayer(
+            concurrency=args.concurrency, rate=args.rate, speed=args.speed,
+            target=parse_address(args.target) if args.target else None,
+            proxy=parse_address(args.proxy) if args.proxy else None,
+            rewrites=rewrites, timeout=args.timeout)
+        query_text = ' '.join(args.query)
+        parse_query(query_text)
+    except ValueError as e:
+        parser.error(str(e))
+
+    report = replayer.run(iter_flows(CaptureReader(args.dir), query_text, args.repeat))
+    print(json.dumps(report.to_dict(), indent=2) if args.json else report.render())
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+from proxy.eventbus import BATCH_HEADER, STREAM_HEADER, STREAM_MAGIC, VERSION, FlowEvent
+from collections.abc import Iterator
+
+import argparse
+import json
+import socket
+import sys
+
+
+def read_events(path: str) -> Iterator[FlowEvent]:
+    '''
+    Subscribes to the EventBus listening on path and yields its events until the proxy closes the bus.
+
+    >>> for event in read_events('events.sock'):
+    ...     print(event.method, event.uri, event.status)
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        with sock.makefile('rb') as f:
+            magic, version = STREAM_HEADER.unpack(f.read(STREAM_HEADER.size))
+            if magic != STREAM_MAGIC or version != VERSION:
+                raise ValueError(f'{path} is not a flow event stream of version {VERSION}.')
+
+            while True:
+                header = f.read(BATCH_HEADER.size)
+                if len(header) < BATCH_HEADER.size:
+                    return
+                length, count = BATCH_HEADER.unpack(header)
+                payload = memoryview(f.read(length))
+
+                offset = 0
+                for _ in range(count):
+                    event, offset = FlowEvent.decode(payload, offset)
+                    yield event
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog='python -m proxy.subscribe', description='Print the flows published by a running proxy.',
+        epilog='example: python -m proxy.subscribe events.sock --json')
+    parser.add_argument('path', help='event_bus_path of the proxy')
+    parser.add_argument('--json', action='store_true', help='print JSON lines')
+    args = parser.parse_args(argv)
+
+    try:
+        for event in read_events(args.path):
+            if args.json:
+                print(json.dumps(event.to_dict(), ensure_ascii=False), flush=True)
+            else:
+                total = '-' if event.total is None else '%.3f' % (event.total / 1e9)
+                print(event.method, event.uri, event.status or '-', event.size, total, flush=True)
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+from httprequest import Timing
+from collections import deque
+
+import itertools
+import json
+import os
+
+
+MAX_FLOWS = 1000
+
+# (span name, start attribute, end attribute)
+UPSTREAM_SPANS = (
+    ('dns', 'dns_start', 'dns_end'),
+    ('connect', 'connect_start', 'connect_end'),
+    ('tls', 'tls_start', 'tls_end'),
+    ('upstream', 'request_start', 'response_end'),
+)
+
+
+def get_spans(timing: Timing) -> list[tuple[str, int, int]]:
+    spans = list(timing.spans)
+    for name, start_name, end_name in UPSTREAM_SPANS:
+        start = getattr(timing, start_name)
+        end = getattr(timing, end_name)
+        if start is not None and end is not None:
+            spans.append((name, start, end))
+
+    return sorted(spans, key=lambda x: x[1])
+
+
+def get_event(name: str, start: int, end: int, tid: int, category: str = 'proxy', args: dict | None = None) -> dict:
+    # Complete event、時刻はマイクロ秒
+    event = {'name': name, 'cat': category, 'ph': 'X', 'ts': start / 1000, 'dur': (end - start) / 1000,
+             'pid': os.getpid(), 'tid': tid}
+    if args:
+        event['args'] = args
+    return event
+
+
+class Tracer():
+    '''
+    Spans of the most recent flows, exported in the Chrome trace event format.
+    https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+
+    Each flow gets its own row, so open the file in chrome://tracing or https://ui.perfetto.dev.
+    Only the Timing of a flow is kept, not its messages.
+
+    >>> tracer = Tracer()
+    >>> tracer.add('GET http://example.com/', response.timing)
+    >>> tracer.dump('trace.json')
+    '''
+
+    def __init__(self, max_flows: int = MAX_FLOWS):
+        self.flows: deque[tuple[int, str, Timing]] = deque(maxlen=max_flows)
+        self.flow_ids = itertools.count(1)
+
+    def add(self, name: str, timing: Timing):
+        # client_write などは後から timing に足されるので、書き出すときに読む
+        self.flows.append((next(self.flow_ids), name, timing))
+
+    def export(self) -> dict:
+        events = []
+        for flow_id, name, timing in list(self.flows):
+            spans = get_spans(timing)
+            if not spans:
+                continue
+
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': flow_id,
+                           'args': {'name': name}})
+            start = min(x[1] for x in spans)
+            end = max(x[2] for x in spans)
+            events.append(get_event('flow', start, end, flow_id, 'flow', {'name': name}))
+            for span_name, span_start, span_end in spans:
+                events.append(get_event(span_name, span_start, span_end, flow_id))
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, path: str):
+        with open(path, 'wt') as f:
+            json.dump(self.export(), f)
@@ -0,0 +1,51 @@
+from os.path import dirname, abspath
+import sys
+import threading
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+from httprequest.http import PreparedRequest, RequestMessage
+from proxy.accesslog import AccessLog
+
+
+class BrokenFile():
+    def write(self, data):
+        raise OSError('disk full')
+
+    def flush(self):
+        pass
+
+
+def prepared_request() -> PreparedRequest:
+    return PreparedRequest('example.com', 80, False, RequestMessage(b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n'))
+
+
+def test_failed_write_counts_batch_as_dropped():
+    access_log = AccessLog(flush_interval=60)
+    access_log.file = BrokenFile()
+    for _ in range(10):
+        access_log.add(prepared_request(), None)
+    access_log.close()
+
+    assert access_log.written == 0
+    assert access_log.dropped == 10
+
+
+def test_every_record_is_written_or_dropped(tmp_path):
+    access_log = AccessLog(str(tmp_path / 'access.log'), buffer_size=64, flush_interval=0.01)
+    request = prepared_request()
+
+    def add():
+        for _ in range(2000):
+            access_log.add(request, None)
+
+    threads = [threading.Thread(target=add) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    access_log.close()
+
+    assert access_log.written + access_log.dropped == 8 * 2000
+    with open(tmp_path / 'access.log') as f:
+        assert len(f.readlines()) == access_log.written
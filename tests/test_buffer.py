@@ -0,0 +1,91 @@
+from os.path import dirname, abspath
+import sys
+import threading
+
+import pytest
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+from httprequest import buffer
+from httprequest.buffer import Buffer, MemoryBudget
+
+
+@pytest.fixture
+def budget(monkeypatch):
+    budget = MemoryBudget(1000, wait_timeout=0.1)
+    monkeypatch.setattr(buffer, "default_budget", budget)
+    return budget
+
+
+def test_in_memory():
+    b = Buffer(b"abc")
+    b.write(b"def")
+    assert not b.is_spilled()
+    assert len(b) == 6
+    assert bytes(b) == b"abcdef"
+    assert b.get_file() is None
+
+
+def test_spill_and_read_back():
+    b = Buffer(spill_threshold=10)
+    for _ in range(10):
+        b.write(b"0123456789")
+    assert b.is_spilled()
+    assert bytes(b) == b"0123456789" * 10
+    assert b.getbuffer()[:4].tobytes() == b"0123"
+    # 読み出した後の追記も反映される
+    b.write(b"tail")
+    assert bytes(b.getbuffer()[-4:]) == b"tail"
+    assert b"".join(b.iter_chunks(7)) == b"0123456789" * 10 + b"tail"
+    assert b.open().read() == b"0123456789" * 10 + b"tail"
+
+
+def test_spill_threshold_default_and_none(monkeypatch):
+    monkeypatch.setattr(buffer, "default_spill_threshold", 10)
+    assert Buffer(b"x" * 11).is_spilled()
+    assert not Buffer(b"x" * 11, spill_threshold=None).is_spilled()
+
+
+def test_wrap_does_not_spill():
+    b = Buffer.wrap(b"x" * 100)
+    assert not b.is_spilled()
+    assert len(b) == 100
+
+
+def test_budget_is_charged_and_released(budget):
+    b = Buffer(b"x" * 600)
+    assert budget.used == 600
+    # 予算に空きがなければ一時ファイルに移して解放する
+    c = Buffer(b"x" * 600, blocking=False)
+    assert c.is_spilled()
+    assert budget.used == 600
+    b.close()
+    assert budget.used == 0
+    assert budget.peak == 600
+
+
+def test_budget_wait_is_woken_by_release(budget):
+    b = Buffer(b"x" * 600)
+    threading.Timer(0.02, b.close).start()
+    budget.wait_timeout = 5
+    c = Buffer(b"x" * 600)
+    assert not c.is_spilled()
+    assert budget.used == 600
+
+
+def test_budget_wait_times_out(budget):
+    b = Buffer(b"x" * 600)
+    c = Buffer(b"x" * 600)
+    assert c.is_spilled()
+    assert budget.used == len(b)
+
+
+def test_wrap_is_charged(budget):
+    b = Buffer.wrap(b"x" * 1500)
+    # 既にメモリにある分は上限を超えても数える
+    assert budget.used == 1500
+    assert Buffer(b"x" * 10, blocking=False).is_spilled()
+    del b
+    assert budget.used == 0
+    Buffer.wrap(b"x" * 100, charge=False)
+    assert budget.used == 0
@@ -0,0 +1,176 @@
+from os.path import dirname, abspath
+import email.utils
+import sys
+import time
+
+import pytest
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+from httprequest import cache
+from httprequest.cache import Cache, CachedResponse
+from httprequest.http import PreparedRequest, Request, RequestMessage, Response, ResponseMessage
+
+
+def http_date(offset: float = 0) -> str:
+    return email.utils.formatdate(time.time() + offset, usegmt=True)
+
+
+class Origin:
+    """
+    Stands in for PreparedRequest.send: answers with the queued raw responses and records the requests.
+    """
+
+    def __init__(self):
+        self.responses: list[bytes] = []
+        self.requests: list[RequestMessage] = []
+
+    def __call__(self, prepared_request, decode_chunked=True, decode_content=False, use_http2=False, stream=False):
+        self.requests.append(prepared_request.message)
+        message = prepared_request.message
+        request = Request(prepared_request.host, prepared_request.port, prepared_request.is_ssl, message)
+        request.request_time = time.time()
+        return Response(request, time.time(), ResponseMessage(self.responses.pop(0)))
+
+
+@pytest.fixture
+def origin(monkeypatch):
+    origin = Origin()
+    monkeypatch.setattr(PreparedRequest, "send", lambda self, *args, **kwargs: origin(self, *args, **kwargs))
+    return origin
+
+
+def get(c: Cache, headers: str = "", method: str = "GET", target: str = "/a"):
+    raw = f"{method} {target} HTTP/1.1\r\nHost: example.com\r\n{headers}\r\n".encode()
+    return c.send(PreparedRequest("example.com", 443, True, RequestMessage(raw)))
+
+
+def response(headers: str, body: bytes = b"hello", status: str = "200 OK") -> bytes:
+    head = f"HTTP/1.1 {status}\r\nDate: {http_date()}\r\nContent-Length: {len(body)}\r\n{headers}\r\n"
+    return head.encode() + body
+
+
+def test_fresh_response_is_served_from_cache(origin):
+    c = Cache(collapse_timeout=None)
+    origin.responses.append(response("Cache-Control: max-age=60\r\n"))
+
+    assert get(c).cache_status == cache.MISS
+    hit = get(c)
+    assert hit.cache_status == cache.HIT
+    assert bytes(hit.message.body) == b"hello"
+    assert "Age" in hit.message.headers
+    assert len(origin.requests) == 1
+
+
+def test_stale_response_is_revalidated(origin):
+    c = Cache(collapse_timeout=None)
+    origin.responses.append(response('Cache-Control: max-age=0\r\nETag: "v1"\r\n'))
+    origin.responses.append(response("Cache-Control: max-age=60\r\n", b"", "304 Not Modified"))
+
+    get(c)
+    revalidated = get(c)
+    assert origin.requests[1].headers["If-None-Match"] == '"v1"'
+    assert revalidated.cache_status == cache.REVALIDATED
+    assert revalidated.message.status_code == "200"
+    assert bytes(revalidated.message.body) == b"hello"
+    # 304 で更新された max-age で新しいものとして返す
+    assert get(c).cache_status == cache.HIT
+
+
+def test_vary(origin):
+    c = Cache(collapse_timeout=None)
+    origin.responses.append(response("Cache-Control: max-age=60\r\nVary: Accept-Encoding\r\n", b"gzip"))
+    origin.responses.append(response("Cache-Control: max-age=60\r\nVary: Accept-Encoding\r\n", b"br"))
+
+    assert get(c, "Accept-Encoding: gzip\r\n").cache_status == cache.MISS
+    assert get(c, "Accept-Encoding: br\r\n").cache_status == cache.MISS
+    assert bytes(get(c, "Accept-Encoding: gzip\r\n").message.body) == b"gzip"
+    assert bytes(get(c, "Accept-Encoding: br\r\n").message.body) == b"br"
+    assert len(origin.requests) == 2
+
+
+def test_only_if_cached(origin):
+    c = Cache(collapse_timeout=None)
+    assert get(c, "Cache-Control: only-if-cached\r\n").message.status_code == "504"
+    assert not origin.requests
+
+    origin.responses.append(response("Cache-Control: max-age=60\r\n"))
+    get(c)
+    assert get(c, "Cache-Control: only-if-cached\r\n").cache_status == cache.HIT
+
+
+def test_request_directives(origin):
+    c = Cache(collapse_timeout=None)
+    origin.responses.append(response("Cache-Control: max-age=60\r\n"))
+    origin.responses.append(response("Cache-Control: max-age=60\r\n"))
+    get(c)
+
+    assert get(c, "Cache-Control: no-cache\r\n").cache_status == cache.MISS
+    assert len(origin.requests) == 2
+
+
+def test_conditional_request_is_answered_locally(origin):
+    c = Cache(collapse_timeout=None)
+    origin.responses.append(response('Cache-Control: max-age=60\r\nETag: W/"v1"\r\n'))
+    get(c)
+
+    not_modified = get(c, 'If-None-Match: "v1"\r\n')
+    assert not_modified.message.status_code == "304"
+    assert len(origin.requests) == 1
+
+
+@pytest.mark.parametrize("headers", ["Cache-Control: no-store\r\n", "Cache-Control: private, max-age=60\r\n",
+                                     "Cache-Control: max-age=60\r\nSet-Cookie: a=1\r\n",
+                                     "Cache-Control: max-age=60\r\nVary: *\r\n"])
+def test_not_storable(origin, headers):
+    c = Cache(collapse_timeout=None)
+    origin.responses.append(response(headers))
+    origin.responses.append(response(headers))
+
+    get(c)
+    assert get(c).cache_status == cache.MISS
+
+
+def test_unsafe_method_invalidates(origin):
+    c = Cache(collapse_timeout=None)
+    origin.responses.append(response("Cache-Control: max-age=60\r\n"))
+    origin.responses.append(response("", b""))
+    origin.responses.append(response("Cache-Control: max-age=60\r\n"))
+
+    get(c)
+    assert get(c, "Content-Length: 0\r\n", method="POST").cache_status == cache.BYPASS
+    assert get(c).cache_status == cache.MISS
+
+
+def stored(headers: str, status: str = "200 OK") -> CachedResponse:
+    now = time.time()
+    raw_header = f"HTTP/1.1 {status}\r\n{headers}\r\n".encode()
+    return CachedResponse("key", (), raw_header, None, 0, now, now)
+
+
+def test_freshness_lifetime():
+    assert stored("Cache-Control: max-age=60, s-maxage=10\r\n").get_freshness_lifetime() == 10
+    assert stored("Cache-Control: max-age=abc\r\n").get_freshness_lifetime() == 0
+    lifetime = stored(f"Date: {http_date()}\r\nExpires: {http_date(100)}\r\n").get_freshness_lifetime()
+    assert 99 <= lifetime <= 101
+    assert stored(f"Date: {http_date()}\r\nExpires: 0\r\n").get_freshness_lifetime() == 0
+    # 最終更新からの経過時間の 10%
+    lifetime = stored(f"Date: {http_date()}\r\nLast-Modified: {http_date(-1000)}\r\n").get_freshness_lifetime()
+    assert 99 <= lifetime <= 101
+    assert stored(f"Last-Modified: {http_date(-1000)}\r\n", "302 Found").get_freshness_lifetime() == 0
+
+
+def test_current_age():
+    assert stored("Age: 30\r\n").get_current_age(time.time() + 10) == pytest.approx(40, abs=1)
+
+
+def test_disk_tier_survives_restart(origin, tmp_path):
+    c = Cache(disk_path=str(tmp_path), disk_threshold=0, collapse_timeout=None)
+    origin.responses.append(response("Cache-Control: max-age=60\r\n"))
+    get(c)
+
+    restarted = Cache(disk_path=str(tmp_path), disk_threshold=0, collapse_timeout=None)
+    hit = get(restarted)
+    assert hit.cache_status == cache.HIT
+    assert bytes(hit.message.body) == b"hello"
+    assert len(origin.requests) == 1
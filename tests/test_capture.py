@@ -0,0 +1,66 @@
+from os.path import dirname, abspath
+import sys
+import time
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+from httprequest.http import PreparedRequest, Request, RequestMessage, Response, ResponseMessage
+from proxy.capture import CaptureReader, CaptureStore
+
+
+def flow(body: bytes = b'hello') -> tuple[PreparedRequest, Response]:
+    message = RequestMessage(b'GET /a HTTP/1.1\r\nHost: example.com\r\n\r\n')
+    prepared_request = PreparedRequest('example.com', 80, False, message)
+    raw = b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + body
+    request = Request('example.com', 80, False, message)
+    request.request_time = time.time()
+    response = Response(request, time.time(), ResponseMessage(raw))
+    return prepared_request, response
+
+
+def test_flow_is_serialized_on_add(tmp_path):
+    store = CaptureStore(str(tmp_path))
+    prepared_request, response = flow()
+    store.add(prepared_request, response)
+    # キューに入れた後で変わっても記録には影響しない
+    response.message.body.set_body(b'changed')
+    store.close()
+
+    reader = CaptureReader(str(tmp_path))
+    flows = list(reader.find(host='example.com'))
+    assert len(flows) == 1
+    assert flows[0].response.tobytes().endswith(b'\r\n\r\nhello')
+    reader.close()
+
+
+def test_queue_is_bounded_by_bytes(tmp_path):
+    store = CaptureStore(str(tmp_path), queue_bytes=1024)
+    # 書き込みスレッドを止めておく
+    store.queue.put_nowait(None)
+    store.thread.join()
+
+    store.add(*flow(b'x' * 600))
+    store.add(*flow(b'x' * 600))
+    assert store.queue.qsize() == 1
+    assert store.dropped == 1
+
+
+def test_writer_survives_failing_flow(tmp_path):
+    store = CaptureStore(str(tmp_path))
+    write_flow = store.write_flow
+    calls = []
+
+    def failing(flow):
+        calls.append(flow)
+        if len(calls) == 1:
+            raise RuntimeError('broken')
+        write_flow(flow)
+
+    store.write_flow = failing
+    store.add(*flow())
+    store.add(*flow())
+    store.close()
+
+    assert store.dropped == 1
+    assert store.written == 1
+    assert store.queued_bytes == 0
@@ -0,0 +1,47 @@
+from os.path import dirname, abspath
+import ssl
+import sys
+
+import pytest
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+from proxy import cert
+
+
+def test_altname_uses_config_syntax():
+    assert cert.get_altname('example.com') == b'DNS:example.com'
+    assert cert.get_altname('127.0.0.1') == b'IP:127.0.0.1'
+    assert cert.get_altname('::1') == b'IP:::1'
+
+
+def test_csr_has_pkcs10_version():
+    private_key = cert.generate_keypair()
+    cacert, _ = cert.create_cacert(private_key)
+    csr = cert.create_csr(private_key, cacert.get_subject())
+
+    assert csr.get_version() == 0
+    assert csr.verify(private_key)
+
+
+def test_server_cert_copies_ip_altname(tmp_path, monkeypatch):
+    e2e = pytest.importorskip('benchmarks.e2e')
+    ca_key_path, ca_cert_path = e2e.create_test_ca(str(tmp_path))
+    key_path, cert_path = e2e.create_origin_cert(str(tmp_path), ca_key_path, ca_cert_path, ['localhost', '127.0.0.1'])
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(cert_path, key_path)
+    port = e2e.get_free_port()
+    origin = e2e.start_origin(port, ssl_context)
+    # オリジンの証明書を検証できるように、テスト用の CA を信頼させる
+    monkeypatch.setenv('SSL_CERT_FILE', ca_cert_path)
+    try:
+        private_key, _ = cert.get_private_key(ca_key_path)
+        cacert, _ = cert.get_cacert(ca_cert_path)
+        server_cert, _ = cert.create_server_cert('127.0.0.1', port, private_key, cacert)
+    finally:
+        origin.shutdown()
+        origin.server_close()
+
+    altnames = [str(server_cert.get_extension(i)) for i in range(server_cert.get_extension_count())
+                if server_cert.get_extension(i).get_short_name() == b'subjectAltName']
+    assert altnames == ['DNS:localhost, IP Address:127.0.0.1']
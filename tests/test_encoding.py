@@ -0,0 +1,81 @@
+from os.path import dirname, abspath
+import gzip
+import os
+import sys
+import zlib
+
+import brotli
+import pytest
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+from httprequest import encoding, exceptions
+from httprequest.http import ResponseMessage
+
+
+def split(data: bytes, size: int) -> list[bytes]:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+DATA = os.urandom(1000) * 50 + b"x" * 100000
+
+
+def test_gzip_multi_member_in_one_call():
+    data = gzip.compress(DATA) + gzip.compress(b"tail")
+    assert encoding.decode(data, "gzip") == DATA + b"tail"
+
+
+def test_gzip_multi_member_across_calls():
+    member1, member2 = gzip.compress(b"member1"), gzip.compress(b"member2")
+    assert b"".join(encoding.iter_decode([member1, member2], "gzip")) == b"member1member2"
+
+
+@pytest.mark.parametrize("size", [1, 7, 4096])
+def test_gzip_multi_member_split_anywhere(size):
+    data = gzip.compress(DATA) + gzip.compress(b"second") + gzip.compress(b"third")
+    assert b"".join(encoding.iter_decode(split(data, size), "gzip")) == DATA + b"secondthird"
+
+
+@pytest.mark.parametrize("size", [1, 3, 4096])
+def test_gzip_zero_padding(size):
+    # gzip.decompress と同じく、メンバーの後ろのゼロ埋めは受け付ける
+    data = gzip.compress(b"hello world") + b"\0" * 8 + gzip.compress(b"!") + b"\0" * 8
+    assert gzip.decompress(data) == b"hello world!"
+    assert b"".join(encoding.iter_decode(split(data, size), "gzip")) == b"hello world!"
+
+
+def test_gzip_zero_padding_in_response():
+    raw = gzip.compress(b"hello world") + b"\0" * 8
+    head = b"HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\nContent-Length: %d\r\n\r\n" % len(raw)
+    message = ResponseMessage(head + raw)
+    message.prepare_body(True, True)
+    assert bytes(message.body) == b"hello world"
+
+
+def test_deflate_with_and_without_zlib_header():
+    assert encoding.decode(zlib.compress(DATA), "deflate") == DATA
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    raw = compressor.compress(DATA) + compressor.flush()
+    assert b"".join(encoding.iter_decode(split(raw, 100), "deflate")) == DATA
+
+
+def test_stacked_codings():
+    data = brotli.compress(gzip.compress(DATA))
+    assert encoding.decode(data, "gzip, br") == DATA
+
+
+def test_round_trip():
+    for coding in ("gzip", "deflate", "br"):
+        assert encoding.decode(encoding.encode(DATA, coding), coding) == DATA
+
+
+def test_max_size():
+    limits = encoding.DecodeLimits(max_size=1000, max_ratio=None)
+    with pytest.raises(exceptions.DecompressionLimitError):
+        encoding.decode(gzip.compress(DATA), "gzip", limits)
+
+
+def test_max_ratio():
+    limits = encoding.DecodeLimits(max_size=None, max_ratio=10)
+    with pytest.raises(exceptions.DecompressionLimitError):
+        encoding.decode(gzip.compress(b"\0" * 10 * 1024 * 1024), "gzip", limits)
@@ -0,0 +1,80 @@
+from os.path import dirname, abspath
+import socket
+import sys
+import threading
+import time
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+from httprequest.http import PreparedRequest, Request, RequestMessage, Response, ResponseMessage
+from proxy import eventbus
+from proxy.eventbus import EventBus, Subscriber
+from proxy.subscribe import read_events
+
+
+def flow(method: str = 'GET', body: bytes = b'hello') -> tuple[PreparedRequest, Response]:
+    message = RequestMessage(method=method, request_target='/a', http_version='HTTP/1.1',
+                             headers={'Host': 'example.com'})
+    prepared_request = PreparedRequest('example.com', 80, False, message)
+    request = Request('example.com', 80, False, message)
+    request.request_time = time.time()
+    raw = b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) + body
+    return prepared_request, Response(request, time.time(), ResponseMessage(raw))
+
+
+def wait_for_subscriber(bus: EventBus):
+    deadline = time.monotonic() + 5
+    while not bus.subscribers and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_events_are_encoded_at_publish(tmp_path):
+    bus = EventBus(str(tmp_path / 'events.sock'), include_bodies=True)
+    events = read_events(bus.path)
+    # 接続は最初のイベントを読むときに張られる
+    prepared_request, response = flow()
+    first = None
+
+    def publish():
+        wait_for_subscriber(bus)
+        bus.publish(prepared_request, response)
+        # 送る前に変わっても、イベントは publish したときの内容
+        response.message.body.set_body(b'changed')
+        bus.close()
+
+    threading.Thread(target=publish).start()
+    for event in events:
+        first = first or event
+
+    assert first.method == 'GET'
+    assert first.response_body == b'hello'
+
+
+def test_failed_encoding_is_dropped(tmp_path, monkeypatch):
+    bus = EventBus(str(tmp_path / 'events.sock'))
+    subscriber = Subscriber(socket.socket(socket.AF_UNIX), 10, 1024)
+    bus.subscribers.append(subscriber)
+
+    def fail(*args):
+        raise OverflowError('too long')
+
+    monkeypatch.setattr(eventbus, 'encode_event', fail)
+    bus.publish(*flow())
+
+    assert bus.dropped == 1
+    assert not subscriber.events
+    subscriber.socket.close()
+    bus.close()
+
+
+def test_subscriber_queue_is_bounded_by_bytes():
+    subscriber = Subscriber(socket.socket(socket.AF_UNIX), 10, 1024)
+    subscriber.put(b'x' * 600)
+    subscriber.put(b'x' * 600)
+    subscriber.put(b'x' * 100)
+
+    assert len(subscriber.events) == 2
+    assert subscriber.dropped == 1
+    assert subscriber.get_batch() == [b'x' * 600, b'x' * 100]
+    assert subscriber.queued_bytes == 0
+    subscriber.socket.close()
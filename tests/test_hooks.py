@@ -0,0 +1,136 @@
+from os.path import dirname, abspath
+import asyncio
+import sys
+import threading
+
+import pytest
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+from httprequest.http import PreparedRequest, RequestMessage, ResponseMessage
+from proxy.hooks import Hook, HookRunner, hook
+
+
+def prepared_request(method: str = 'GET', host: str = 'example.com') -> PreparedRequest:
+    message = RequestMessage(b'%s / HTTP/1.1\r\nHost: %s\r\n\r\n' % (method.encode(), host.encode()))
+    return PreparedRequest(host, 80, False, message)
+
+
+def test_drop_overflow_counts_dropped_calls():
+    release = threading.Event()
+    called = []
+
+    @hook(offload=True)
+    def blocking(flow):
+        called.append(flow)
+        release.wait(5)
+
+    runner = HookRunner([blocking], queue_size=1, overflow='drop')
+    runner.offload('request', prepared_request())
+    runner.offload('request', prepared_request())
+    release.set()
+    runner.close()
+
+    assert len(called) == 1
+    assert runner.dropped == 1
+    assert runner.get_stats()['request:' + blocking.__qualname__]['dropped'] == 1
+    assert runner.pending == 0
+
+
+def test_queue_overflow_waits_for_a_slot():
+    called = []
+
+    @hook(offload=True)
+    def slow(flow):
+        called.append(flow)
+
+    runner = HookRunner([slow], queue_size=1, overflow='queue')
+    for _ in range(20):
+        runner.offload('request', prepared_request())
+    runner.close()
+
+    assert len(called) == 20
+    assert runner.dropped == 0
+
+
+def test_coroutine_hooks_inline_and_offloaded():
+    offloaded = []
+
+    async def inline(flow):
+        flow.message.headers['X-Hooked'] = '1'
+
+    @hook(offload=True)
+    async def observe(flow):
+        await asyncio.sleep(0.2)
+        offloaded.append(flow.message.headers['X-Hooked'])
+
+    runner = HookRunner([inline, observe])
+    flow = prepared_request()
+    runner.run_inline('request', flow)
+    runner.offload('request', flow)
+    # close() は残っているコルーチンの呼び出しを待つ
+    runner.close()
+
+    assert flow.message.headers['X-Hooked'] == '1'
+    assert offloaded == ['1']
+
+
+def test_errors_are_counted():
+    def inline(flow):
+        raise ValueError('inline')
+
+    @hook(offload=True)
+    def offloaded(flow):
+        raise ValueError('offloaded')
+
+    runner = HookRunner([inline, offloaded])
+    with pytest.raises(ValueError):
+        runner.run_inline('request', prepared_request())
+    runner.offload('request', prepared_request())
+    runner.close()
+
+    stats = runner.get_stats()
+    assert stats['request:' + inline.__qualname__]['errors'] == 1
+    assert stats['request:' + offloaded.__qualname__]['errors'] == 1
+    assert stats['request:' + offloaded.__qualname__]['calls'] == 1
+
+
+def response_message(content_type: str) -> ResponseMessage:
+    return ResponseMessage(b'HTTP/1.1 200 OK\r\nContent-Type: %s\r\nContent-Length: 0\r\n\r\n' % content_type.encode())
+
+
+def test_hook_matches_host_method_and_content_type():
+    @hook(hosts=['*.example.com'], methods=['get'], content_types=['application/json', 'text/*'])
+    def filtered(flow):
+        pass
+
+    matches = Hook(filtered).matches
+    assert matches(prepared_request('GET', 'api.example.com'))
+    assert matches(prepared_request('GET', 'API.Example.com'))
+    assert not matches(prepared_request('GET', 'example.org'))
+    assert not matches(prepared_request('POST', 'api.example.com'))
+    assert matches(prepared_request('GET', 'api.example.com'), response_message('application/json; charset=utf-8'))
+    assert matches(prepared_request('GET', 'api.example.com'), response_message('text/html'))
+    assert not matches(prepared_request('GET', 'api.example.com'), response_message('image/png'))
+    # リクエストのないフローには、フィルターのないフックだけが関心を持つ
+    assert not matches(None)
+    assert Hook(lambda flow: None).matches(None)
+
+
+def test_needs_body():
+    @hook(content_types=['application/json'])
+    def json_hook(flow):
+        pass
+
+    @hook(body=False)
+    def head_only(flow):
+        pass
+
+    runner = HookRunner(response_hooks=[json_hook, head_only])
+    request = prepared_request()
+    # レスポンスのメッセージがなければ content_types で絞るフックも関心ありとみなす
+    assert runner.needs_body(request)
+    assert runner.needs_body(request, response_message('application/json'))
+    assert not runner.needs_body(request, response_message('image/png'))
+    assert not HookRunner(response_hooks=[head_only]).needs_body(request)
+    runner.close()
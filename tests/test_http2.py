@@ -0,0 +1,68 @@
+from os.path import dirname, abspath
+import socket
+import sys
+import threading
+
+import h2.config
+import h2.connection
+import h2.events
+import pytest
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+from httprequest import exceptions, http2
+from httprequest.http import RequestMessage
+from httprequest.http2 import H2Connection
+
+
+def serve(sock: socket.socket, goaway: bool) -> None:
+    """
+    A minimal HTTP/2 server: answers every request with "ok", or sends GOAWAY without processing it.
+    """
+    conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding="utf-8"))
+    conn.initiate_connection()
+    sock.sendall(conn.data_to_send())
+    while True:
+        try:
+            data = sock.recv(65536)
+        except OSError:
+            break
+        if not data:
+            break
+        for event in conn.receive_data(data):
+            if isinstance(event, h2.events.StreamEnded):
+                if goaway:
+                    conn.close_connection(last_stream_id=0)
+                else:
+                    conn.send_headers(event.stream_id, [(":status", "200"), ("content-length", "2")])
+                    conn.send_data(event.stream_id, b"ok", end_stream=True)
+        sock.sendall(conn.data_to_send())
+    sock.close()
+
+
+def connect(goaway: bool) -> H2Connection:
+    client, server = socket.socketpair()
+    threading.Thread(target=serve, args=(server, goaway), daemon=True).start()
+    return H2Connection(client)
+
+
+def test_stream_above_goaway_is_not_processed():
+    conn = connect(goaway=True)
+    with pytest.raises(exceptions.StreamNotProcessedError):
+        conn.request("GET", "example.com", "/", [], b"", timeout=5)
+
+    # 閉じたコネクションへの新しいリクエストも送られていない
+    with pytest.raises(exceptions.StreamNotProcessedError):
+        conn.request("GET", "example.com", "/", [], b"", timeout=5)
+
+
+def test_send_retries_unprocessed_stream_on_new_connection(monkeypatch):
+    connections = [connect(goaway=True), connect(goaway=False)]
+    monkeypatch.setattr(http2.default_pool, "connect", lambda *args, **kwargs: connections.pop(0))
+
+    message = RequestMessage(b"GET / HTTP/1.1\r\nHost: example.com\r\n\r\n")
+    response = message.send("example.com", 443, True, use_http2=True)
+
+    assert response.message.status_code == "200"
+    assert bytes(response.message.body) == b"ok"
+    assert not connections
@@ -0,0 +1,62 @@
+from os.path import dirname, abspath
+import sys
+import time
+
+import pytest
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+from httprequest.http import PreparedRequest, Request, RequestMessage, Response, ResponseMessage
+from proxy import query
+from proxy.capture import CaptureReader, CaptureStore
+from proxy.query import parse_query, run_query
+
+
+def flow(path: str, total: int | None = None) -> tuple[PreparedRequest, Response]:
+    message = RequestMessage(b'GET %s HTTP/1.1\r\nHost: example.com\r\n\r\n' % path.encode())
+    prepared_request = PreparedRequest('example.com', 80, False, message)
+    request = Request('example.com', 80, False, message)
+    request.request_time = time.time()
+    response = Response(request, time.time(), ResponseMessage(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n'))
+    if total is not None:
+        response.timing.request_start = 0
+        response.timing.request_end = 0
+        response.timing.first_byte = total // 2
+        response.timing.response_end = total
+    return prepared_request, response
+
+
+@pytest.fixture(params=['numpy', 'plain'])
+def reader(request, tmp_path, monkeypatch):
+    if request.param == 'plain':
+        monkeypatch.setattr(query, 'numpy', None)
+    elif query.numpy is None:
+        pytest.skip('numpy is not installed')
+
+    store = CaptureStore(str(tmp_path))
+    # 時間が分からない 3 つと、50ms と 2s のフロー
+    for i in range(3):
+        store.add(*flow(f'/unknown{i}'))
+    store.add(*flow('/fast', 50 * 10**6))
+    store.add(*flow('/slow', 2 * 10**9))
+    store.close()
+
+    reader = CaptureReader(str(tmp_path))
+    yield reader
+    reader.close()
+
+
+def paths(reader: CaptureReader, text: str) -> list[str]:
+    return [row['path'] for row in run_query(reader, parse_query(text))]
+
+
+def test_flows_without_timing_match_no_duration_condition(reader):
+    assert paths(reader, 'faster than 1s') == ['/fast']
+    assert paths(reader, 'latency<1s') == ['/fast']
+    assert paths(reader, 'ttfb<=2s') == ['/fast', '/slow']
+    assert paths(reader, 'latency!=50ms') == ['/slow']
+    assert paths(reader, 'slower than 1s') == ['/slow']
+
+
+def test_flows_without_timing_match_other_conditions(reader):
+    assert len(paths(reader, 'status=200')) == 5
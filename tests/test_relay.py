@@ -0,0 +1,126 @@
+from os.path import dirname, abspath
+from types import SimpleNamespace
+import socket
+import sys
+import threading
+
+import pytest
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+from httprequest.http import PreparedRequest, RequestMessage
+from httprequest.tube import Tube
+from proxy import main
+from proxy.hooks import HookRunner, hook
+from proxy.profiler import FlowProfiler
+
+HEAD = b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nTransfer-Encoding: chunked\r\n\r\n'
+# 拡張付きのチャンクもそのまま届くこと
+CHUNKS = b'5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\n\r\n'
+
+
+class Origin():
+    '''
+    Answers one request with HEAD + CHUNKS, then records whether the proxy closed the connection.
+    '''
+
+    def __init__(self):
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen()
+        self.port = self.server.getsockname()[1]
+        self.closed = threading.Event()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        sock, _ = self.server.accept()
+        with sock:
+            data = b''
+            while b'\r\n\r\n' not in data:
+                data += sock.recv(4096)
+            sock.sendall(HEAD + CHUNKS)
+            sock.settimeout(5)
+            try:
+                if not sock.recv(1):
+                    self.closed.set()
+            except OSError:
+                pass
+
+
+@pytest.fixture
+def origin():
+    origin = Origin()
+    yield origin
+    origin.server.close()
+
+
+@pytest.fixture(autouse=True)
+def proxy_config(monkeypatch):
+    for name, value in (('stream_responses', True), ('decode_content', False), ('chunked_passthrough', True),
+                        ('upstream_http2', False)):
+        monkeypatch.setattr(main.config, name, value, raising=False)
+
+
+def relay(origin: Origin, response_hooks) -> tuple[object, bytes]:
+    server = SimpleNamespace(hooks=HookRunner(response_hooks=response_hooks), cache=None, metrics=None,
+                             compressor=None, capture=None, event_bus=None, access_log=None, tracer=None,
+                             flow_profiler=FlowProfiler())
+    handler = object.__new__(main.TCPHandler)
+    handler.server = server
+    handler.spans = []
+
+    client, proxy_side = socket.socketpair()
+    tube = Tube()
+    tube.socket = proxy_side
+    message = RequestMessage(b'GET /a HTTP/1.1\r\nHost: 127.0.0.1:%d\r\n\r\n' % origin.port)
+    try:
+        response = handler.relay(PreparedRequest('127.0.0.1', origin.port, False, message), tube)
+    finally:
+        proxy_side.close()
+        server.hooks.close()
+
+    received = b''
+    while True:
+        data = client.recv(65536)
+        if not data:
+            break
+        received += data
+    client.close()
+    return response, received
+
+
+def test_streamed_chunked_response_is_relayed_unchanged(origin):
+    @hook(body=False)
+    def head_only(response):
+        pass
+
+    response, received = relay(origin, [head_only])
+
+    assert received == HEAD + CHUNKS
+    assert response.get_size() == len(HEAD) + len(CHUNKS)
+    assert origin.closed.wait(5)
+
+
+def test_body_hook_reads_the_body(origin):
+    bodies = []
+
+    def read(response):
+        bodies.append(bytes(response.message.body))
+
+    response, received = relay(origin, [read])
+
+    # ボディを読んだレスポンスは呼び出し元が送る
+    assert received == b''
+    assert response.stream is None
+    assert bodies == [CHUNKS]
+    assert origin.closed.wait(5)
+
+
+def test_raising_hook_closes_upstream(origin):
+    @hook(body=False)
+    def broken(response):
+        raise ValueError('broken')
+
+    with pytest.raises(ValueError):
+        relay(origin, [broken])
+    assert origin.closed.wait(5)
@@ -0,0 +1,47 @@
+from os.path import dirname, abspath
+import socket
+import sys
+import time
+
+import pytest
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+from httprequest import RequestMessage
+from proxy.capture import CapturedFlow
+from proxy.replay import Replayer, send_via_proxy
+
+
+def captured_flow(port: int, is_ssl: bool = False) -> CapturedFlow:
+    request = memoryview(b'GET /small HTTP/1.1\r\nHost: 127.0.0.1:%d\r\n\r\n' % port)
+    return CapturedFlow(1, 0, time.time(), time.time(), {}, '127.0.0.1', port, is_ssl, request, memoryview(b''))
+
+
+def test_direct_send_uses_timeout():
+    # 接続は受けるが何も返さないオリジン
+    with socket.socket() as server:
+        server.bind(('127.0.0.1', 0))
+        server.listen()
+        port = server.getsockname()[1]
+
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            Replayer(timeout=1).send(captured_flow(port))
+        assert time.monotonic() - start < 5
+
+
+def test_https_through_proxy(tmp_path):
+    e2e = pytest.importorskip('benchmarks.e2e')
+    bench = e2e.Bench(str(tmp_path))
+    proxy = e2e.ProxyProcess(str(tmp_path / 'proxy'), bench.get_proxy_config(), bench.ca_cert_path)
+    try:
+        address = ('127.0.0.1', proxy.port)
+        message = RequestMessage(method='GET', request_target='/small', http_version='HTTP/1.1',
+                                 headers={'Host': f'127.0.0.1:{bench.https_port}'})
+        assert send_via_proxy(address, message, '127.0.0.1', bench.https_port, True, timeout=10) == '200'
+
+        report = Replayer(proxy=address, timeout=10).run([captured_flow(bench.https_port, True)])
+        assert report.statuses == {'200': 1}
+    finally:
+        proxy.stop()
+        bench.close()
@@ -0,0 +1,127 @@
+from os.path import dirname, abspath
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+from httprequest import resolver
+from httprequest.resolver import Resolver, connect, sort_addrinfo
+
+
+V4 = (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", 80))
+V6 = (socket.AF_INET6, socket.SOCK_STREAM, 6, "", ("::1", 80, 0, 0))
+
+
+class FakeGetaddrinfo:
+    def __init__(self):
+        self.calls = 0
+        self.answer: list | Exception = [V4]
+
+    def __call__(self, host, port, family=0, type=0):
+        self.calls += 1
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return list(self.answer)
+
+
+@pytest.fixture
+def getaddrinfo(monkeypatch):
+    fake = FakeGetaddrinfo()
+    monkeypatch.setattr(socket, "getaddrinfo", fake)
+    return fake
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_positive_cache(getaddrinfo, clock):
+    r = Resolver(ttl=60)
+    assert r.resolve("example.com", 80) == [V4]
+    assert r.resolve("example.com", 80) == [V4]
+    assert getaddrinfo.calls == 1
+
+    clock[0] += 61
+    r.stale_ttl = 0
+    r.resolve("example.com", 80)
+    assert getaddrinfo.calls == 2
+
+
+def test_negative_cache(getaddrinfo, clock):
+    r = Resolver(negative_ttl=5)
+    getaddrinfo.answer = socket.gaierror(socket.EAI_NONAME, "not found")
+    for _ in range(3):
+        with pytest.raises(socket.gaierror):
+            r.resolve("missing.example", 80)
+    assert getaddrinfo.calls == 1
+
+    clock[0] += 6
+    getaddrinfo.answer = [V4]
+    assert r.resolve("missing.example", 80) == [V4]
+
+
+def test_stale_answer_is_refreshed_in_background(getaddrinfo, clock, monkeypatch):
+    started = []
+    monkeypatch.setattr(threading.Thread, "start", lambda self: started.append(self) or self.run())
+
+    r = Resolver(ttl=60, stale_ttl=300)
+    r.resolve("example.com", 80)
+    clock[0] += 100
+    getaddrinfo.answer = [V6]
+    # 古い答えをすぐ返し、裏で引き直した答えを次から使う
+    assert r.resolve("example.com", 80) == [V4]
+    assert len(started) == 1
+    assert r.resolve("example.com", 80) == [V6]
+
+
+def test_failed_refresh_keeps_stale_answer(getaddrinfo, clock, monkeypatch):
+    monkeypatch.setattr(threading.Thread, "start", lambda self: self.run())
+
+    r = Resolver(ttl=60, stale_ttl=300)
+    r.resolve("example.com", 80)
+    clock[0] += 100
+    getaddrinfo.answer = socket.gaierror(socket.EAI_AGAIN, "temporary failure")
+    assert r.resolve("example.com", 80) == [V4]
+    assert r.resolve("example.com", 80) == [V4]
+
+    clock[0] += 300
+    with pytest.raises(socket.gaierror):
+        r.resolve("example.com", 80)
+
+
+def test_max_entries(getaddrinfo, clock):
+    r = Resolver(max_entries=2)
+    for host in ("a", "b", "c"):
+        r.resolve(host, 80)
+    r.resolve("a", 80)
+    assert getaddrinfo.calls == 4
+
+
+def test_sort_addrinfo_interleaves_families():
+    v6 = [V6, (*V6[:4], ("::2", 80, 0, 0))]
+    v4 = [V4]
+    assert sort_addrinfo(v6 + v4) == [v6[0], V4, v6[1]]
+    assert sort_addrinfo([]) == []
+
+
+def test_connect_skips_unreachable_address():
+    server = socket.create_server(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+    # 閉じたポートは接続拒否ですぐ失敗し、次のアドレスに進む
+    closed = socket.create_server(("127.0.0.1", 0))
+    closed_port = closed.getsockname()[1]
+    closed.close()
+
+    addrinfo = [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", closed_port)),
+                (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", port))]
+    sock = connect(addrinfo, timeout=5, delay=resolver.CONNECTION_ATTEMPT_DELAY)
+    assert sock.getpeername()[1] == port
+    sock.close()
+    server.close()
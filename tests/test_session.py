@@ -0,0 +1,141 @@
+from os.path import dirname, abspath
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+import sys
+import threading
+import time
+
+import pytest
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+from httprequest.aio import AsyncSession
+from httprequest.session import Session
+
+LARGE_SIZE = 16 * 1024 * 1024
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        # HEAD へのレスポンスは Content-Length があってもボディを持たない
+        self.send_response(200)
+        self.send_header("Content-Length", "100")
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == "/large":
+            self.send_response(200)
+            self.send_header("Content-Length", str(LARGE_SIZE))
+            self.end_headers()
+            try:
+                for _ in range(LARGE_SIZE // 65536):
+                    self.wfile.write(b"x" * 65536)
+            except OSError:
+                # 途中で切断された
+                pass
+            return
+
+        if self.headers.get("If-None-Match") == '"a"':
+            self.send_response(304)
+            self.send_header("ETag", '"a"')
+            self.send_header("Content-Length", "5")
+            self.end_headers()
+            return
+
+        time.sleep(0.05)
+        self.send_response(200)
+        self.send_header("Content-Length", "5")
+        self.end_headers()
+        self.wfile.write(b"hello")
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def origin():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:%d" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_head_and_304_end_without_body(origin):
+    with Session(timeout=5) as session:
+        start = time.monotonic()
+        head = session.request("HEAD", origin + "/")
+        not_modified = session.get(origin + "/", headers={"If-None-Match": '"a"'})
+        assert time.monotonic() - start < 2
+
+        assert head.message.status_code == "200"
+        assert not_modified.message.status_code == "304"
+        # ボディがないことが分かるので、接続は使い回せる
+        assert session.pool.reused == 1
+
+
+def test_connection_close_request_is_not_kept_alive(origin):
+    with Session(timeout=5) as session:
+        session.get(origin + "/", headers={"Connection": "close"})
+        assert session.pool.get_idle_count() == 0
+
+
+def test_fetch_many_restores_idle_limit(origin):
+    with Session(max_idle_per_host=1, timeout=5) as session:
+        results = list(session.fetch_many([origin + "/"] * 16, concurrency=8))
+        assert all(response.message.status_code == "200" for _, response in results)
+        assert session.pool.max_idle_per_host == 1
+        assert session.pool.get_idle_count() == 1
+
+
+def test_async_head_and_304_end_without_body(origin):
+    async def run():
+        async with AsyncSession(timeout=5) as session:
+            head = await session.request("HEAD", origin + "/")
+            not_modified = await session.get(origin + "/", headers={"If-None-Match": '"a"'})
+            return head, not_modified, session.pool.reused
+
+    start = time.monotonic()
+    head, not_modified, reused = asyncio.run(run())
+    assert time.monotonic() - start < 2
+    assert head.message.status_code == "200"
+    assert not_modified.message.status_code == "304"
+    assert reused == 1
+
+
+def test_async_stream(origin):
+    async def run():
+        async with AsyncSession(timeout=5) as session:
+            async with session.stream("GET", origin + "/") as response:
+                body = b"".join([data async for data in response])
+            # 読み切った接続は使い回す
+            assert session.pool.get_idle_count() == 1
+
+            async with session.stream("GET", origin + "/large") as response:
+                async for data in response:
+                    break
+            # 途中まで読んだ接続は捨てる
+            assert session.pool.get_idle_count() == 0
+
+            again = await session.get(origin + "/")
+            return body, session.pool.created, again
+
+    body, created, again = asyncio.run(run())
+    assert body == b"hello"
+    assert created == 2
+    assert bytes(again.message.body) == b"hello"
+
+
+def test_async_fetch_many_restores_idle_limit(origin):
+    async def run():
+        async with AsyncSession(max_idle_per_host=1, timeout=5) as session:
+            results = [x async for x in session.fetch_many([origin + "/"] * 16, concurrency=8)]
+            return results, session.pool.max_idle_per_host, session.pool.get_idle_count()
+
+    results, max_idle_per_host, idle = asyncio.run(run())
+    assert all(response.message.status_code == "200" for _, response in results)
+    assert max_idle_per_host == 1
+    assert idle == 1
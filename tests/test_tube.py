@@ -0,0 +1,53 @@
+from os.path import dirname, abspath
+import socket
+import sys
+import threading
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+import h11
+
+from httprequest import buffer
+from httprequest.buffer import Buffer, MemoryBudget
+from httprequest.tube import Tube
+
+
+def recv_all(sock: socket.socket, size: int) -> bytes:
+    received = bytearray()
+    while len(received) < size:
+        received += sock.recv(65536)
+    return bytes(received)
+
+
+def test_send_message():
+    for body in (Buffer(b"small"), Buffer(b"x" * 1000000, spill_threshold=None),
+                 Buffer(b"y" * 1000000, spill_threshold=1000)):
+        client, server = socket.socketpair()
+        tube = Tube()
+        tube.socket = client
+        head = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body)
+        threading.Thread(target=tube.send_message, args=(head, body)).start()
+        assert recv_all(server, len(head) + len(body)) == head + bytes(body)
+        client.close()
+        server.close()
+
+
+def test_request_body_is_charged_while_received(monkeypatch):
+    budget = MemoryBudget(10 * 1024 * 1024)
+    monkeypatch.setattr(buffer, "default_budget", budget)
+
+    client, server = socket.socketpair()
+    tube = Tube()
+    tube.socket = server
+    body = b"z" * 300000
+    threading.Thread(
+        target=client.sendall,
+        args=(b"POST / HTTP/1.1\r\nHost: a\r\nContent-Length: %d\r\n\r\n" % len(body) + body,)).start()
+
+    raw = tube.recv_raw_http_msg(h11.Connection(our_role=h11.SERVER))
+    assert raw.endswith(body)
+    # ヘッダーと一緒に届いた分は数えない
+    assert budget.peak >= len(body) - 65536
+    assert budget.used == 0
+    client.close()
+    server.close()
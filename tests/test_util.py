@@ -0,0 +1,48 @@
+from os.path import dirname, abspath
+import sys
+
+import pytest
+
+parent_dir = dirname(dirname(abspath(__file__)))
+sys.path.append(parent_dir)
+from httprequest import exceptions
+from httprequest.util import ChunkedDecoder, ChunkedEncoder
+
+
+def decode(data: bytes, size: int = 1) -> bytes:
+    decoder = ChunkedDecoder()
+    chunks = []
+    for i in range(0, len(data), size):
+        chunks.extend(decoder.feed(data[i:i + size]))
+    assert decoder.finished
+    return b"".join(chunks)
+
+
+def test_decode_split_anywhere():
+    data = b"5;name=value\r\nhello\r\n1A\r\n" + b"x" * 26 + b"\r\n0\r\nExpires: 0\r\n\r\n"
+    for size in (1, 2, 7, len(data)):
+        assert decode(data, size) == b"hello" + b"x" * 26
+
+
+def test_trailers_and_unused_data():
+    decoder = ChunkedDecoder()
+    decoder.feed(b"3\r\nabc\r\n0\r\nX-Sum: 1\r\n\r\nHTTP/1.1")
+    assert decoder.trailers == [b"X-Sum: 1"]
+    assert decoder.unused_data == b"HTTP/1.1"
+
+
+@pytest.mark.parametrize("size", [b"0x1f", b"+5", b"-5", b"5_0", b" ", b"", b"g"])
+def test_invalid_chunk_size(size):
+    with pytest.raises(exceptions.ChunkedEncodingError):
+        ChunkedDecoder().feed(size + b"\r\n" + b"x" * 80 + b"\r\n0\r\n\r\n")
+
+
+def test_missing_crlf_after_data():
+    with pytest.raises(exceptions.ChunkedEncodingError):
+        ChunkedDecoder().feed(b"3\r\nabcX\r\n")
+
+
+def test_encoder_round_trip():
+    encoder = ChunkedEncoder()
+    data = encoder.encode(b"hello") + encoder.encode(b"") + encoder.encode(b"world") + encoder.end()
+    assert decode(data) == b"helloworld"